@@ -1,3 +1,7 @@
 export PYTHONHASHSEED=0
+export WRITE_MISMATCHES=1
+export WRITE_STATS=1
 py.test -s tests/test_chapter*.py
 export PYTHONHASHSEED=
+export WRITE_MISMATCHES=
+export WRITE_STATS=
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+
+from lxml import html
+
+from book_parser import assign_listing_ids, parse_listing
+
+# Finds listings straight from a chapter's .asciidoc source, so chapter tests
+# don't have to wait for asciidoctor to build the .html first.
+#
+# We only implement as much of the asciidoctor (compat-mode) block grammar as
+# we need to find listing blocks and the sourcecode example blocks that wrap
+# them.  Each one gets rendered to the same html `make %.html` would produce,
+# and then handed to parse_listing, so the CodeListing/Command/Output logic
+# stays in one place.  test_asciidoc_listings checks the results against the
+# built html for every chapter.
+
+BLOCK_ATTRIBUTE_LINE = re.compile(r'^\[(?:|[\w.#%{,"\'].*)\]$')
+BLOCK_ANCHOR = re.compile(r'^\[\[(?:|[\w:][\w:.-]*(?:, *.+)?)\]\]$')
+BLOCK_TITLE = re.compile(r'^\.(\.?[^ \t.].*)$')
+COMMENT_LINE = re.compile(r'^//(?=[^/]|$)')
+ATTRIBUTE_ENTRY = re.compile(r'^:!?\w[^:]*!?:(?:[ \t]+.*)?$')
+ATX_SECTION_TITLE = re.compile(r'^(=={0,5})[ \t]+\S')
+SETEXT_SECTION_TITLE = re.compile(r'^(?!\.).*\w.*$')
+SETEXT_UNDERLINE_CHARS = '=-~^+'
+ATTRIBUTE = re.compile(r'''\s*(?:([\w-]+)\s*=\s*)?("[^"]*"|'[^']*'|[^,]*?)\s*(?:,|$)''')
+
+VERBATIM_DELIMITERS = {
+    '-': 'listing',
+    '.': 'literal',
+    '+': 'pass',
+    '/': 'comment',
+}
+COMPOUND_DELIMITERS = {
+    '=': 'example',
+    '*': 'sidebar',
+    '_': 'quote',
+}
+ADMONITION_STYLES = {'NOTE', 'TIP', 'IMPORTANT', 'WARNING', 'CAUTION'}
+
+DEFAULT_SUBS = {
+    'verbatim': ['specialcharacters', 'callouts'],
+    'normal': [
+        'specialcharacters', 'quotes', 'attributes', 'replacements',
+        'macros', 'post_replacements'
+    ],
+    'none': [],
+}
+
+PASS_START, PASS_END = '\u0096', '\u0097'
+PASSTHROUGH_PLACEHOLDER = re.compile(PASS_START + r'(\d+)' + PASS_END)
+INLINE_PASS_MACRO = re.compile(
+    r'(?:(\\?)\+\+\+(.*?)\+\+\+)|'
+    r'(?:(\\?)\$\$(.*?)\$\$)|'
+    r'(?:(\\?)pass:([a-z]+(?:,[a-z]+)*)?\[(|.*?[^\\])\])',
+    re.DOTALL
+)
+INLINE_COMPAT_MONOSPACE = re.compile(
+    r'(^|[^`\w])(?:\[([^\]]+)\])?(\\?(`)([^`\s]|[^`\s].*?\S)`)(?![`\w])',
+    re.DOTALL | re.MULTILINE
+)
+INDEXTERM = re.compile(r'\\?\(\((.+?)\)\)(?!\))', re.DOTALL)
+INLINE_ANCHOR = re.compile(r'\\?\[\[([^\W\d][\w:.-]*)(?:, *(.+?))?\]\]')
+LINK_WITH_TEXT = re.compile(r'(^|[\s>(\[])(?:link:)?((?:https?|ftp|irc)://[^\s\[\]<]*[^\s.,\[\]<])\[([^\]]*)\]')
+
+CALLOUT = re.compile(
+    r'(?:(?://|#|--|;;) ?)?(\\)?&lt;!?(|--)(\d+|\.)\2&gt;'
+    r'(?=(?: ?\\?&lt;!?\2(?:\d+|\.)\2&gt;)*$)',
+    re.MULTILINE
+)
+
+def _constrained(mark):
+    return re.compile(
+        r'(^|[^\w;:}])(?:\[([^\]]+)\])?' + mark + r'(\S|\S.*?\S)' + mark + r'(?!\w)',
+        re.DOTALL | re.MULTILINE
+    )
+
+def _unconstrained(mark):
+    return re.compile(r'\\?(?:\[([^\]]+)\])?' + mark + r'(.+?)' + mark, re.DOTALL)
+
+# asciidoctor's compat-mode quote substitutions, in the order it applies them
+QUOTES = [
+    ('unconstrained', _unconstrained(r'\*\*'), '<strong>{}</strong>'),
+    ('constrained', _constrained(r'\*'), '<strong>{}</strong>'),
+    ('constrained', re.compile(
+        r"(^|[^\w;:}])(?:\[([^\]]+)\])?``(\S|\S.*?\S)''(?!\w)", re.DOTALL | re.MULTILINE
+    ), '&#8220;{}&#8221;'),
+    ('constrained', _constrained("'"), '<em>{}</em>'),
+    ('constrained', re.compile(
+        r"(^|[^\w;:}])(?:\[([^\]]+)\])?`(\S|\S.*?\S)'(?!\w)", re.DOTALL | re.MULTILINE
+    ), '&#8216;{}&#8217;'),
+    ('unconstrained', _unconstrained(r'\+\+'), '<code>{}</code>'),
+    ('constrained', _constrained(r'\+'), '<code>{}</code>'),
+    ('unconstrained', _unconstrained('__'), '<em>{}</em>'),
+    ('constrained', _constrained('_'), '<em>{}</em>'),
+    ('unconstrained', _unconstrained('##'), '<mark>{}</mark>'),
+    ('constrained', _constrained('#'), '<mark>{}</mark>'),
+    ('unconstrained', re.compile(r'\\?(?:\[([^\]]+)\])?\^(\S+?)\^'), '<sup>{}</sup>'),
+    ('unconstrained', re.compile(r'\\?(?:\[([^\]]+)\])?~(\S+?)~'), '<sub>{}</sub>'),
+]
+
+REPLACEMENTS = [
+    (re.compile(r'\\?\(C\)'), '&#169;'),
+    (re.compile(r'\\?\(R\)'), '&#174;'),
+    (re.compile(r'\\?\(TM\)'), '&#8482;'),
+    (re.compile(r'(^|\n| |\\)--( |\n|$)'), r'&#8201;&#8212;&#8201;'),
+    (re.compile(r'(\w)\\?--(?=\w)'), r'\1&#8212;&#8203;'),
+    (re.compile(r'\\?\.\.\.'), '&#8230;&#8203;'),
+    (re.compile(r"(\w)\\?'(?=\w)"), r'\1&#8217;'),
+    (re.compile(r'\\?-&gt;'), '&#8594;'),
+    (re.compile(r'\\?=&gt;'), '&#8658;'),
+    (re.compile(r'\\?&lt;-'), '&#8592;'),
+    (re.compile(r'\\?&lt;='), '&#8656;'),
+]
+
+
+class _Block(object):
+
+    def __init__(self, context, attributes, title, lines=None, children=None):
+        self.context = context
+        self.attributes = attributes
+        self.title = title
+        self.lines = lines or []
+        self.children = children or []
+
+
+    @property
+    def style(self):
+        return self.attributes.get('style')
+
+
+    @property
+    def roles(self):
+        return self.attributes.get('role', '').split()
+
+
+
+def _get_delimiter(line):
+    if line == '--':
+        return 'open'
+    if line.startswith('```'):
+        return 'fenced'
+    if len(line) < 4:
+        return None
+    if line.startswith('|===') and line[1:] == '=' * (len(line) - 1):
+        return 'table'
+    if line == line[0] * len(line):
+        return VERBATIM_DELIMITERS.get(line[0]) or COMPOUND_DELIMITERS.get(line[0])
+    return None
+
+
+def _is_setext_title(line, next_line):
+    if not next_line or next_line[0] not in SETEXT_UNDERLINE_CHARS:
+        return False
+    if next_line != next_line[0] * len(next_line):
+        return False
+    if not SETEXT_SECTION_TITLE.match(line):
+        return False
+    return abs(len(line) - len(next_line)) < 2
+
+
+def _parse_attributes(attrlist, attributes):
+    position = 0
+    for match in ATTRIBUTE.finditer(attrlist):
+        if match.end() == match.start():
+            break
+        name, value = match.groups()
+        if value[:1] in ('"', "'") and value[-1:] == value[:1] and len(value) > 1:
+            value = value[1:-1]
+        if name:
+            attributes[name] = value
+            continue
+        position += 1
+        if position == 1:
+            if value:
+                attributes['style'] = value.split('.')[0].split('#')[0]
+                for role in re.findall(r'\.([\w-]+)', value):
+                    attributes['role'] = (attributes.get('role', '') + ' ' + role).strip()
+        elif position == 2 and attributes.get('style') == 'source':
+            attributes['language'] = value
+
+
+def _read_until(lines, i, closing):
+    start = i
+    while i < len(lines) and lines[i] != closing:
+        i += 1
+    return lines[start:i], i + 1
+
+
+def _read_paragraph(lines, i):
+    paragraph = []
+    while i < len(lines):
+        line = lines[i]
+        if not line:
+            break
+        if paragraph and (BLOCK_ATTRIBUTE_LINE.match(line) or _get_delimiter(line)):
+            break
+        if paragraph and line == '+':
+            break
+        if not COMMENT_LINE.match(line):
+            paragraph.append(line)
+        i += 1
+    return paragraph, i
+
+
+def _parse_blocks(lines, i=0, closing=None):
+    blocks = []
+    attributes = {}
+    title = None
+    while i < len(lines):
+        line = lines[i]
+        if closing is not None and line == closing:
+            return blocks, i + 1
+        if not line or COMMENT_LINE.match(line) or BLOCK_ANCHOR.match(line):
+            i += 1
+            continue
+        if BLOCK_ATTRIBUTE_LINE.match(line):
+            _parse_attributes(line[1:-1], attributes)
+            i += 1
+            continue
+        if BLOCK_TITLE.match(line):
+            title = line[1:]
+            i += 1
+            continue
+        if ATTRIBUTE_ENTRY.match(line):
+            i += 1
+            continue
+
+        delimiter = _get_delimiter(line)
+        style = attributes.get('style')
+        if delimiter == 'open' and style in ('source', 'listing', 'literal', 'pass', 'comment'):
+            delimiter = 'listing' if style == 'source' else style
+
+        if delimiter in ('listing', 'literal', 'fenced'):
+            contents, i = _read_until(lines, i + 1, '```' if delimiter == 'fenced' else line)
+            if delimiter == 'fenced':
+                attributes.setdefault('style', 'source')
+                if line[3:].strip():
+                    attributes.setdefault('language', line[3:].strip())
+            context = 'listing'
+            if delimiter == 'literal' and attributes.get('style') not in ('source', 'listing'):
+                context = 'literal'
+            if delimiter != 'literal' and attributes.get('style') == 'literal':
+                context = 'literal'
+            blocks.append(_Block(context, attributes, title, lines=contents))
+
+        elif delimiter in ('pass', 'comment', 'table'):
+            _, i = _read_until(lines, i + 1, line)
+
+        elif delimiter:
+            children, i = _parse_blocks(lines, i + 1, closing=line)
+            context = delimiter
+            if delimiter == 'example' and style in ADMONITION_STYLES:
+                context = 'admonition'
+            blocks.append(_Block(context, attributes, title, children=children))
+
+        elif closing is None and i + 1 < len(lines) and _is_setext_title(line, lines[i + 1]):
+            i += 2
+
+        elif closing is None and ATX_SECTION_TITLE.match(line):
+            i += 1
+
+        else:
+            paragraph, i = _read_paragraph(lines, i)
+            if style in ('source', 'listing'):
+                blocks.append(_Block('listing', attributes, title, lines=paragraph))
+            elif style == 'literal' or line[0] in ' \t':
+                blocks.append(_Block('literal', attributes, title, lines=paragraph))
+            else:
+                blocks.append(_Block('paragraph', attributes, title, lines=paragraph))
+
+        attributes = {}
+        title = None
+
+    return blocks, i
+
+
+def _resolve_subs(subs_attribute, default):
+    if subs_attribute is None:
+        return list(DEFAULT_SUBS[default])
+    subs = []
+    for sub in [s.strip() for s in subs_attribute.split(',') if s.strip()]:
+        if sub.startswith('+'):
+            subs = subs or list(DEFAULT_SUBS[default])
+            subs.append(sub[1:])
+        elif sub.endswith('+'):
+            subs = [sub[:-1]] + (subs or list(DEFAULT_SUBS[default]))
+        elif sub.startswith('-'):
+            subs = [s for s in (subs or DEFAULT_SUBS[default]) if s != sub[1:]]
+        elif sub in DEFAULT_SUBS:
+            subs.extend(DEFAULT_SUBS[sub])
+        else:
+            subs.append(sub)
+    return subs
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _sub_quotes(text):
+    for scope, pattern, template in QUOTES:
+        if scope == 'constrained':
+            def convert(match, template=template):
+                if match.group(1) == '\\':
+                    return match.group(0)[1:]
+                return match.group(1) + template.format(match.group(3))
+        else:
+            def convert(match, template=template):
+                if match.group(0).startswith('\\'):
+                    return match.group(0)[1:]
+                return template.format(match.group(2))
+        text = pattern.sub(convert, text)
+    return text
+
+
+def _sub_replacements(text):
+    for pattern, replacement in REPLACEMENTS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _sub_macros(text):
+    def indexterm(match):
+        if match.group(0).startswith('\\'):
+            return match.group(0)[1:]
+        term = match.group(1)
+        if term.startswith('(') and term.endswith(')'):
+            return ''  # (((concealed, index, term)))
+        return term
+    if '((' in text:
+        text = INDEXTERM.sub(indexterm, text)
+    if '[[' in text:
+        text = INLINE_ANCHOR.sub(lambda m: m.group(0)[1:] if m.group(0).startswith('\\') else '', text)
+    if '://' in text:
+        text = LINK_WITH_TEXT.sub(lambda m: m.group(1) + (m.group(3) or m.group(2)), text)
+    return text
+
+
+def _sub_callouts(text):
+    def callout(match):
+        if match.group(1):
+            return '&lt;{}&gt;'.format(match.group(3))
+        return '<i class="conum" data-value="{0}"></i><b>({0})</b>'.format(match.group(3))
+    return CALLOUT.sub(callout, text)
+
+
+def _extract_passthroughs(text, passthroughs):
+    def store(rendered):
+        passthroughs.append(rendered)
+        return '{}{}{}'.format(PASS_START, len(passthroughs) - 1, PASS_END)
+
+    def pass_macro(match):
+        if match.group(1) is not None and match.group(2) is not None:
+            if match.group(1):
+                return match.group(0)[1:]
+            return store(match.group(2))
+        if match.group(3) is not None and match.group(4) is not None:
+            if match.group(3):
+                return match.group(0)[1:]
+            return store(_escape(match.group(4)))
+        if match.group(5):
+            return match.group(0)[1:]
+        contents = match.group(7).replace('\\]', ']')
+        if match.group(6):
+            contents = _apply_subs(contents, _resolve_subs(match.group(6), 'none'))
+        return store(contents)
+
+    def compat_monospace(match):
+        if match.group(3).startswith('\\'):
+            attrs = '[{}]'.format(match.group(2)) if match.group(2) else ''
+            return match.group(1) + attrs + match.group(3)[1:]
+        return match.group(1) + store('<code>{}</code>'.format(_escape(match.group(5))))
+
+    if '++' in text or '$$' in text or 'ss:' in text:
+        text = INLINE_PASS_MACRO.sub(pass_macro, text)
+    if '`' in text:
+        text = INLINE_COMPAT_MONOSPACE.sub(compat_monospace, text)
+    return text
+
+
+def _apply_subs(text, subs):
+    passthroughs = []
+    if 'macros' in subs:
+        text = _extract_passthroughs(text, passthroughs)
+    for sub in subs:
+        if sub == 'specialcharacters':
+            text = _escape(text)
+        elif sub == 'quotes':
+            text = _sub_quotes(text)
+        elif sub == 'replacements':
+            text = _sub_replacements(text)
+        elif sub == 'macros':
+            text = _sub_macros(text)
+        elif sub == 'callouts':
+            text = _sub_callouts(text)
+    if passthroughs:
+        text = PASSTHROUGH_PLACEHOLDER.sub(lambda m: passthroughs[int(m.group(1))], text)
+    return text
+
+
+def _strip_blank_lines(lines):
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return lines[start:end]
+
+
+def _render_title(title):
+    if title is None:
+        return []
+    return ['<div class="title">{}</div>'.format(_apply_subs(title, DEFAULT_SUBS['normal']))]
+
+
+def _render(block):
+    if block.context == 'listing':
+        text = _apply_subs(
+            '\n'.join(_strip_blank_lines(block.lines)),
+            _resolve_subs(block.attributes.get('subs'), 'verbatim'),
+        )
+        if block.style == 'source':
+            pre = '<pre class="CodeRay highlight"><code data-lang="{}">{}</code></pre>'.format(
+                block.attributes.get('language', ''), text
+            )
+        else:
+            pre = '<pre>{}</pre>'.format(text)
+        return '\n'.join(
+            ['<div class="{}">'.format(' '.join(['listingblock'] + block.roles))] +
+            _render_title(block.title) +
+            ['<div class="content">', pre, '</div>', '</div>']
+        )
+
+    if block.context in ('paragraph', 'literal'):
+        text = _apply_subs('\n'.join(block.lines), DEFAULT_SUBS['normal'])
+        return '<div class="paragraph">\n<p>{}</p>\n</div>'.format(text)
+
+    return '\n'.join(
+        ['<div class="{}">'.format(' '.join([block.context + 'block'] + block.roles))] +
+        _render_title(block.title) +
+        ['<div class="content">'] +
+        [_render(child) for child in block.children] +
+        ['</div>', '</div>']
+    )
+
+
+def _iter_listing_blocks(blocks):
+    for block in blocks:
+        if block.context == 'example' and 'sourcecode' in block.roles:
+            yield block
+        elif block.context == 'listing':
+            yield block
+        else:
+            for listing_block in _iter_listing_blocks(block.children):
+                yield listing_block
+
+
+def parse_listings_from_asciidoc(text):
+    lines = [l.rstrip() for l in text.replace('\r\n', '\n').split('\n')]
+    blocks, _ = _parse_blocks(lines)
+    return assign_listing_ids([
+        listing
+        for block in _iter_listing_blocks(blocks)
+        for listing in parse_listing(html.fragment_fromstring(_render(block)))
+    ])
+
+
+def load_listings_from_asciidoc(path):
+    with open(path, encoding='utf-8') as f:
+        return parse_listings_from_asciidoc(f.read())
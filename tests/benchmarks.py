@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the hot paths in the book tester
+
+Usage:
+    python tests/benchmarks.py [<benchmark>...]
+
+Runs all the benchmarks if none are named.  Chapter benchmarks use whatever
+chapter html has been built (make build), or a synthetic chapter if none has.
+"""
+import glob
+import os
+import sys
+import timeit
+
+from lxml import html
+
+from book_parser import get_listing_nodes
+from normalizers import fix_actual_output, fix_expected_output, wrap_long_line, wrap_long_lines
+import examples
+import html_selectors
+from test_normalizers import chained_actual, chained_expected, textwrap_long_lines
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_chapter_html():
+    paths = sorted(
+        glob.glob(os.path.join(BASE_DIR, 'chapter_*.html')) +
+        glob.glob(os.path.join(BASE_DIR, 'appendix_*.html'))
+    )
+    if not paths:
+        print('no chapter html found, using a synthetic 400-listing chapter')
+        listings = [
+            examples.CODE_LISTING_WITH_CAPTION,
+            examples.COMMANDS_WITH_VIRTUALENV,
+            examples.OUTPUT_WITH_COMMANDS_INLINE,
+            examples.CODE_LISTING_WITH_SKIPME,
+        ] * 100
+        body = '\n'.join(
+            '<div class="sect2"><div class="paragraph"><p>some text</p></div>{}</div>'.format(l)
+            for l in listings
+        )
+        return [('synthetic', '<html><body><div id="content">{}</div></body></html>'.format(body))]
+
+    chapters = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            chapters.append((os.path.basename(path), f.read()))
+    return chapters
+
+
+def _report(name, old_time, new_time):
+    print('{:<50} {:>10.2f}ms {:>10.2f}ms {:>8.1f}x'.format(
+        name, old_time * 1000, new_time * 1000, old_time / new_time
+    ))
+
+
+def _old_listing_nodes(parsed_html):
+    all_nodes = parsed_html.cssselect('.exampleblock.sourcecode, div:not(.sourcecode) div.listingblock')
+    listing_nodes = []
+    for ix, node in enumerate(all_nodes):
+        prev = all_nodes[ix - 1]
+        if node not in list(prev.iterdescendants()):
+            listing_nodes.append(node)
+    return listing_nodes
+
+
+def _header(old_name, new_name):
+    print('{:<50} {:>12} {:>12} {:>9}'.format('', old_name, new_name, 'speedup'))
+
+
+def bench_listing_nodes():
+    chapters = get_chapter_html()
+    _header('cssselect', 'tree walk')
+    total_old = total_new = 0
+    for name, raw_html in chapters:
+        parsed_html = html.fromstring(raw_html)
+        assert get_listing_nodes(parsed_html) == _old_listing_nodes(parsed_html), name
+        old_time = min(timeit.repeat(lambda: _old_listing_nodes(parsed_html), number=1, repeat=3))
+        new_time = min(timeit.repeat(lambda: get_listing_nodes(parsed_html), number=1, repeat=3))
+        total_old += old_time
+        total_new += new_time
+        _report(name, old_time, new_time)
+    _report('TOTAL', total_old, total_new)
+
+
+LISTING_SELECTORS = [
+    ('.title', html_selectors.TITLE),
+    ('.content', html_selectors.CONTENT),
+    ('div.content', html_selectors.DIV_CONTENT),
+    ('pre strong', html_selectors.PRE_STRONG),
+    ('pre code strong', html_selectors.PRE_CODE_STRONG),
+]
+
+
+def bench_selectors():
+    chapters = get_chapter_html()
+    _header('cssselect', 'precompiled')
+    total_old = total_new = 0
+    for name, raw_html in chapters:
+        nodes = get_listing_nodes(html.fromstring(raw_html))
+        for css, selector in LISTING_SELECTORS:
+            assert all(n.cssselect(css) == selector(n) for n in nodes), (name, css)
+        old = lambda: [n.cssselect(css) for n in nodes for css, _ in LISTING_SELECTORS]
+        new = lambda: [selector(n) for n in nodes for _, selector in LISTING_SELECTORS]
+        old_time = min(timeit.repeat(old, number=1, repeat=3))
+        new_time = min(timeit.repeat(new, number=1, repeat=3))
+        total_old += old_time
+        total_new += new_time
+        _report(name, old_time, new_time)
+    _report('TOTAL', total_old, total_new)
+
+
+def bench_normalizers():
+    with open(os.path.join(BASE_DIR, 'tests', 'actual_manage_py_test.output')) as f:
+        output = f.read()
+    _header('re.sub chain', 'one scan')
+    for name, old, new in [
+        ('actual', chained_actual, fix_actual_output),
+        ('expected', chained_expected, fix_expected_output),
+    ]:
+        assert old(output) == new(output), name
+        old_time = min(timeit.repeat(lambda: old(output), number=1, repeat=3))
+        new_time = min(timeit.repeat(lambda: new(output), number=1, repeat=3))
+        _report(name, old_time, new_time)
+
+
+def get_recorded_outputs():
+    outputs = []
+    for path in sorted(glob.glob(os.path.join(BASE_DIR, 'tests', '*.output'))):
+        with open(path) as f:
+            outputs.append((os.path.basename(path), f.read()))
+    return outputs
+
+
+def bench_wrap_long_lines():
+    _header('textwrap', 'fast path')
+    for name, output in get_recorded_outputs():
+        assert wrap_long_lines(output) == textwrap_long_lines(output), name
+        old_time = min(timeit.repeat(lambda: textwrap_long_lines(output), number=1, repeat=3))
+
+        def new():
+            # don't let the line cache carry over from the last run
+            wrap_long_line.cache_clear()
+            return wrap_long_lines(output)
+
+        new_time = min(timeit.repeat(new, number=1, repeat=3))
+        _report(name, old_time, new_time)
+
+
+BENCHMARKS = {
+    'listing_nodes': bench_listing_nodes,
+    'normalizers': bench_normalizers,
+    'selectors': bench_selectors,
+    'wrap_long_lines': bench_wrap_long_lines,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('\n==', name)
+        BENCHMARKS[name]()
@@ -1,33 +1,79 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from collections import namedtuple
+import copy
+import difflib
+import hashlib
+from lxml import etree, html
 import re
 
+from html_selectors import CONTENT, DIV_CONTENT, PRE_CODE_STRONG, PRE_STRONG, TITLE
+from output_matcher import ExpectedOutputMatcher
+
+
+# bump this whenever a change here alters what parse_listing returns, so that
+# any cached listings (see listing_cache.py) get thrown away
+BOOK_PARSER_VERSION = 7
 
 COMMIT_REF_FINDER = r'ch\d\dl\d\d\d-?\d?'
 
+GIT_COMMAND_TYPES = ('git diff', 'git status', 'git commit')
+INTERACTIVE_MANAGEPY_COMMANDS = {
+    'python manage.py migrate',
+    'python manage.py makemigrations',
+    'python manage.py collectstatic',
+}
+
+# "filename (chXXlXXX)", "server: filename" or just "filename", in one go
+CODE_LISTING_TITLE = re.compile(
+    r'(?:(.+) \((' + COMMIT_REF_FINDER + r')\)|server: (.*)|(.*))$'
+)
+
+
 class CodeListing(object):
     COMMIT_REF_FINDER = r'^(.+) \((' + COMMIT_REF_FINDER + ')\)$'
 
+    # lots of these get made (and pickled), so no per-instance __dict__
+    __slots__ = (
+        'filename', 'commit_ref', 'is_server_listing', '_contents', 'lines', '_is_diff',
+        'was_written', 'was_checked', 'skip', 'currentcontents', 'dofirst', 'listing_id',
+    )
+
     def __init__(self, filename, contents):
-        self.is_server_listing = False
-        if re.match(CodeListing.COMMIT_REF_FINDER, filename):
-            self.filename = re.match(CodeListing.COMMIT_REF_FINDER, filename).group(1)
-            self.commit_ref = re.match(CodeListing.COMMIT_REF_FINDER, filename).group(2)
-        elif filename.startswith('server: '):
-            self.filename = filename.replace('server: ', '')
-            self.commit_ref = None
-            self.is_server_listing = True
+        filename_with_ref, commit_ref, server_filename, plain_filename = (
+            CODE_LISTING_TITLE.match(filename).groups()
+        )
+        if filename_with_ref is not None:
+            self.filename = filename_with_ref
+        elif server_filename is not None:
+            self.filename = server_filename
         else:
-            self.filename = filename
-            self.commit_ref = None
+            self.filename = plain_filename
+        self.commit_ref = commit_ref
+        self.is_server_listing = server_filename is not None
         self.contents = contents
         self.was_written = False
+        self.was_checked = False
         self.skip = False
         self.currentcontents = False
+        self.dofirst = None
+        self.listing_id = None
+
+
+    @property
+    def contents(self):
+        return self._contents
+
+
+    @contents.setter
+    def contents(self, contents):
+        self._contents = contents
+        self.lines = contents.split('\n')
+        self._is_diff = any(l.count('@@') > 1 for l in self.lines)
 
 
     def is_diff(self):
-        return any(l.count('@@') > 1 for l in self.contents.split('\n'))
+        return self._is_diff
 
 
     @property
@@ -38,43 +84,46 @@ class CodeListing(object):
             return 'code listing currentcontents'
         elif self.commit_ref:
             return 'code listing with git ref'
-        elif self.is_diff():
+        elif self._is_diff:
             return 'diff'
         else:
             return 'code listing'
 
     def __repr__(self):
-        return '<CodeListing %s: %s...>' % (self.filename, self.contents.split('\n')[0])
+        return '<CodeListing %s: %s...>' % (self.filename, self.lines[0])
+
+
 
+def _classify_command(command):
+    for git_cmd in GIT_COMMAND_TYPES:
+        if git_cmd in command:
+            return git_cmd
+    if command.startswith('python') and 'test' in command:
+        return 'test'
+    if command == 'python manage.py behave':
+        return 'bdd test'
+    if command in INTERACTIVE_MANAGEPY_COMMANDS:
+        return 'interactive manage.py'
+    return 'other command'
 
 
 class Command(str):
+    # str subclasses can't have non-empty __slots__, so the best we can do
+    # is classify the text once, up front. the flags still win at lookup time
     def __init__(self, a_string):
         self.was_run = False
         self.skip = False
         self.server_command = False
         self.dofirst = None
+        self.listing_id = None
+        self._content_type = _classify_command(self)
         str.__init__(a_string)
 
     @property
     def type(self):
         if self.server_command:
             return 'server command'
-        for git_cmd in ('git diff', 'git status', 'git commit'):
-            if git_cmd in self:
-                return git_cmd
-        if self.startswith('python') and 'test' in self:
-            return 'test'
-        if self == 'python manage.py behave':
-            return 'bdd test'
-        if self == 'python manage.py migrate':
-            return 'interactive manage.py'
-        if self == 'python manage.py makemigrations':
-            return 'interactive manage.py'
-        if self == 'python manage.py collectstatic':
-            return 'interactive manage.py'
-        else:
-            return 'other command'
+        return self._content_type
 
     def __repr__(self):
         return '<Command %s>' % (str.__repr__(self),)
@@ -88,17 +137,31 @@ class Output(str):
         self.was_checked = False
         self.skip = False
         self.dofirst = None
+        self.listing_id = None
         self.qunit_output = False
+        self._content_type = 'tree' if u'├' in self else 'output'
+        self._matcher = None
         str.__init__(a_string)
 
     @property
     def type(self):
         if self.qunit_output:
             return 'qunit output'
-        if u'├' in self:
-            return 'tree'
-        else:
-            return 'output'
+        return self._content_type
+
+    @property
+    def matcher(self):
+        # worked out on first use rather than when parsing, and never
+        # pickled, so the listing cache can't hang on to the results of
+        # normalizers that have since changed
+        if self._matcher is None:
+            self._matcher = ExpectedOutputMatcher.compile(self)
+        return self._matcher
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_matcher'] = None
+        return state
 
 
 def fix_newlines(text):
@@ -109,7 +172,7 @@ def fix_newlines(text):
 def parse_output(listing):
     text = fix_newlines(listing.text_content().strip())
 
-    commands = listing.cssselect('pre strong')
+    commands = PRE_STRONG(listing)
     if not commands:
         return [Output(text)]
 
@@ -162,10 +225,10 @@ def parse_listing(listing):
 
     if 'sourcecode' in classes:
         try:
-            filename = listing.cssselect('.title')[0].text_content().strip()
+            filename = TITLE(listing)[0].text_content().strip()
         except IndexError:
             raise Exception('could not find title for listing {}'.format(listing.text_content()))
-        contents = listing.cssselect('.content')[0].text_content().replace('\r\n', '\n').strip('\n')
+        contents = CONTENT(listing)[0].text_content().replace('\r\n', '\n').strip('\n')
         contents = _strip_callouts(contents)
         listing = CodeListing(filename, contents)
         listing.skip = skip
@@ -175,7 +238,7 @@ def parse_listing(listing):
         return [listing]
 
     elif 'qunit-output' in classes:
-        contents = listing.cssselect('.content')[0].text_content().replace('\r\n', '\n').strip('\n')
+        contents = CONTENT(listing)[0].text_content().replace('\r\n', '\n').strip('\n')
         output = Output(contents)
         output.qunit_output = True
         output.skip = skip
@@ -183,7 +246,7 @@ def parse_listing(listing):
         return [output]
 
     if 'server-commands' in classes:
-        listing = listing.cssselect('div.content')[0]
+        listing = DIV_CONTENT(listing)[0]
 
     outputs = parse_output(listing)
     if skip:
@@ -202,6 +265,159 @@ def parse_listing(listing):
 def get_commands(node):
     return [
         el.text_content().replace('\\\n', '')
-        for el in node.cssselect('pre code strong')
+        for el in PRE_CODE_STRONG(node)
+    ]
+
+
+def get_listing_nodes(root):
+    # single walk in document order, equivalent to selecting
+    # '.exampleblock.sourcecode, div:not(.sourcecode) div.listingblock'
+    # and keeping only the outermost matches.  we don't descend into a
+    # listing once found, so nested listingblocks never get looked at.
+    listing_nodes = []
+    stack = [(root, False)]
+    while stack:
+        node, in_plain_div = stack.pop()
+        if not isinstance(node.tag, str):
+            continue  # comments, processing instructions
+        classes = node.get('class', '').split()
+        if 'exampleblock' in classes and 'sourcecode' in classes:
+            listing_nodes.append(node)
+            continue
+        if node.tag == 'div':
+            if in_plain_div and 'listingblock' in classes:
+                listing_nodes.append(node)
+                continue
+            in_plain_div = in_plain_div or 'sourcecode' not in classes
+        stack.extend((child, in_plain_div) for child in reversed(node))
+    return listing_nodes
+
+
+def _listing_kind_and_text(listing):
+    if isinstance(listing, CodeListing):
+        return 'code', listing.contents
+    if isinstance(listing, Command):
+        return 'command', str(listing)
+    return 'output', str(listing)
+
+
+def assign_listing_ids(listings):
+    # a stable name for each listing in a chapter, that doesn't change just
+    # because something got inserted above it.  listings with a commit ref
+    # are called that; everything else is "<anchor>:<kind>-<content hash>",
+    # where the anchor is the last commit ref (or dofirst) before it, and a
+    # ".2", ".3" suffix tells apart identical listings in the same stretch.
+    anchor = 'start'
+    seen = {}
+    for listing in listings:
+        commit_ref = getattr(listing, 'commit_ref', None)
+        if commit_ref:
+            anchor = base_id = commit_ref
+        else:
+            if listing.dofirst:
+                anchor = listing.dofirst
+            kind, text = _listing_kind_and_text(listing)
+            digest = hashlib.sha1(text.encode('utf8')).hexdigest()[:8]
+            base_id = '{}:{}-{}'.format(anchor, kind, digest)
+        seen[base_id] = seen.get(base_id, 0) + 1
+        if seen[base_id] == 1:
+            listing.listing_id = base_id
+        else:
+            listing.listing_id = '{}.{}'.format(base_id, seen[base_id])
+    return listings
+
+
+def parse_listings_from_html(raw_html):
+    parsed_html = html.fromstring(raw_html)
+    return assign_listing_ids(
+        [p for n in get_listing_nodes(parsed_html) for p in parse_listing(n)]
+    )
+
+
+# positions in inserted and modified are positions in the new listings,
+# positions in removed are positions in the old ones
+ListingChanges = namedtuple('ListingChanges', 'inserted removed modified')
+
+
+def fingerprint_listing_node(node):
+    return hashlib.sha1(etree.tostring(node, with_tail=False)).hexdigest()
+
+
+def _listing_keys(blocks):
+    return [
+        (fingerprint, ix)
+        for fingerprint, listings in blocks
+        for ix in range(len(listings))
     ]
 
+
+def diff_listing_blocks(old_blocks, new_blocks):
+    inserted, removed, modified = [], [], []
+    matcher = difflib.SequenceMatcher(
+        None, _listing_keys(old_blocks), _listing_keys(new_blocks), autojunk=False
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        paired = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+        modified.extend(range(j1, j1 + paired))
+        removed.extend(range(i1 + paired, i2))
+        inserted.extend(range(j1 + paired, j2))
+    return ListingChanges(inserted, removed, modified)
+
+
+def parse_listings_incrementally(raw_html, previous_blocks=None):
+    # blocks is a list of (fingerprint, listings) pairs, one per listing node.
+    # pass in the blocks from parsing an earlier version of the same chapter,
+    # and any node whose html hasn't changed doesn't get parsed again.
+    # the listings we return are copies, so the blocks stay pristine for next time
+    reusable = {}
+    for fingerprint, listings in previous_blocks or []:
+        reusable.setdefault(fingerprint, listings)
+
+    blocks = []
+    for node in get_listing_nodes(html.fromstring(raw_html)):
+        fingerprint = fingerprint_listing_node(node)
+        if fingerprint in reusable:
+            # copies, because identical nodes mustn't end up sharing listings
+            listings = [copy.copy(l) for l in reusable[fingerprint]]
+        else:
+            listings = parse_listing(node)
+        blocks.append((fingerprint, listings))
+
+    assign_listing_ids([l for _, block_listings in blocks for l in block_listings])
+    listings = [copy.copy(l) for _, block_listings in blocks for l in block_listings]
+    return listings, blocks, diff_listing_blocks(previous_blocks or [], blocks)
+
+
+def iter_book_listings(path, chunk_size=64 * 1024):
+    # stream (chapter_id, position, listing) out of the single-page book.html
+    # without ever holding the whole DOM: each chapter (a div.sect1) is parsed
+    # as soon as it's complete, then thrown away.  we use a pull parser rather
+    # than etree.iterparse so that we get HtmlElements (text_content etc)
+    parser = etree.HTMLPullParser(events=('end',), tag='div', encoding='utf-8')
+    parser.set_element_class_lookup(html.HtmlElementClassLookup())
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            for _, element in parser.read_events():
+                if 'sect1' not in element.get('class', '').split():
+                    continue
+                heading = element.find('h2')
+                chapter_id = heading.get('id') if heading is not None else None
+                listings = assign_listing_ids(
+                    [p for n in get_listing_nodes(element) for p in parse_listing(n)]
+                )
+                for position, listing in enumerate(listings):
+                    yield chapter_id, position, listing
+                element.clear()
+                parent = element.getparent()
+                while element.getprevious() is not None:
+                    del parent[0]
+            if not chunk:
+                return
+
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from lxml import html
+import copy
 import io
 import os
 import stat
@@ -8,7 +8,6 @@ import re
 import subprocess
 import time
 import tempfile
-from textwrap import wrap
 import unittest
 
 from write_to_file import write_to_file
@@ -16,8 +15,16 @@ from book_parser import (
     CodeListing,
     Command,
     Output,
-    parse_listing,
 )
+from asciidoc_listings import load_listings_from_asciidoc
+from listing_cache import load_listings
+from listing_store import ListingStore, StaleListingStoreException
+import command_stats
+import mismatch_report
+import normalizers
+from normalizers import fix_actual_line, fix_actual_output, translate, wrap_long_lines
+from output_matcher import ActualOutputIndex, StreamingOutputCheck
+from output_recorder import OutputRecorder
 from sourcetree import Commit, SourceTree
 from update_source_repo import update_sources_for_chapter
 
@@ -34,20 +41,33 @@ SLIMERJS_BINARY = os.path.join(
 DO_SERVER_COMMANDS = False
 
 
-def contains(inseq, subseq):
-    return any(
-        inseq[pos:pos + len(subseq)] == subseq
-        for pos in range(0, len(inseq) - len(subseq) + 1)
-    )
+def find_subsequence(inseq, subseq):
+    # knuth-morris-pratt, so a block gets found in one pass over the file
+    # however many near-misses (blank lines, "else:", etc) there are on the way
+    if not subseq:
+        return 0
+    fallbacks = [0] * len(subseq)
+    matched = 0
+    for pos in range(1, len(subseq)):
+        while matched and subseq[pos] != subseq[matched]:
+            matched = fallbacks[matched - 1]
+        if subseq[pos] == subseq[matched]:
+            matched += 1
+        fallbacks[pos] = matched
+    matched = 0
+    for pos, item in enumerate(inseq):
+        while matched and item != subseq[matched]:
+            matched = fallbacks[matched - 1]
+        if item == subseq[matched]:
+            matched += 1
+            if matched == len(subseq):
+                return pos - matched + 1
+    return -1
 
 
+def contains(inseq, subseq):
+    return find_subsequence(inseq, subseq) != -1
 
-def wrap_long_lines(text):
-    paragraphs = text.split('\n')
-    return '\n'.join(
-        '\n'.join(wrap(p, 79, break_long_words=True, break_on_hyphens=False))
-        for p in paragraphs
-    )
 
 
 def split_blocks(text):
@@ -57,180 +77,51 @@ def split_blocks(text):
     ]
 
 
-def fix_test_dashes(output):
-    return output.replace(' ' + '-' * 69, '-' * 70)
-
-
-def strip_mock_ids(output):
-    strip_mocks_with_names = re.sub(
-        r"Mock name='(.+)' id='(\d+)'>",
-        r"Mock name='\1' id='XX'>",
-        output,
-    )
-    strip_all_mocks = re.sub(
-        r"Mock id='(\d+)'>",
-        r"Mock id='XX'>",
-        strip_mocks_with_names,
-    )
-    return strip_all_mocks
-
-def strip_object_ids(output):
-    return re.sub('0x([0-9a-f]+)>', '0xXX>', output)
-
-
-def strip_migration_timestamps(output):
-    return re.sub(r'00(\d\d)_auto_20\d{6}_\d{4}', r'00\1_auto_20XXXXXX_XXXX', output)
-
-
-def strip_localhost_port(output):
-    return re.sub(r'localhost:\d\d\d\d\d?', r'localhost:XXXX', output)
-
-
-def strip_session_ids(output):
-    return re.sub(r'^[a-z0-9]{32}$', r'xxx_session_id_xxx', output)
-
-
-def standardise_assertionerror_none(output):
-    return output.replace("AssertionError: None", "AssertionError")
-
-
-def strip_git_hashes(output):
-    fixed_indexes = re.sub(
-        r"index .......\.\........ 100644",
-        r"index XXXXXXX\.\.XXXXXXX 100644",
-        output,
-    )
-    fixed_commit_numbers = re.sub(
-        r"^[a-f0-9]{7} ",
-        r"XXXXXXX ",
-        fixed_indexes,
-        flags=re.MULTILINE,
-    )
-    return fixed_commit_numbers
-
-
-def strip_callouts(output):
-    minus_old_callouts = re.sub(
-        r"^(.+)  <\d+>$",
-        r"\1",
-        output,
-        flags=re.MULTILINE,
-    )
-    minus_new_callouts = re.sub(
-        r"^(.+)  \(\d+\)$",
-        r"\1",
-        minus_old_callouts,
-        flags=re.MULTILINE,
-    )
-    return minus_new_callouts
-
-
-def standardise_library_paths(output):
-    return re.sub(
-        r'(File ").+packages/', r'\1.../', output, flags=re.MULTILINE,
-    )
-
-
-def strip_test_speed(output):
-    return re.sub(
-        r"Ran (\d+) tests? in \d+\.\d\d\ds",
-        r"Ran \1 tests in X.Xs",
-        output,
-    )
-
-def strip_js_test_speed(output):
-    return re.sub(
-        r"Took \d+ms to run (\d+) tests. (\d+) passed, (\d+) failed.",
-        r"Took XXms to run \1 tests. \2 passed, \3 failed.",
-        output,
-    )
-
-
-def strip_bdd_test_speed(output):
-    return re.sub(
-        r"features/steps/(\w+).py:(\d+) \d+.\d\d\ds",
-        r"features/steps/\1.py:\2 XX.XXXs",
-        output,
-    )
-
-
-def strip_screenshot_timestamps(output):
-    fixed = re.sub(
-        r"window0-(201\d-\d\d-\d\dT\d\d\.\d\d\.\d?\d?)",
-        r"window0-201X-XX-XXTXX.XX",
-        output,
-    )
-    # this last is very specific to one listing in 19...
-    fixed = re.sub(r"^\d\d\.html$", "XX.html", fixed, flags=re.MULTILINE)
-    return fixed
-
-
-SQLITE_MESSAGES = {
-    'django.db.utils.IntegrityError: lists_item.list_id may not be NULL':
-    'django.db.utils.IntegrityError: NOT NULL constraint failed: lists_item.list_id',
-
-    'django.db.utils.IntegrityError: columns list_id, text are not unique':
-    'django.db.utils.IntegrityError: UNIQUE constraint failed: lists_item.list_id,\nlists_item.text',
-
-    'sqlite3.IntegrityError: columns list_id, text are not unique':
-    'sqlite3.IntegrityError: UNIQUE constraint failed: lists_item.list_id,\nlists_item.text'
-}
-
-
-def fix_sqlite_messages(actual_text):
-    fixed_text = actual_text
-    for old_version, new_version in SQLITE_MESSAGES.items():
-        fixed_text = fixed_text.replace(old_version, new_version)
-    return fixed_text
-
-
-def fix_creating_database_line(actual_text):
-    if "Creating test database for alias 'default'..." in actual_text:
-        actual_lines = actual_text.split('\n')
-        actual_lines.remove("Creating test database for alias 'default'...")
-        actual_lines.insert(0, "Creating test database for alias 'default'...")
-        actual_text = '\n'.join(actual_lines)
-    return actual_text
-
-
-
-def fix_interactive_managepy_stuff(actual_text):
-    return actual_text.replace(
-        'Select an option: ', 'Select an option:\n',
-    ).replace(
-        '>>> ', '>>>\n',
-    )
-
 class ChapterTest(unittest.TestCase):
     maxDiff = None
+    # where the command stats go, if not command_stats.STATS_DIR
+    stats_dir = None
 
     def setUp(self):
-        self.sourcetree = SourceTree()
+        self.sourcetree = SourceTree(shell_session=bool(os.environ.get('SHELL_SESSION')))
         self.tempdir = self.sourcetree.tempdir
         self.processes = []
         self.pos = 0
         self.dev_server_running = False
         self.current_server_cd = None
+        normalizers.reset_stats()
+        self.recorder = OutputRecorder.from_environment(getattr(self, 'chapter_name', None))
 
 
     def tearDown(self):
         self.sourcetree.cleanup()
+        if self.recorder is not None:
+            self.recorder.save()
+        if hasattr(self, 'chapter_name') and command_stats.should_write_stats():
+            print('output normalizers for', self.chapter_name)
+            print(normalizers.format_stats())
+            stats = self.sourcetree.command_stats
+            if stats.records:
+                json_path, _ = stats.write_report(self.chapter_name, self.stats_dir)
+                print('slowest commands for', self.chapter_name, '(all in {})'.format(json_path))
+                print(stats.format_report())
 
 
     def parse_listings(self):
         base_dir = os.path.split(os.path.abspath(os.path.dirname(__file__)))[0]
+        if os.environ.get('LISTING_STORE'):
+            try:
+                with ListingStore(os.environ['LISTING_STORE']) as store:
+                    self.listings = store.load_listings(self.chapter_name)
+                return
+            except StaleListingStoreException as e:
+                print(e, '(parsing the chapter instead)')
+        if os.environ.get('LISTINGS_FROM_ASCIIDOC'):
+            filename = self.chapter_name + '.asciidoc'
+            self.listings = load_listings_from_asciidoc(os.path.join(base_dir, filename))
+            return
         filename = self.chapter_name + '.html'
-        with open(os.path.join(base_dir, filename), encoding='utf-8') as f:
-            raw_html = f.read()
-        parsed_html = html.fromstring(raw_html)
-        all_nodes = parsed_html.cssselect('.exampleblock.sourcecode, div:not(.sourcecode) div.listingblock')
-        listing_nodes = []
-        for ix, node in enumerate(all_nodes):
-            prev = all_nodes[ix - 1]
-            if node not in list(prev.iterdescendants()):
-                listing_nodes.append(node)
-
-        self.listings = [p for n in listing_nodes for p in parse_listing(n)]
+        self.listings = load_listings(os.path.join(base_dir, filename))
 
 
     def check_final_diff(self, ignore=None, diff=None):
@@ -299,7 +190,9 @@ class ChapterTest(unittest.TestCase):
         codelisting.was_written = True
 
 
-    def run_command(self, command, cwd=None, user_input=None, ignore_errors=False):
+    def run_command(
+        self, command, cwd=None, user_input=None, ignore_errors=False, expected_output=None,
+    ):
         self.assertEqual(
             type(command), Command,
             "passed a non-Command to run-command:\n%s" % (command,)
@@ -308,11 +201,37 @@ class ChapterTest(unittest.TestCase):
             command.was_run = True
             return
         print('running command', command)
-        output = self.sourcetree.run_command(command, cwd=cwd, user_input=user_input, ignore_errors=ignore_errors)
+        output_check = None
+        if isinstance(expected_output, Output):
+            # a long test run can be stopped as soon as it's gone wrong
+            output_check = StreamingOutputCheck.for_output(
+                expected_output, self._fix_streamed_line
+            )
+        started = time.time()
+        stats_recorded = len(self.sourcetree.command_stats.records)
+        output = self.sourcetree.run_command(
+            command, cwd=cwd, user_input=user_input, ignore_errors=ignore_errors,
+            output_check=output_check,
+        )
+        for stats in self.sourcetree.command_stats.records[stats_recorded:]:
+            stats.update(pos=self.pos, listing_type=command.type)
+        if self.recorder is not None and output is not None:
+            self.recorder.record_command(
+                command, output, self.sourcetree.last_returncode,
+                time.time() - started, self.tempdir,
+            )
         command.was_run = True
         return output
 
 
+    def _fix_streamed_line(self, line):
+        # the same as assert_console_output_correct does to the whole output,
+        # except that it can't know yet whether to strip /private
+        if '/private' in line:
+            return None
+        return fix_actual_line(line.replace(self.tempdir, '/...'))
+
+
     def _cleanup_runserver(self):
         self.run_server_command('pkill -f runserver', ignore_errors=True)
 
@@ -377,18 +296,52 @@ class ChapterTest(unittest.TestCase):
             print(output)
 
 
-    def assertLineIn(self, line, lines):
+    def assertLineIn(self, line, lines, actual=None, expected=None, near=0):
+        # actual and expected are the whole outputs, for the mismatch files,
+        # and near is roughly where in lines the line ought to be
         if line not in lines:
+            if len(lines) > mismatch_report.MAX_LINES:
+                paths = self.write_mismatch(
+                    '\n'.join(lines) if actual is None else actual,
+                    line if expected is None else expected,
+                )
+                raise AssertionError(mismatch_report.missing_line_message(
+                    line, lines, paths and paths[0], near
+                ))
             raise AssertionError('%s not found in:\n%s' % (
                 repr(line), '\n'.join(repr(l) for l in lines))
             )
 
+
+    def assertOutputEqual(self, actual, expected):
+        if actual == expected:
+            return
+        paths = self.write_mismatch(actual, expected)
+        if mismatch_report.is_small(actual) and mismatch_report.is_small(expected):
+            self.assertMultiLineEqual(
+                actual, expected, paths and 'full outputs in:\n' + '\n'.join(paths)
+            )
+        raise AssertionError(mismatch_report.output_mismatch_message(actual, expected, paths))
+
+
+    def write_mismatch(self, actual, expected):
+        # only for chapter runs, not every failing unit test of the tester
+        if mismatch_report.should_write_mismatches():
+            return mismatch_report.write_mismatch(self.mismatch_name(), actual, expected)
+
+
+    def mismatch_name(self):
+        return '{}.{}'.format(getattr(self, 'chapter_name', type(self).__name__), self.pos)
+
+
     def assert_console_output_correct(self, actual, expected, ls=False):
         print('checking expected output', expected.encode('utf-8'))
         self.assertEqual(
             type(expected), Output,
             "passed a non-Output to run-command:\n%s" % (expected,)
         )
+        if self.recorder is not None:
+            self.recorder.record_check(actual, expected, ls, self.tempdir)
 
         if self.tempdir in actual:
             actual = actual.replace(self.tempdir, '/...')
@@ -400,64 +353,96 @@ class ChapterTest(unittest.TestCase):
             expected.was_checked = True
             return
 
-        actual_fixed = standardise_library_paths(actual)
-        actual_fixed = wrap_long_lines(actual_fixed)
-        actual_fixed = strip_test_speed(actual_fixed)
-        actual_fixed = strip_js_test_speed(actual_fixed)
-        actual_fixed = strip_bdd_test_speed(actual_fixed)
-        actual_fixed = strip_git_hashes(actual_fixed)
-        actual_fixed = strip_mock_ids(actual_fixed)
-        actual_fixed = strip_object_ids(actual_fixed)
-        actual_fixed = strip_migration_timestamps(actual_fixed)
-        actual_fixed = strip_session_ids(actual_fixed)
-        actual_fixed = strip_localhost_port(actual_fixed)
-        actual_fixed = strip_screenshot_timestamps(actual_fixed)
-        actual_fixed = fix_sqlite_messages(actual_fixed)
-        actual_fixed = fix_creating_database_line(actual_fixed)
-        actual_fixed = fix_interactive_managepy_stuff(actual_fixed)
-        actual_fixed = standardise_assertionerror_none(actual_fixed)
-
-        expected_fixed = standardise_library_paths(expected)
-        expected_fixed = fix_test_dashes(expected_fixed)
-        expected_fixed = strip_test_speed(expected_fixed)
-        expected_fixed = strip_js_test_speed(expected_fixed)
-        expected_fixed = strip_bdd_test_speed(expected_fixed)
-        expected_fixed = strip_git_hashes(expected_fixed)
-        expected_fixed = strip_mock_ids(expected_fixed)
-        expected_fixed = strip_object_ids(expected_fixed)
-        expected_fixed = strip_migration_timestamps(expected_fixed)
-        expected_fixed = strip_session_ids(expected_fixed)
-        expected_fixed = strip_localhost_port(expected_fixed)
-        expected_fixed = strip_screenshot_timestamps(expected_fixed)
-        expected_fixed = strip_callouts(expected_fixed)
-        expected_fixed = standardise_assertionerror_none(expected_fixed)
+        actual_fixed = fix_actual_output(actual)
+        matcher = expected.matcher
 
         if '\t' in actual_fixed:
             actual_fixed = re.sub(r'\s+', ' ', actual_fixed)
-            expected_fixed = re.sub(r'\s+', ' ', expected_fixed)
-
-        actual_lines = actual_fixed.split('\n')
-        expected_lines = expected_fixed.split('\n')
-
-        for line in expected_lines:
-            if line.startswith('[...'):
-                continue
-            if line.endswith('[...]'):
-                line = line.rsplit('[...]')[0].rstrip()
-                self.assertLineIn(line, [l[:len(line)] for l in actual_lines])
-            elif line.startswith(' '):
-                self.assertLineIn(line, actual_lines)
-            else:
-                self.assertLineIn(line, [l.strip() for l in actual_lines])
+            matcher = matcher.whitespace_collapsed
+
+        actual_index = ActualOutputIndex(actual_fixed.split('\n'))
+        for ix, (match_mode, line) in enumerate(matcher.lines):
+            if not actual_index.contains(match_mode, line):
+                self.assertLineIn(
+                    line, actual_index.candidates(match_mode, line),
+                    actual_fixed, matcher.text,
+                    near=self._where_line_should_be(actual_index, matcher.lines[:ix]),
+                )
 
-        if len(expected_lines) > 4 and '[...' not in expected_fixed:
+        if matcher.needs_full_equality:
             if expected.type != 'qunit output':
-                self.assertMultiLineEqual(actual_fixed.strip(), expected_fixed.strip())
+                self.assertOutputEqual(actual_fixed.strip(), matcher.text.strip())
 
         expected.was_checked = True
 
 
+    def _where_line_should_be(self, actual_index, lines_before):
+        # just after the last expected line before it, which must have been
+        # found (blank lines could have been found anywhere)
+        for match_mode, line in reversed(lines_before):
+            if line.strip():
+                return actual_index.position(match_mode, line) + 1
+        return 0
+
+
+    def recheck_recordings(self, records):
+        # the output checks from a recorded run, against the listings as they
+        # are now.  an expected output that's been edited gets a new listing
+        # id, so it's found as the one after its command instead
+        failures = []
+        # rechecks don't get recorded
+        recorder, self.recorder = self.recorder, None
+        try:
+            for record in list(records):
+                if record['expected_id'] is None:
+                    continue
+                expected = self._find_recorded_expected_output(record)
+                if expected is None:
+                    failures.append((record['expected_id'], 'no such listing any more'))
+                    continue
+                # a fresh copy, so its matcher gets built with the normalizers
+                # as they are now
+                expected = copy.copy(expected)
+                if expected.type == 'tree':
+                    expected = self._tree_for_checking(expected)
+                self.tempdir = record['tempdir']
+                try:
+                    self.assert_console_output_correct(record['output'], expected, ls=record['ls'])
+                except AssertionError as e:
+                    failures.append((record['expected_id'], str(e)))
+        finally:
+            self.tempdir = self.sourcetree.tempdir
+            self.recorder = recorder
+        return failures
+
+
+    def _find_recorded_expected_output(self, record):
+        for listing_id, offset in [(record['expected_id'], 0), (record['listing_id'], 1)]:
+            if listing_id is None:
+                continue
+            for pos, listing in enumerate(self.listings):
+                if listing.listing_id == listing_id:
+                    if pos + offset < len(self.listings):
+                        candidate = self.listings[pos + offset]
+                        if isinstance(candidate, Output):
+                            return candidate
+                    break
+
+
+    def position_of(self, listing_id):
+        for pos, listing in enumerate(self.listings):
+            if listing.listing_id == listing_id:
+                return pos
+        raise Exception('No listing with id {}. Listings were:\n{}'.format(
+            listing_id,
+            '\n'.join('{} {}'.format(l.listing_id, l) for l in self.listings)
+        ))
+
+
     def skip_with_check(self, pos, expected_content):
+        # pos can be a listing_id, which survives edits earlier in the chapter
+        if isinstance(pos, str):
+            pos = self.position_of(pos)
         listing = self.listings[pos]
         error = 'Could not find {} in at pos {}: "{}". Listings were:\n{}'.format(
             expected_content, pos, listing,
@@ -475,12 +460,8 @@ class ChapterTest(unittest.TestCase):
 
     def assert_directory_tree_correct(self, expected_tree, cwd=None):
         actual_tree = self.sourcetree.run_command('tree -I *.pyc --noreport', cwd)
-        # special case for first listing:
         original_tree = expected_tree
-        if expected_tree.startswith('superlists/'):
-            expected_tree = Output(
-                expected_tree.replace('superlists/', '.', 1)
-            )
+        expected_tree = self._tree_for_checking(expected_tree)
         # actual_tree = actual_tree.replace('\xa0\xa0', ' ')
         # expected_tree = Output(expected_tree.replace('\xa0\xa0', ' '))
 
@@ -488,6 +469,16 @@ class ChapterTest(unittest.TestCase):
         original_tree.was_checked = True
 
 
+    def _tree_for_checking(self, expected_tree):
+        # special case for first listing:
+        if expected_tree.startswith('superlists/'):
+            fixed_tree = Output(expected_tree.replace('superlists/', '.', 1))
+            # so the check gets recorded against the real listing
+            fixed_tree.listing_id = expected_tree.listing_id
+            return fixed_tree
+        return expected_tree
+
+
     def assert_all_listings_checked(self, listings, exceptions=[]):
         for i, listing in enumerate(listings):
             if i in exceptions:
@@ -518,7 +509,7 @@ class ChapterTest(unittest.TestCase):
         if test_command_in_listings:
             pos += 1
             self.assertIn('test', self.listings[pos])
-            test_run = self.run_command(self.listings[pos])
+            test_run = self.run_command(self.listings[pos], expected_output=self.listings[pos + 1])
         elif ft:
             test_run = self.run_command(Command("python functional_tests.py"))
         else:
@@ -541,11 +532,14 @@ class ChapterTest(unittest.TestCase):
         else:
             self.assertIn('test', self.listings[self.pos])
         self._strip_out_any_pycs()
+        expected_output = self.listings[self.pos + 1]
         if bdd:
-            test_run = self.run_command(self.listings[self.pos], ignore_errors=True)
+            test_run = self.run_command(
+                self.listings[self.pos], ignore_errors=True, expected_output=expected_output
+            )
         else:
-            test_run = self.run_command(self.listings[self.pos])
-        self.assert_console_output_correct(test_run, self.listings[self.pos + 1])
+            test_run = self.run_command(self.listings[self.pos], expected_output=expected_output)
+        self.assert_console_output_correct(test_run, expected_output)
         self.pos += 2
 
 
@@ -554,18 +548,7 @@ class ChapterTest(unittest.TestCase):
             ['phantomjs', PHANTOMJS_RUNNER, tests_path]
         ).decode()
         # some fixes to make phantom more like firefox
-        output = output.replace('at file', '@file')
-        output = re.sub(r"Can't find variable: (\w+)", r"\1 is not defined", output)
-        output = re.sub(
-            r"'(\w+)' is not an object \(evaluating '(\w+)\.\w+'\)",
-            r"\2 is \1",
-            output
-        )
-        output = re.sub(
-            r"'undefined' is not a function \(evaluating '(.+)\(.*\)'\)",
-            r"\1 is not a function",
-            output
-        )
+        output = translate(output, 'phantomjs-firefox')
         print('fixed phantomjs output', output)
         return output
 
@@ -613,11 +596,13 @@ class ChapterTest(unittest.TestCase):
     def check_current_contents(self, listing, actual_contents):
         print("CHECK CURRENT CONTENTS")
         stripped_actual_lines = [l.strip() for l in actual_contents.split('\n')]
+        actual_line_set = set(stripped_actual_lines)
         listing_contents = re.sub(r' +#$', '', listing.contents, flags=re.MULTILINE)
         for block in split_blocks(listing_contents):
             stripped_block = [line.strip() for line in block.strip().split('\n')]
             for line in stripped_block:
-                self.assertIn(line, stripped_actual_lines)
+                if line not in actual_line_set:
+                    self.assertIn(line, stripped_actual_lines)
             self.assertTrue(
                 contains(stripped_actual_lines, stripped_block),
                 '\n{}\n\nnot found in\n\n{}'.format('\n'.join(stripped_block), '\n'.join(stripped_actual_lines)),
@@ -686,7 +671,7 @@ class ChapterTest(unittest.TestCase):
 
     def restart_dev_server(self):
         print('restarting dev server')
-        self.run_command(Command('pkill -f runserver'))
+        self.sourcetree.supervisor.stop_matching('runserver')
         time.sleep(1)
         self.start_dev_server()
         time.sleep(1)
@@ -710,6 +695,7 @@ class ChapterTest(unittest.TestCase):
 
     def recognise_listing_and_process_it(self):
         listing = self.listings[self.pos]
+        listing_type = listing.type
         if listing.dofirst:
             print("DOFIRST", listing.dofirst)
             self.sourcetree.patch_from_commit(
@@ -720,23 +706,23 @@ class ChapterTest(unittest.TestCase):
             listing.was_checked = True
             listing.was_written = True
             self.pos += 1
-        elif listing.type == 'test':
+        elif listing_type == 'test':
             print("TEST RUN")
             self.run_test_and_check_result()
-        elif listing.type == 'bdd test':
+        elif listing_type == 'bdd test':
             print("BDD TEST RUN")
             self.run_test_and_check_result(bdd=True)
-        elif listing.type == 'git diff':
+        elif listing_type == 'git diff':
             print("GIT DIFF")
             self.check_diff_or_status(self.pos)
-        elif listing.type == 'git status':
+        elif listing_type == 'git status':
             print("STATUS")
             self.check_diff_or_status(self.pos)
-        elif listing.type == 'git commit':
+        elif listing_type == 'git commit':
             print("COMMIT")
             self.check_commit(self.pos)
 
-        elif listing.type == 'interactive manage.py':
+        elif listing_type == 'interactive manage.py':
             print("INTERACTIVE MANAGE.PY")
             output_before = self.listings[self.pos + 1]
             assert isinstance(output_before, Output)
@@ -800,12 +786,12 @@ class ChapterTest(unittest.TestCase):
 
 
 
-        elif listing.type == 'tree':
+        elif listing_type == 'tree':
             print("TREE")
             self.assert_directory_tree_correct(listing)
             self.pos += 1
 
-        elif listing.type == 'server command':
+        elif listing_type == 'server command':
             if DO_SERVER_COMMANDS:
                 server_output = self.run_server_command(listing)
             listing.was_run = True
@@ -818,7 +804,7 @@ class ChapterTest(unittest.TestCase):
                 next_listing.was_checked = True
                 self.pos += 1
 
-        elif listing.type == 'other command':
+        elif listing_type == 'other command':
             print("A COMMAND")
             output = self.run_command(listing)
             next_listing = self.listings[self.pos + 1]
@@ -837,38 +823,38 @@ class ChapterTest(unittest.TestCase):
                 listing.was_checked = True
                 self.pos += 1
 
-        elif listing.type == 'diff':
+        elif listing_type == 'diff':
             print("DIFF")
             self.apply_patch(listing)
 
-        elif listing.type == 'code listing currentcontents':
+        elif listing_type == 'code listing currentcontents':
             actual_contents = self.sourcetree.get_contents(
                 listing.filename
             )
             self.check_current_contents(listing, actual_contents)
             self.pos += 1
 
-        elif listing.type == 'code listing':
+        elif listing_type == 'code listing':
             print("CODE")
             self.write_to_file(listing)
             self.pos += 1
 
-        elif listing.type == 'code listing with git ref':
+        elif listing_type == 'code listing with git ref':
             print("CODE FROM GIT REF")
             self.sourcetree.apply_listing_from_commit(listing)
             self.pos += 1
 
-        elif listing.type == 'server code listing':
+        elif listing_type == 'server code listing':
             print("SERVER CODE")
             self.write_file_on_server(listing.filename, listing.contents)
             listing.was_written = True
             self.pos += 1
 
-        elif listing.type == 'qunit output':
+        elif listing_type == 'qunit output':
             self.check_qunit_output(listing)
             self.pos += 1
 
-        elif listing.type == 'output':
+        elif listing_type == 'output':
             self._strip_out_any_pycs()
             test_run = self.run_unit_tests()
             if 'OK' in test_run and 'OK' not in listing:
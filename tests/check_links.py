@@ -1,10 +1,12 @@
 from lxml import html
 import requests
 
+from html_selectors import LINKS
+
 with open('book.html') as f:
     node = html.fromstring(f.read())
 
-all_hrefs = [e.get('href') for e in node.cssselect('a')]
+all_hrefs = [e.get('href') for e in LINKS(node)]
 urls = [l for l in all_hrefs if l and l.startswith('h')]
 
 for l in urls:
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import resource
+import time
+
+STATS_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), '.command_stats')
+FIELDS = [
+    'pos', 'listing_type', 'kind', 'command', 'exit_code', 'seconds',
+    'cpu_seconds', 'children_max_rss_kb', 'output_bytes',
+]
+
+
+def should_write_stats():
+    # chapter runs set this, see the Makefile
+    return bool(os.environ.get('WRITE_STATS'))
+
+
+def get_kind(command):
+    # what sort of thing the time went on
+    if 'manage.py test' in command:
+        return 'django tests'
+    if 'functional_tests' in command:
+        return 'functional tests'
+    # eg the python in "source ../virtualenv/bin/activate && python ..."
+    programs = [os.path.basename(word) for word in command.split('&&')[-1].split()]
+    if 'pip' in programs:
+        return 'pip'
+    return programs[0] if programs else ''
+
+
+def _format_cpu(cpu_seconds):
+    return 'n/a' if cpu_seconds is None else '{:.2f}'.format(cpu_seconds)
+
+
+def _children_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+
+class CommandStats(object):
+    # wall time, cpu time and so on for each command a SourceTree runs.
+    #
+    # cpu time is the change in RUSAGE_CHILDREN, so it only covers processes
+    # that have been waited for, and only makes sense for one at a time: not
+    # background servers, commands in a shell session or SourceTree.run's
+    # (which can overlap), which get None (n/a in the report) instead.
+    # children_max_rss_kb is RUSAGE_CHILDREN's running max, the biggest child
+    # so far, not this command's: it only tells you which command first
+    # needed that much
+
+    def __init__(self):
+        self.records = []
+
+
+    def start(self, command):
+        started = time.time()
+        cpu, _ = _children_usage()
+        record = dict(
+            pos=None, listing_type=None, kind=get_kind(command), command=str(command),
+            exit_code=None, seconds=None, cpu_seconds=None, children_max_rss_kb=None,
+            output_bytes=None,
+        )
+        record['_started'] = (started, cpu)
+        self.records.append(record)
+        return record
+
+
+    def finish(self, record, exit_code, output, waited_for=True):
+        started, cpu_before = record.pop('_started')
+        cpu, max_rss = _children_usage()
+        if isinstance(output, str):
+            output = output.encode('utf8')
+        record.update(
+            exit_code=exit_code,
+            seconds=round(time.time() - started, 3),
+            cpu_seconds=round(cpu - cpu_before, 3) if waited_for else None,
+            children_max_rss_kb=max_rss if waited_for else None,
+            output_bytes=len(output) if output else 0,
+        )
+
+
+    def finished_records(self):
+        return [r for r in self.records if r['seconds'] is not None]
+
+
+    def write_report(self, name, stats_dir=None):
+        stats_dir = stats_dir or STATS_DIR
+        os.makedirs(stats_dir, exist_ok=True)
+        records = self.finished_records()
+        json_path = os.path.join(stats_dir, name + '.json')
+        with open(json_path, 'w') as f:
+            json.dump(records, f, indent=2)
+        csv_path = os.path.join(stats_dir, name + '.csv')
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        return json_path, csv_path
+
+
+    def format_report(self, top=10):
+        records = self.finished_records()
+        lines = ['{:>8} {:>8} {:>5} {:>4}  {}'.format('seconds', 'cpu', 'pos', 'exit', 'command')]
+        for record in sorted(records, key=lambda r: r['seconds'], reverse=True)[:top]:
+            lines.append('{:8.2f} {:>8} {:>5} {:>4}  {}'.format(
+                record['seconds'], _format_cpu(record['cpu_seconds']),
+                '' if record['pos'] is None else record['pos'],
+                '' if record['exit_code'] is None else record['exit_code'],
+                record['command'].split('\n')[0][:60],
+            ))
+        lines.append('')
+        lines.append('{:>8} {:>8} {:>5}  {}'.format('seconds', 'cpu', 'runs', 'kind'))
+        totals = {}
+        for record in records:
+            seconds, cpu, runs = totals.get(record['kind'], (0, None, 0))
+            if record['cpu_seconds'] is not None:
+                cpu = (cpu or 0) + record['cpu_seconds']
+            totals[record['kind']] = (seconds + record['seconds'], cpu, runs + 1)
+        for kind, (seconds, cpu, runs) in sorted(
+            totals.items(), key=lambda item: item[1][0], reverse=True
+        ):
+            lines.append('{:8.2f} {:>8} {:>5}  {}'.format(seconds, _format_cpu(cpu), runs, kind))
+        return '\n'.join(lines)
@@ -221,3 +221,16 @@ Ran 1 test in 10.575s
 FAILED (errors=1)</pre>
 </div>
 </div>'''
+
+
+# a whole (tiny) chapter
+CHAPTER_HTML = '<html><body><div id="content">{}</div></body></html>'.format(
+    '\n'.join([
+        CODE_LISTING_WITH_CAPTION_AND_GIT_COMMIT_REF,
+        CODE_LISTING_WITH_SKIPME,
+        OUTPUTS_WITH_CURRENTCONTENTS,
+        OUTPUTS_WITH_DOFIRST,
+        SERVER_COMMAND,
+        OUTPUT_QUNIT,
+    ])
+)
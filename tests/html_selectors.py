@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from lxml.cssselect import CSSSelector
+
+# element.cssselect(css) translates the css to xpath on every call, which adds
+# up when you do it for every listing in the book.  these get translated once,
+# at import time.  CSSSelector is an lxml.etree.XPath, so call them like
+# functions: TITLE(listing_node) returns the same list listing_node.cssselect('.title')
+# would.  (not called selectors.py, that would shadow the stdlib module)
+
+
+def _html_selector(css):
+    return CSSSelector(css, translator='html')
+
+
+# listings
+TITLE = _html_selector('.title')
+CONTENT = _html_selector('.content')
+DIV_CONTENT = _html_selector('div.content')
+PRE_STRONG = _html_selector('pre strong')
+PRE_CODE_STRONG = _html_selector('pre code strong')
+
+# links and anchors
+LINKS = _html_selector('a')
+INTERNAL_LINKS = _html_selector('a[href^="#"]')
+ELEMENTS_WITH_ID = _html_selector('*[id]')
+
+# page structure
+H1 = _html_selector('h1')
+H2 = _html_selector('h2')
+H3 = _html_selector('h3')
+HEAD = _html_selector('head')
+BODY = _html_selector('body')
+HEADER = _html_selector('#header')
+TOC = _html_selector('#toc')
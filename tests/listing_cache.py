@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import hashlib
+import os
+import pickle
+
+from book_parser import BOOK_PARSER_VERSION, parse_listings_incrementally
+
+CACHE_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '.listing_cache'
+)
+
+
+def get_cache_path(html_path, raw_html, cache_dir=CACHE_DIR):
+    chapter = os.path.basename(html_path)
+    sha = hashlib.sha1(raw_html).hexdigest()
+    return os.path.join(
+        cache_dir,
+        '{}.{}.v{}.pickle'.format(chapter, sha, BOOK_PARSER_VERSION)
+    )
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        print('ignoring unreadable listing cache', cache_path)
+        return None
+
+
+def _read_previous_blocks(html_path, cache_dir):
+    # whatever we cached for an older version of this chapter, if anything
+    chapter = os.path.basename(html_path)
+    pattern = '{}.*.v{}.pickle'.format(chapter, BOOK_PARSER_VERSION)
+    for previous_path in glob.glob(os.path.join(cache_dir, pattern)):
+        return _read_cache(previous_path)
+    return None
+
+
+def _write_cache(html_path, cache_path, blocks):
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    chapter = os.path.basename(html_path)
+    for stale_path in glob.glob(os.path.join(cache_dir, chapter + '.*.pickle')):
+        os.remove(stale_path)
+    tmp_path = cache_path + '.tmp{}'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(blocks, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def load_listings(html_path, cache_dir=CACHE_DIR):
+    with open(html_path, 'rb') as f:
+        raw_html = f.read()
+    cache_path = get_cache_path(html_path, raw_html, cache_dir)
+    blocks = _read_cache(cache_path)
+    if blocks is not None:
+        return [listing for _, listings in blocks for listing in listings]
+
+    # the chapter changed (or was never cached). only re-parse the listing
+    # blocks that are different from last time
+    previous_blocks = _read_previous_blocks(html_path, cache_dir)
+    listings, blocks, changes = parse_listings_incrementally(
+        raw_html.decode('utf-8'), previous_blocks
+    )
+    if previous_blocks is not None:
+        print('re-parsed {}: {} inserted, {} removed, {} modified'.format(
+            os.path.basename(html_path),
+            len(changes.inserted), len(changes.removed), len(changes.modified),
+        ))
+    _write_cache(html_path, cache_path, blocks)
+    return listings
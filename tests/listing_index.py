@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build and query an index of every listing in the book
+
+Usage:
+    listing_index.py build [--index=<path>] [--processes=<n>]
+    listing_index.py commit <commit_ref> [--index=<path>]
+    listing_index.py file <filename> [--index=<path>]
+
+Options:
+    --index=<path>      Index file [default: tests/.listing_cache/listing_index.jsonl]
+    --processes=<n>     Number of worker processes (default: one per cpu)
+"""
+import hashlib
+import json
+from multiprocessing import Pool
+import os
+
+from docopt import docopt
+
+from asciidoc_listings import load_listings_from_asciidoc
+from book_parser import CodeListing
+from listing_cache import CACHE_DIR, load_listings
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_PATH = os.path.join(CACHE_DIR, 'listing_index.jsonl')
+
+
+def get_chapters(atlas_path=os.path.join(BASE_DIR, 'atlas.json')):
+    with open(atlas_path) as f:
+        atlas = json.load(f)
+    return [
+        os.path.splitext(filename)[0]
+        for filename in atlas['files']
+        if filename.endswith('.asciidoc')
+    ]
+
+
+def get_source_path(chapter, base_dir=BASE_DIR):
+    # the html if it's been built, otherwise the asciidoc
+    html_path = os.path.join(base_dir, chapter + '.html')
+    if os.path.exists(html_path):
+        return html_path
+    return os.path.join(base_dir, chapter + '.asciidoc')
+
+
+def get_source_sha(chapter, base_dir=BASE_DIR):
+    with open(get_source_path(chapter, base_dir), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_chapter_listings(chapter, base_dir=BASE_DIR, cache_dir=CACHE_DIR):
+    source_path = get_source_path(chapter, base_dir)
+    if source_path.endswith('.html'):
+        return load_listings(source_path, cache_dir=cache_dir)
+    return load_listings_from_asciidoc(source_path)
+
+
+def index_chapter(chapter, base_dir=BASE_DIR, cache_dir=CACHE_DIR):
+    entries = []
+    for position, listing in enumerate(load_chapter_listings(chapter, base_dir, cache_dir)):
+        if isinstance(listing, CodeListing):
+            contents = listing.contents
+            filename, commit_ref = listing.filename, listing.commit_ref
+        else:
+            contents = str(listing)
+            filename = commit_ref = None
+        entries.append({
+            'chapter': chapter,
+            'position': position,
+            'type': listing.type,
+            'filename': filename,
+            'commit_ref': commit_ref,
+            'dofirst': listing.dofirst,
+            'listing_id': listing.listing_id,
+            'sha1': hashlib.sha1(contents.encode('utf8')).hexdigest(),
+        })
+    return entries
+
+
+def _index_chapter_in_worker(args):
+    return index_chapter(*args)
+
+
+def build_index(
+    index_path=INDEX_PATH, chapters=None, base_dir=BASE_DIR, cache_dir=CACHE_DIR, processes=None
+):
+    if chapters is None:
+        chapters = get_chapters(os.path.join(base_dir, 'atlas.json'))
+    with Pool(processes) as pool:
+        # imap keeps atlas order, so the index reads like the book does
+        per_chapter = pool.imap(_index_chapter_in_worker, [(c, base_dir, cache_dir) for c in chapters])
+        entries = [entry for chapter_entries in per_chapter for entry in chapter_entries]
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + '.tmp{}'.format(os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    os.replace(tmp_path, index_path)
+    return entries
+
+
+def load_index(index_path=INDEX_PATH):
+    with open(index_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_commit_ref(entries, commit_ref):
+    return [e for e in entries if commit_ref in (e['commit_ref'], e['dofirst'])]
+
+
+def find_listing_id(entries, listing_id):
+    return [e for e in entries if e['listing_id'] == listing_id]
+
+
+def find_filename(entries, filename):
+    # some listings write to several files, eg "lists/views.py, lists/urls.py"
+    return [
+        e for e in entries
+        if e['filename'] is not None and
+        filename in [f.strip() for f in e['filename'].split(',')]
+    ]
+
+
+def _print_entries(entries):
+    for entry in entries:
+        print('{chapter}:{position} {type} {filename} {commit_ref}'.format(**entry))
+
+
+def main(arguments):
+    index_path = arguments['--index']
+    if not os.path.isabs(index_path):
+        index_path = os.path.join(BASE_DIR, index_path)
+
+    if arguments['build']:
+        processes = arguments['--processes']
+        entries = build_index(index_path, processes=int(processes) if processes else None)
+        print('indexed {} listings into {}'.format(len(entries), index_path))
+    elif arguments['commit']:
+        _print_entries(find_commit_ref(load_index(index_path), arguments['<commit_ref>']))
+    elif arguments['file']:
+        _print_entries(find_filename(load_index(index_path), arguments['<filename>']))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Write every listing in the book to one compact, memory-mappable file
+
+Usage:
+    listing_store.py build [--store=<path>]
+    listing_store.py show <chapter> [--store=<path>]
+
+Options:
+    --store=<path>      Store file [default: tests/.listing_cache/listings.store]
+
+Chapter tests read from the store instead of parsing when LISTING_STORE is set
+to its path, so parallel test runs share one parse (and, via the page cache,
+one copy of the data).
+"""
+import mmap
+import os
+import struct
+
+from docopt import docopt
+
+from book_parser import BOOK_PARSER_VERSION, CodeListing, Command, Output
+from listing_cache import CACHE_DIR
+from listing_index import BASE_DIR, get_chapters, get_source_sha, load_chapter_listings
+
+STORE_PATH = os.path.join(CACHE_DIR, 'listings.store')
+
+# file layout, all little-endian:
+#   header
+#   chapter table   one CHAPTER per chapter: name, sha1 of the html (or
+#                   asciidoc) it came from, first listing, listing count
+#   listing table   one LISTING per listing
+#   string offsets  n_strings + 1 uint32s, into the string data
+#   string data     utf8, each distinct string stored once
+# strings are referred to by their index in the offsets table
+MAGIC = b'LSTR'
+STORE_FORMAT = 3
+HEADER = struct.Struct('<4sHHIII')  # magic, format, parser version, strings, chapters, listings
+CHAPTER = struct.Struct('<IIII')
+LISTING = struct.Struct('<BBxxIIIIII')  # kind, flags, type, text, filename, commit_ref, dofirst, id
+OFFSET = struct.Struct('<I')
+NO_STRING = 0xFFFFFFFF
+
+CODE_LISTING, COMMAND, OUTPUT = 0, 1, 2
+SKIP = 1
+CURRENTCONTENTS = 2
+SERVER_LISTING = 4
+SERVER_COMMAND = 8
+QUNIT_OUTPUT = 16
+
+
+class StaleListingStoreException(Exception):
+    pass
+
+
+
+class ChapterNotInStoreException(StaleListingStoreException):
+    pass
+
+
+
+class _StringTable(object):
+
+    def __init__(self):
+        self.ids = {}
+        self.encoded = []
+
+
+    def add(self, string):
+        if string is None:
+            return NO_STRING
+        if string not in self.ids:
+            self.ids[string] = len(self.encoded)
+            self.encoded.append(string.encode('utf8'))
+        return self.ids[string]
+
+
+
+def _pack_listing(listing, strings):
+    if isinstance(listing, CodeListing):
+        kind = CODE_LISTING
+        text = listing.contents
+        filename, commit_ref = listing.filename, listing.commit_ref
+        flags = (
+            (SKIP if listing.skip else 0) |
+            (CURRENTCONTENTS if listing.currentcontents else 0) |
+            (SERVER_LISTING if listing.is_server_listing else 0)
+        )
+    else:
+        kind = COMMAND if isinstance(listing, Command) else OUTPUT
+        text = str(listing)
+        filename = commit_ref = None
+        flags = (
+            (SKIP if listing.skip else 0) |
+            (SERVER_COMMAND if getattr(listing, 'server_command', False) else 0) |
+            (QUNIT_OUTPUT if getattr(listing, 'qunit_output', False) else 0)
+        )
+    return LISTING.pack(
+        kind, flags,
+        strings.add(listing.type),
+        strings.add(text),
+        strings.add(filename),
+        strings.add(commit_ref),
+        strings.add(listing.dofirst),
+        strings.add(listing.listing_id),
+    )
+
+
+def write_store(path, chapter_listings):
+    strings = _StringTable()
+    chapter_table = []
+    listing_table = []
+    for chapter, source_sha, listings in chapter_listings:
+        chapter_table.append(CHAPTER.pack(
+            strings.add(chapter), strings.add(source_sha), len(listing_table), len(listings)
+        ))
+        listing_table.extend(_pack_listing(l, strings) for l in listings)
+
+    offsets = [0]
+    for encoded in strings.encoded:
+        offsets.append(offsets[-1] + len(encoded))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, STORE_FORMAT, BOOK_PARSER_VERSION,
+            len(strings.encoded), len(chapter_table), len(listing_table),
+        ))
+        f.write(b''.join(chapter_table))
+        f.write(b''.join(listing_table))
+        f.write(b''.join(OFFSET.pack(o) for o in offsets))
+        f.write(b''.join(strings.encoded))
+    os.replace(tmp_path, path)
+
+
+def build_store(path=STORE_PATH, chapters=None, base_dir=BASE_DIR, cache_dir=CACHE_DIR):
+    if chapters is None:
+        chapters = get_chapters(os.path.join(base_dir, 'atlas.json'))
+    write_store(path, [
+        (
+            chapter,
+            get_source_sha(chapter, base_dir),
+            load_chapter_listings(chapter, base_dir, cache_dir),
+        )
+        for chapter in chapters
+    ])
+
+
+
+class ListingView(object):
+    # a window onto one record in the store.  nothing gets decoded until you
+    # ask for it, and materialize() builds the real listing the tester needs
+
+    __slots__ = ('_store', '_record')
+
+    def __init__(self, store, record):
+        self._store = store
+        self._record = record
+
+
+    @property
+    def kind(self):
+        return self._record[0]
+
+
+    @property
+    def type(self):
+        return self._store._get_string(self._record[2])
+
+
+    @property
+    def text(self):
+        return self._store._get_string(self._record[3])
+
+
+    @property
+    def filename(self):
+        return self._store._get_string(self._record[4])
+
+
+    @property
+    def commit_ref(self):
+        return self._store._get_string(self._record[5])
+
+
+    @property
+    def dofirst(self):
+        return self._store._get_string(self._record[6])
+
+
+    @property
+    def listing_id(self):
+        return self._store._get_string(self._record[7])
+
+
+    def materialize(self):
+        kind, flags = self._record[:2]
+        if kind == CODE_LISTING:
+            listing = CodeListing.__new__(CodeListing)
+            listing.filename = self.filename
+            listing.commit_ref = self.commit_ref
+            listing.is_server_listing = bool(flags & SERVER_LISTING)
+            listing.contents = self.text
+            listing.was_written = False
+            listing.was_checked = False
+            listing.currentcontents = bool(flags & CURRENTCONTENTS)
+        elif kind == COMMAND:
+            listing = Command(self.text)
+            listing.server_command = bool(flags & SERVER_COMMAND)
+        else:
+            listing = Output(self.text)
+            listing.qunit_output = bool(flags & QUNIT_OUTPUT)
+        listing.skip = bool(flags & SKIP)
+        listing.dofirst = self.dofirst
+        listing.listing_id = self.listing_id
+        return listing
+
+
+    def __repr__(self):
+        return '<ListingView {} {!r}>'.format(self.type, self.filename or self.text[:40])
+
+
+
+class ListingStore(object):
+    # the header says which parser wrote the store, and each chapter which
+    # version of its source, so a store can't quietly hand out listings the
+    # book no longer has
+
+    def __init__(self, path=STORE_PATH, base_dir=BASE_DIR):
+        self.path = path
+        self.base_dir = base_dir
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, store_format, parser_version, n_strings, n_chapters, n_listings = (
+            HEADER.unpack_from(self._map, 0)
+        )
+        if (magic, store_format, parser_version) != (MAGIC, STORE_FORMAT, BOOK_PARSER_VERSION):
+            self.close()
+            raise StaleListingStoreException(
+                '{} was written by a different version, rebuild it'.format(path)
+            )
+        self._listings_start = HEADER.size + n_chapters * CHAPTER.size
+        self._offsets_start = self._listings_start + n_listings * LISTING.size
+        self._strings_start = self._offsets_start + (n_strings + 1) * OFFSET.size
+        self._chapters = {}
+        for ix in range(n_chapters):
+            name, source_sha, first, count = CHAPTER.unpack_from(
+                self._map, HEADER.size + ix * CHAPTER.size
+            )
+            self._chapters[self._get_string(name)] = (self._get_string(source_sha), first, count)
+
+
+    def _get_string(self, string_id):
+        if string_id == NO_STRING:
+            return None
+        start, end = struct.unpack_from(
+            '<II', self._map, self._offsets_start + string_id * OFFSET.size
+        )
+        return self._map[self._strings_start + start:self._strings_start + end].decode('utf8')
+
+
+    def chapters(self):
+        return list(self._chapters)
+
+
+    def _get_chapter(self, chapter):
+        try:
+            return self._chapters[chapter]
+        except KeyError:
+            raise ChapterNotInStoreException(
+                '{} is not in {}, rebuild it'.format(chapter, self.path)
+            )
+
+
+    def source_sha(self, chapter):
+        return self._get_chapter(chapter)[0]
+
+
+    def views(self, chapter):
+        _, first, count = self._get_chapter(chapter)
+        return [
+            ListingView(self, LISTING.unpack_from(self._map, self._listings_start + ix * LISTING.size))
+            for ix in range(first, first + count)
+        ]
+
+
+    def load_listings(self, chapter):
+        stored_sha = self.source_sha(chapter)
+        if get_source_sha(chapter, self.base_dir) != stored_sha:
+            raise StaleListingStoreException(
+                '{} has changed since {} was built, rebuild it'.format(chapter, self.path)
+            )
+        return [view.materialize() for view in self.views(chapter)]
+
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def main(arguments):
+    store_path = arguments['--store']
+    if not os.path.isabs(store_path):
+        store_path = os.path.join(BASE_DIR, store_path)
+
+    if arguments['build']:
+        build_store(store_path)
+        print('wrote', store_path, os.path.getsize(store_path), 'bytes')
+    elif arguments['show']:
+        with ListingStore(store_path) as store:
+            for position, view in enumerate(store.views(arguments['<chapter>'])):
+                print(position, view)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import difflib
+import os
+
+# assertMultiLineEqual diffs the whole of both outputs, and assertLineIn
+# prints every line it looked through.  for a long failing test run that can
+# take ages and scroll the useful bit out of sight, so past these limits the
+# failure message only covers the area around the problem.  on chapter runs
+# (WRITE_MISMATCHES is set, see the Makefile) the full outputs go into
+# MISMATCH_DIR too
+MISMATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.mismatches')
+MAX_LINES = 200
+MAX_LINE_LENGTH = 500
+CONTEXT = 10
+CLOSE_MATCHES = 5
+# roughly how many characters difflib gets to look at when hunting for lines
+# like a missing one, taken from around where the line ought to have been
+SEARCH_BUDGET = 200000
+
+
+def is_small(text):
+    lines = text.split('\n')
+    return len(lines) <= MAX_LINES and all(len(l) <= MAX_LINE_LENGTH for l in lines)
+
+
+def clip(line):
+    if len(line) <= MAX_LINE_LENGTH:
+        return line
+    return '{} [... {} more chars]'.format(line[:MAX_LINE_LENGTH], len(line) - MAX_LINE_LENGTH)
+
+
+def first_difference(actual_lines, expected_lines):
+    for ix, (actual_line, expected_line) in enumerate(zip(actual_lines, expected_lines)):
+        if actual_line != expected_line:
+            return ix
+    return min(len(actual_lines), len(expected_lines))
+
+
+def windowed_diff(actual, expected):
+    # a diff of a few dozen lines either side of the first difference,
+    # which costs the same however long the outputs are
+    actual_lines = actual.split('\n')
+    expected_lines = expected.split('\n')
+    first = first_difference(actual_lines, expected_lines)
+    start = max(first - CONTEXT, 0)
+    end = first + 2 * CONTEXT
+    diff = difflib.unified_diff(
+        [clip(l) for l in expected_lines[start:end]],
+        [clip(l) for l in actual_lines[start:end]],
+        'expected', 'actual', lineterm='', n=CONTEXT,
+    )
+    return first + 1, list(diff)
+
+
+def lines_around(lines, near, budget=None):
+    # working outwards from lines[near], one line either side at a time
+    budget = SEARCH_BUDGET if budget is None else budget
+    near = max(0, min(near, len(lines)))
+    picked = {}
+    after, before = near, near - 1
+    while after < len(lines) or before >= 0:
+        for ix in [after, before]:
+            if 0 <= ix < len(lines) and lines[ix] not in picked:
+                budget -= len(lines[ix])
+                if budget < 0:
+                    return list(picked)
+                picked[lines[ix]] = ix
+        after, before = after + 1, before - 1
+    return list(picked)
+
+
+def close_matches(line, lines, near=0):
+    return difflib.get_close_matches(line, lines_around(lines, near), n=CLOSE_MATCHES)
+
+
+def should_write_mismatches():
+    return bool(os.environ.get('WRITE_MISMATCHES'))
+
+
+def write_mismatch(name, actual, expected):
+    os.makedirs(MISMATCH_DIR, exist_ok=True)
+    paths = []
+    for suffix, text in [('actual', actual), ('expected', expected)]:
+        path = os.path.join(MISMATCH_DIR, '{}.{}'.format(name, suffix))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        paths.append(path)
+    return paths
+
+
+def output_mismatch_message(actual, expected, paths):
+    line_number, diff = windowed_diff(actual, expected)
+    return '\n'.join(
+        ['output differs from expected, first at line {}:'.format(line_number)] +
+        diff +
+        (['full outputs in:'] + ['  ' + p for p in paths] if paths else [])
+    )
+
+
+def missing_line_message(line, lines, path, near=0):
+    return '\n'.join(
+        ['{} not found in {} lines. closest were:'.format(repr(line), len(lines))] +
+        [repr(l) for l in close_matches(line, lines, near)] +
+        (['all of them are in:', '  ' + path] if path else [])
+    )
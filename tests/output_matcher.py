@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+
+from normalizers import fix_expected_output
+
+# expected output never changes, so it gets normalized and worked out once,
+# when the listing is parsed (and then lives in the listing cache), instead
+# of every time assert_console_output_correct checks it.
+#
+# how each expected line has to turn up in the actual output:
+PREFIX = 'prefix'  # "some line [...]": the start of an actual line
+EXACT = 'exact'  # indented: a whole actual line, indentation and all
+STRIPPED = 'stripped'  # anything else: an actual line, ignoring surrounding whitespace
+
+
+CREATING_TEST_DATABASE = "Creating test database for alias 'default'..."
+WHITESPACE = re.compile(r'\s+')
+SESSION_ID_LINE = re.compile(r'^[a-z0-9]{32}$')
+
+
+def squash(fixed_text):
+    # what's left to compare once you ignore whitespace, and the line that
+    # fix_creating_database_line moves about
+    return WHITESPACE.sub('', fixed_text).replace(WHITESPACE.sub('', CREATING_TEST_DATABASE), '')
+
+
+def compile_lines(fixed_text):
+    lines = []
+    for line in fixed_text.split('\n'):
+        if line.startswith('[...'):
+            continue
+        if line.endswith('[...]'):
+            lines.append((PREFIX, line.rsplit('[...]')[0].rstrip()))
+        elif line.startswith(' '):
+            lines.append((EXACT, line))
+        else:
+            lines.append((STRIPPED, line))
+    return lines
+
+
+
+class ExpectedOutputMatcher(object):
+
+    def __init__(self, fixed_text):
+        self.text = fixed_text
+        self.lines = compile_lines(fixed_text)
+        # short outputs, and ones with bits left out, only need their lines
+        # to turn up somewhere.  anything else has to match exactly
+        self.needs_full_equality = (
+            len(fixed_text.split('\n')) > 4 and '[...' not in fixed_text
+        )
+        self._whitespace_collapsed = None
+        self._squashed = None
+
+
+    @classmethod
+    def compile(cls, expected_text):
+        return cls(fix_expected_output(expected_text))
+
+
+    @property
+    def whitespace_collapsed(self):
+        # for actual output with tabs in, where both sides get squashed down
+        # to single spaces (and hence a single line)
+        if self._whitespace_collapsed is None:
+            self._whitespace_collapsed = ExpectedOutputMatcher(re.sub(r'\s+', ' ', self.text))
+        return self._whitespace_collapsed
+
+
+    @property
+    def squashed(self):
+        if self._squashed is None:
+            self._squashed = squash(self.text)
+        return self._squashed
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_whitespace_collapsed'] = None
+        state['_squashed'] = None
+        return state
+
+
+    def __eq__(self, other):
+        return isinstance(other, ExpectedOutputMatcher) and self.text == other.text
+
+
+    def __repr__(self):
+        return '<ExpectedOutputMatcher {!r}>'.format(self.text[:40])
+
+
+
+class ActualOutputIndex(object):
+    # looking each expected line up in a list of actual lines (or a list of
+    # their prefixes, rebuilt for every "[...]" line) gets slow on long test
+    # runs.  these sets get built once per check instead
+
+    def __init__(self, actual_lines):
+        self.lines = actual_lines
+        self.exact = set(actual_lines)
+        self.stripped_lines = [l.strip() for l in actual_lines]
+        self.stripped = set(self.stripped_lines)
+        self._prefixes = {}
+
+
+    def prefixes(self, length):
+        if length not in self._prefixes:
+            self._prefixes[length] = set(l[:length] for l in self.lines)
+        return self._prefixes[length]
+
+
+    def contains(self, match_mode, line):
+        if match_mode == PREFIX:
+            return line in self.prefixes(len(line))
+        if match_mode == EXACT:
+            return line in self.exact
+        return line in self.stripped
+
+
+    def candidates(self, match_mode, line):
+        # what the line was looked for in, for the error message
+        if match_mode == PREFIX:
+            return [l[:len(line)] for l in self.lines]
+        if match_mode == EXACT:
+            return self.lines
+        return self.stripped_lines
+
+
+    def position(self, match_mode, line):
+        # where the line first turns up, also only for error messages
+        return self.candidates(match_mode, line).index(line)
+
+
+
+class StreamingOutputCheck(object):
+    # checks the output of a command a line at a time while it's still
+    # running, so a long test run that's already gone wrong can be stopped.
+    #
+    # it only ever gives up on outputs that have to match exactly, and only
+    # once it's certain: the normalizers never look across a line break, so
+    # each line can be fixed on its own, and if that (ignoring whitespace,
+    # which the tab handling and the final .strip() might) doesn't carry on
+    # from where the expected output got to, the full comparison can't pass.
+    # normalize_line can return None for a line it can't be sure about, and
+    # then the check stays out of it
+
+    def __init__(self, matcher, normalize_line):
+        self.expected = matcher.squashed
+        self.normalize_line = normalize_line
+        self.position = 0
+        self.undecided = False
+        self.mismatched_line = None
+
+
+    @classmethod
+    def for_output(cls, expected, normalize_line):
+        matcher = expected.matcher
+        if matcher.needs_full_equality and expected.type != 'qunit output':
+            return cls(matcher, normalize_line)
+
+
+    def feed(self, line):
+        # returns False once the output can't possibly match
+        if self.undecided or self.mismatched_line is not None:
+            return self.mismatched_line is None
+        line = line.rstrip('\n')
+        # a session id on its own only gets stripped if it's the whole output
+        normalized = None if SESSION_ID_LINE.match(line) else self.normalize_line(line)
+        if normalized is None:
+            self.undecided = True
+            return True
+        squashed = squash(normalized)
+        end = self.position + len(squashed)
+        if self.expected[self.position:end] != squashed:
+            self.mismatched_line = line
+            return False
+        self.position = end
+        return True
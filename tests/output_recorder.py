@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Recheck the recorded output of a chapter's commands against its listings
+
+Usage:
+    output_recorder.py recheck <chapter> [--recordings=<dir>]
+    output_recorder.py show <chapter> [--recordings=<dir>]
+
+Options:
+    --recordings=<dir>  Recordings folder [default: tests/.recordings]
+
+Chapter tests record the raw output of every command they run, and which
+expected output it got checked against, when RECORD_OUTPUTS is set to a
+folder.  "recheck" then runs just the output checks again, against whatever
+the listings and normalizers say now, in seconds rather than a full run.
+"""
+import gzip
+import json
+import os
+
+from docopt import docopt
+
+from listing_index import BASE_DIR
+
+
+def get_recording_path(recordings_dir, chapter_name):
+    return os.path.join(recordings_dir, chapter_name + '.jsonl.gz')
+
+
+def load_recordings(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+
+class OutputRecorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+
+
+    @classmethod
+    def from_environment(cls, chapter_name):
+        recordings_dir = os.environ.get('RECORD_OUTPUTS')
+        if recordings_dir and chapter_name:
+            return cls(get_recording_path(recordings_dir, chapter_name))
+
+
+    def record_command(self, command, output, exit_code, seconds, tempdir):
+        self.records.append(dict(
+            listing_id=getattr(command, 'listing_id', None),
+            command=str(command),
+            output=output,
+            exit_code=exit_code,
+            seconds=round(seconds, 3),
+            tempdir=tempdir,
+            expected_id=None,
+            ls=False,
+        ))
+
+
+    def record_check(self, actual, expected, ls, tempdir):
+        # usually the output of the last command, otherwise (js tests, say)
+        # it gets a record of its own
+        record = self.records[-1] if self.records else None
+        if record is None or record['output'] != actual or record['expected_id'] is not None:
+            record = dict(
+                listing_id=None, command=None, output=actual, exit_code=None,
+                seconds=None, tempdir=tempdir, expected_id=None, ls=False,
+            )
+            self.records.append(record)
+        record['expected_id'] = expected.listing_id
+        record['ls'] = ls
+
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+
+
+def main(arguments):
+    # book_tester imports this module
+    from book_tester import ChapterTest
+
+    recordings_dir = arguments['--recordings']
+    if not os.path.isabs(recordings_dir):
+        recordings_dir = os.path.join(BASE_DIR, recordings_dir)
+    chapter = arguments['<chapter>']
+    records = load_recordings(get_recording_path(recordings_dir, chapter))
+
+    if arguments['show']:
+        for record in records:
+            print(record['listing_id'], record['command'], record['exit_code'], record['seconds'])
+            print('  checked against', record['expected_id'])
+    elif arguments['recheck']:
+        checker = ChapterTest('recheck_recordings')
+        checker.chapter_name = chapter
+        checker.setUp()
+        # don't record over the recording
+        checker.recorder = None
+        try:
+            checker.parse_listings()
+            failures = checker.recheck_recordings(records)
+        finally:
+            checker.tearDown()
+        for listing_id, message in failures:
+            print('FAILED', listing_id)
+            print(message)
+        print('{} outputs rechecked, {} failed'.format(
+            len([r for r in records if r['expected_id'] is not None]), len(failures)
+        ))
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
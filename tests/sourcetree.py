@@ -1,11 +1,19 @@
+import asyncio
 import getpass
+import hashlib
 import os
 import io
 import re
 import signal
+import shlex
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
+import uuid
+
+from command_stats import CommandStats
 
 def strip_comments(line):
     match_python = re.match(r"^(.+\S) +#$", line)
@@ -58,12 +66,426 @@ class ApplyCommitException(Exception):
     pass
 
 
+
+# a "&" on its own, rather than part of "&&", "2>&1" or "&>"
+BACKGROUND_AMPERSAND = re.compile(r'(?<![&>])&(?![&>])')
+
+
+class ShellSession(object):
+    # one long-lived bash for all of a SourceTree's commands, instead of
+    # starting a new one for each.  each command gets eval'd (so a syntax
+    # error can't swallow what comes after it) from its cwd, with stdin from
+    # /dev/null so it can't eat the next command, and then the shell prints a
+    # unique sentinel and the exit status on a line of their own.  shell
+    # state, like an activated virtualenv, carries over from one command to
+    # the next; changes to os.environ get passed on before each command
+
+    def __init__(self, cwd):
+        self.process = subprocess.Popen(
+            ['/bin/bash', '--noprofile', '--norc'], cwd=cwd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            preexec_fn=os.setsid,
+            universal_newlines=True,
+        )
+        self.marker = uuid.uuid4().hex
+        self.commands_run = 0
+        self.environment = dict(os.environ)
+
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+
+    def _environment_changes(self):
+        changes = []
+        for name in set(self.environment) - set(os.environ):
+            changes.append('unset {}\n'.format(name))
+        for name, value in os.environ.items():
+            if self.environment.get(name) != value:
+                changes.append('export {}={}\n'.format(name, shlex.quote(value)))
+        self.environment = dict(os.environ)
+        return ''.join(changes)
+
+
+    def run(self, command, cwd):
+        self.commands_run += 1
+        sentinel = '{}-{}'.format(self.marker, self.commands_run)
+        self.process.stdin.write(self._environment_changes())
+        self.process.stdin.write(
+            "cd {} && eval {} < /dev/null; printf '\\n%s %d\\n' {} $?\n".format(
+                shlex.quote(cwd), shlex.quote(command), sentinel,
+            )
+        )
+        self.process.stdin.flush()
+        lines = []
+        for line in self.process.stdout:
+            if line.startswith(sentinel + ' '):
+                # and drop the newline printf put in front of the sentinel
+                return ''.join(lines)[:-1], int(line.split()[1])
+            lines.append(line)
+        # the command took the shell with it ("exit", say)
+        self.process.wait()
+        return ''.join(lines), self.process.returncode
+
+
+    def close(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+
+# how long a command gets before it's assumed to have hung: the limit for
+# the first of these it contains, or the default.  the dev server gets none.
+# on a slow machine, TIMEOUT_SCALE=2 (say) doubles them all
+COMMAND_TIMEOUTS = [
+    # provisions a server and installs everything on it
+    ('fab deploy', 30 * 60),
+    ('functional_tests', 15 * 60),
+    ('pip install', 15 * 60),
+    ('test', 10 * 60),
+]
+DEFAULT_TIMEOUT = 5 * 60
+# between asking a process group nicely (SIGTERM) and SIGKILL
+KILL_GRACE = 5
+
+
+def get_timeout(command):
+    if 'runserver' in command:
+        return None
+    timeout = DEFAULT_TIMEOUT
+    for pattern, limit in COMMAND_TIMEOUTS:
+        if pattern in command:
+            timeout = limit
+            break
+    if os.environ.get('TIMEOUT_SCALE'):
+        timeout *= float(os.environ['TIMEOUT_SCALE'])
+    return timeout
+
+
+def timed_out_note(command):
+    return '\n[timed out after {}s]\n'.format(get_timeout(command))
+
+
+def _group_is_alive(process_group):
+    try:
+        os.killpg(process_group, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if not os.path.isdir('/proc'):
+        return True
+    # zombies stay in the group until something reaps them, which in a
+    # container without a proper init can be never
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                stat = f.read()
+        except (OSError, ValueError):
+            continue
+        # pid (command) state ppid pgrp ...
+        state, _, pgrp = stat.rpartition(')')[2].split()[:3]
+        if int(pgrp) == process_group and state != 'Z':
+            return True
+    return False
+
+
+def _signal_group(process_group, signal_number):
+    try:
+        os.killpg(process_group, signal_number)
+    except OSError:
+        pass
+
+
+
+class ProcessSupervisor(object):
+    # every command a SourceTree starts gets a session (and so a process
+    # group) of its own, and this keeps track of them: it times out the ones
+    # that hang, closes their pipes once they're done, and when stopping
+    # things it only ever signals those groups, never anything else on the
+    # machine
+
+    def __init__(self, kill_grace=KILL_GRACE):
+        self.kill_grace = kill_grace
+        self.processes = []
+        self._timers = {}
+
+
+    def start(
+        self, command, actual_command, cwd, timeout=None, background=False, binary=False,
+    ):
+        self.reap()
+        # nobody reads from a background process, so it mustn't be left
+        # blocked on a full pipe
+        pipe = subprocess.DEVNULL if background else subprocess.PIPE
+        process = subprocess.Popen(
+            actual_command, shell=True, cwd=cwd, executable='/bin/bash',
+            stdout=pipe, stderr=subprocess.STDOUT,
+            stdin=pipe,
+            preexec_fn=os.setsid,
+            universal_newlines=not binary,
+        )
+        process._command = command
+        self.watch(process, timeout)
+        return process
+
+
+    def watch(self, process, timeout=None):
+        # for processes started some other way, eg by asyncio
+        self.processes.append(process)
+        self.time_limit(process, timeout)
+
+
+    def time_limit(self, process, timeout):
+        # also used on its own for the shell session, which lives on after
+        # each command
+        process._timed_out = False
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._time_out, [process])
+            timer.daemon = True
+            timer.start()
+            self._timers[process.pid] = timer
+
+
+    def cancel_time_limit(self, process):
+        timer = self._timers.pop(process.pid, None)
+        if timer is not None:
+            timer.cancel()
+
+
+    def _time_out(self, process):
+        process._timed_out = True
+        print('{} timed out, stopping it'.format(process._command))
+        self.stop(process)
+
+
+    def done(self, process):
+        self.cancel_time_limit(process)
+        if isinstance(process, subprocess.Popen):
+            for pipe in [process.stdin, process.stdout]:
+                if pipe is not None:
+                    pipe.close()
+
+
+    def _has_finished(self, process):
+        if isinstance(process, subprocess.Popen):
+            process.poll()
+        return process.returncode is not None and not _group_is_alive(process.pid)
+
+
+    def reap(self):
+        # forgets about groups with nothing left running in them
+        for process in [p for p in self.processes if self._has_finished(p)]:
+            self.done(process)
+            self.processes.remove(process)
+
+
+    def stop(self, *processes):
+        for process in processes:
+            _signal_group(process.pid, signal.SIGTERM)
+        deadline = time.time() + self.kill_grace
+        while time.time() < deadline:
+            if all(self._has_finished(p) for p in processes):
+                return
+            time.sleep(0.05)
+        for process in processes:
+            if not self._has_finished(process):
+                print('{} ignored SIGTERM, killing it'.format(process._command))
+                _signal_group(process.pid, signal.SIGKILL)
+
+
+    async def stop_async(self, *processes):
+        # the same, for asyncio processes, whose returncode only gets set
+        # while the event loop is free to notice
+        for process in processes:
+            _signal_group(process.pid, signal.SIGTERM)
+        deadline = time.time() + self.kill_grace
+        while time.time() < deadline:
+            if all(self._has_finished(p) for p in processes):
+                return
+            await asyncio.sleep(0.05)
+        for process in processes:
+            if not self._has_finished(process):
+                print('{} ignored SIGTERM, killing it'.format(process._command))
+                _signal_group(process.pid, signal.SIGKILL)
+
+
+    def stop_matching(self, text):
+        self.stop(*[p for p in self.processes if text in p._command])
+        self.reap()
+
+
+    def stop_all(self):
+        self.stop(*self.processes)
+        for process in self.processes:
+            self.done(process)
+        self.processes = []
+
+
+
+GIT_QUERY_CACHE_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    '.git_query_cache'
+)
+
+
+class GitQueryCache(object):
+    # what "git show" and friends say about a commit never changes, so once
+    # a commit spec has been resolved to a sha, the answers get kept, in
+    # memory and on disk, and reruns of a chapter don't have to ask again.
+    # resolving specs is remembered too, until the next checkout.
+    #
+    # answers are kept as the bytes git gave, so a diff gets patched in
+    # exactly as it was, CRLFs and all.  what git prints can also depend on
+    # its version and diff.* settings, so those go into the key
+    # (GIT_QUERY_CACHE_DIR has to be cleared by hand for anything else, eg
+    # a change to the commits behind a sha, which git doesn't allow)
+
+    def __init__(self, sourcetree, cache_dir=None):
+        self.sourcetree = sourcetree
+        self.cache_dir = cache_dir or GIT_QUERY_CACHE_DIR
+        self.shas = {}
+        self.answers = {}
+        self._git_setup = None
+
+
+    def resolve(self, commit_spec):
+        if commit_spec not in self.shas:
+            self.shas[commit_spec] = self.sourcetree.run_command(
+                'git rev-parse --verify {}^{{commit}}'.format(commit_spec), silent=True,
+            ).strip()
+        return self.shas[commit_spec]
+
+
+    def get_git_setup(self):
+        if self._git_setup is None:
+            self._git_setup = self.sourcetree.run_command(
+                "git --version && git config --get-regexp '^diff\\.'",
+                silent=True, ignore_errors=True,
+            )
+        return self._git_setup
+
+
+    def _get_cache_path(self, command):
+        key = hashlib.sha1((self.get_git_setup() + command).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+
+    def query_bytes(self, command_template, commit_spec):
+        # command_template has a {} where the commit goes
+        command = command_template.format(self.resolve(commit_spec))
+        if command not in self.answers:
+            cache_path = self._get_cache_path(command)
+            try:
+                with open(cache_path, 'rb') as f:
+                    self.answers[command] = f.read()
+            except FileNotFoundError:
+                output = self.sourcetree.run_command_for_bytes(command)
+                if self.sourcetree.last_returncode:
+                    # "diff" commands don't raise, but mustn't get cached
+                    return output
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with open(cache_path + '.tmp', 'wb') as f:
+                    f.write(output)
+                os.replace(cache_path + '.tmp', cache_path)
+                self.answers[command] = output
+        return self.answers[command]
+
+
+    def query(self, command_template, commit_spec, silent=False):
+        # as text, the way run_command would have read it
+        output = self.query_bytes(command_template, commit_spec)
+        output = output.decode('utf8').replace('\r\n', '\n').replace('\r', '\n')
+        if not silent:
+            print(output)
+        return output
+
+
+
+class SpawnedProcess(object):
+    # a command started with SourceTree.spawn, whose output can be read a
+    # line at a time while it runs (async for line in process: ...)
+
+    def __init__(self, command, process, supervisor):
+        self.command = command
+        self.process = process
+        self.supervisor = supervisor
+        self.lines = []
+
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        line = await self.process.stdout.readline()
+        if not line:
+            raise StopAsyncIteration
+        line = line.decode('utf8', errors='replace')
+        self.lines.append(line)
+        return line
+
+
+    async def wait_for_line(self, text, timeout=None):
+        # eg for a dev server to say it's ready.  raises if the process
+        # finishes without saying it
+        async def find_line():
+            async for line in self:
+                if text in line:
+                    return line
+            raise Exception('{} finished without printing {!r}, output was:\n{}'.format(
+                self.command, text, ''.join(self.lines)
+            ))
+        return await asyncio.wait_for(find_line(), timeout)
+
+
+    async def wait(self):
+        async for _ in self:
+            pass
+        await self.process.wait()
+        return ''.join(self.lines)
+
+
+    async def stop(self):
+        # a spawned process needs stopping before its event loop closes,
+        # SourceTree.cleanup is only a backstop
+        await self.supervisor.stop_async(self.process)
+        await self.process.wait()
+
+
+
 class SourceTree(object):
 
-    def __init__(self):
+    def __init__(self, shell_session=False):
         self.tempdir = tempfile.mkdtemp()
-        self.processes = []
+        self.supervisor = ProcessSupervisor()
+        self.command_stats = CommandStats()
+        self.git_queries = GitQueryCache(self)
         self.dev_server_running = False
+        self.use_shell_session = shell_session
+        self.shell_session = None
+        self.last_returncode = None
+
+
+    @property
+    def processes(self):
+        return self.supervisor.processes
 
 
     def get_contents(self, path):
@@ -72,16 +494,17 @@ class SourceTree(object):
 
 
     def cleanup(self):
-        for process in self.processes:
-            try:
-                os.killpg(process.pid, signal.SIGTERM)
-            except OSError:
-                pass
+        self.supervisor.stop_all()
+        if self.shell_session is not None:
+            self.shell_session.close()
         if getpass.getuser() != 'harry':
             shutil.rmtree(self.tempdir)
 
 
-    def run_command(self, command, cwd=None, user_input=None, ignore_errors=False, silent=False):
+    def run_command(
+        self, command, cwd=None, user_input=None, ignore_errors=False, silent=False,
+        output_check=None,
+    ):
         if cwd is None:
             cwd = os.path.join(self.tempdir, 'superlists')
 
@@ -91,33 +514,46 @@ class SourceTree(object):
                 os.path.join(cwd, 'bootstrap.zip')
             )
             return
-        actual_command = command
-        if command.startswith('fab deploy'):
-            actual_command = 'cd deploy_tools && ' + command
-        process = subprocess.Popen(
-            actual_command, shell=True, cwd=cwd, executable='/bin/bash',
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            stdin=subprocess.PIPE,
-            preexec_fn=os.setsid,
-            universal_newlines=True,
-        )
-        process._command = command
-        self.processes.append(process)
-        if 'runserver' in command:
-            # can't read output, stdout.read just hangs.
-            return
+        actual_command = self._get_actual_command(command)
+        stats = self.command_stats.start(command)
+        in_shell_session = self._can_use_shell_session(command, user_input, output_check)
+        if in_shell_session:
+            output, returncode = self._run_in_shell_session(actual_command, cwd)
+        else:
+            if 'runserver' in command:
+                # can't read output, stdout.read just hangs.
+                self.supervisor.start(command, actual_command, cwd, background=True)
+                self.command_stats.finish(stats, None, None, waited_for=False)
+                return
+            process = self.supervisor.start(
+                command, actual_command, cwd, timeout=get_timeout(command),
+            )
 
-        if user_input and not user_input.endswith('\n'):
-            user_input += '\n'
-        if user_input:
-            print('sending user input: {}'.format(user_input))
-        output, _ = process.communicate(user_input)
-        if process.returncode and not ignore_errors:
-            if 'test' in command or 'diff' in command or 'migrate' in command:
-                return output
-            print('process %s return a non-zero code (%s)' % (command, process.returncode))
-            print('output:\n', output)
-            raise Exception('process %s return a non-zero code (%s)' % (command, process.returncode))
+            if user_input and not user_input.endswith('\n'):
+                user_input += '\n'
+            if user_input:
+                print('sending user input: {}'.format(user_input))
+            if output_check is None:
+                output, _ = process.communicate(user_input)
+                self.supervisor.done(process)
+            else:
+                output = self._read_output_while_checking(process, user_input, output_check)
+                self.supervisor.done(process)
+                if output_check.mismatched_line is not None:
+                    self.last_returncode = process.returncode
+                    self.command_stats.finish(stats, process.returncode, output)
+                    print('stopped {} early, output can no longer match at:\n{}'.format(
+                        command, output_check.mismatched_line
+                    ))
+                    return output
+            returncode = process.returncode
+            if process._timed_out:
+                output += timed_out_note(command)
+        self.last_returncode = returncode
+        self.command_stats.finish(stats, returncode, output, waited_for=not in_shell_session)
+        if returncode and not ignore_errors:
+            self._check_returncode(command, output, returncode)
+            return output
         if not silent:
             try:
                 print(output)
@@ -127,6 +563,125 @@ class SourceTree(object):
         return output
 
 
+    def run_command_for_bytes(self, command, cwd=None):
+        # for output that has to be kept byte for byte, like a diff that's
+        # going to be patched in.  no user input or output checks
+        if cwd is None:
+            cwd = os.path.join(self.tempdir, 'superlists')
+        stats = self.command_stats.start(command)
+        process = self.supervisor.start(
+            command, self._get_actual_command(command), cwd,
+            timeout=get_timeout(command), binary=True,
+        )
+        output, _ = process.communicate()
+        self.supervisor.done(process)
+        self.last_returncode = process.returncode
+        self.command_stats.finish(stats, process.returncode, output)
+        if process.returncode:
+            self._check_returncode(
+                command, output.decode('utf8', 'replace'), process.returncode
+            )
+        return output
+
+
+    def _get_actual_command(self, command):
+        if command.startswith('fab deploy'):
+            return 'cd deploy_tools && ' + command
+        return command
+
+
+    def _check_returncode(self, command, output, returncode):
+        if 'test' in command or 'diff' in command or 'migrate' in command:
+            return
+        print('process %s return a non-zero code (%s)' % (command, returncode))
+        print('output:\n', output)
+        raise Exception('process %s return a non-zero code (%s)' % (command, returncode))
+
+
+    async def spawn(self, command, cwd=None, timeout=None):
+        # starts a command and leaves it running, eg a dev server that can
+        # then be watched for when it's ready, or for errors
+        if cwd is None:
+            cwd = os.path.join(self.tempdir, 'superlists')
+        process = await asyncio.create_subprocess_shell(
+            self._get_actual_command(command), cwd=cwd, executable='/bin/bash',
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            stdin=subprocess.PIPE,
+            start_new_session=True,
+        )
+        process._command = command
+        self.supervisor.watch(process, timeout)
+        return SpawnedProcess(command, process, self.supervisor)
+
+
+    async def run(self, command, cwd=None, user_input=None, ignore_errors=False):
+        # run_command without blocking, so other checks can get on with it
+        # in the meantime
+        stats = self.command_stats.start(command)
+        spawned = await self.spawn(command, cwd=cwd, timeout=get_timeout(command))
+        if user_input:
+            if not user_input.endswith('\n'):
+                user_input += '\n'
+            spawned.process.stdin.write(user_input.encode('utf8'))
+            await spawned.process.stdin.drain()
+        spawned.process.stdin.close()
+        output = await spawned.wait()
+        self.supervisor.done(spawned.process)
+        if spawned.process._timed_out:
+            output += timed_out_note(command)
+        self.last_returncode = spawned.returncode
+        # runs can overlap, so the change in RUSAGE_CHILDREN isn't this
+        # one's alone
+        self.command_stats.finish(stats, spawned.returncode, output, waited_for=False)
+        if spawned.returncode and not ignore_errors:
+            self._check_returncode(command, output, spawned.returncode)
+        return output
+
+
+    def _can_use_shell_session(self, command, user_input, output_check):
+        # anything that runs in the background, or wants input, gets a shell
+        # of its own, and so do checked test runs, which can only be stopped
+        # early by killing their whole process group
+        return (
+            self.use_shell_session and
+            not user_input and
+            output_check is None and
+            'runserver' not in command and
+            not BACKGROUND_AMPERSAND.search(command)
+        )
+
+
+    def _run_in_shell_session(self, command, cwd):
+        if self.shell_session is None or not self.shell_session.alive:
+            self.shell_session = ShellSession(self.tempdir)
+        session_process = self.shell_session.process
+        # a command that hangs takes the session with it, and the next
+        # command gets a new one
+        session_process._command = command
+        self.supervisor.time_limit(session_process, get_timeout(command))
+        try:
+            output, returncode = self.shell_session.run(command, cwd)
+        finally:
+            self.supervisor.cancel_time_limit(session_process)
+        if session_process._timed_out:
+            output += timed_out_note(command)
+        return output, returncode
+
+
+    def _read_output_while_checking(self, process, user_input, output_check):
+        if user_input:
+            process.stdin.write(user_input)
+        process.stdin.close()
+        lines = []
+        for line in process.stdout:
+            lines.append(line)
+            if not output_check.feed(line):
+                self.supervisor.stop(process)
+                break
+        process.wait()
+        return ''.join(lines)
+
+
     def get_local_repo_path(self, chapter_name):
         return os.path.abspath(os.path.join(
             os.path.dirname(__file__),
@@ -145,6 +700,7 @@ class SourceTree(object):
         self.run_command('git reset --hard repo/{}'.format(previous_chapter))
         print(self.run_command('git status'))
         self.chapter = chapter
+        self.git_queries.shas = {}
 
 
     def get_commit_spec(self, commit_ref):
@@ -152,29 +708,34 @@ class SourceTree(object):
 
 
     def get_files_from_commit_spec(self, commit_spec):
-        return self.run_command(
-            'git diff-tree --no-commit-id --name-only --find-renames -r {}'.format(
-                commit_spec
-            )
+        return self.git_queries.query(
+            'git diff-tree --no-commit-id --name-only --find-renames -r {}', commit_spec,
         ).split()
 
 
     def show_future_version(self, commit_spec, path):
-        return self.run_command('git show {}:{}'.format(commit_spec, path), silent=True)
+        return self.git_queries.query(
+            'git show {}:' + path.replace('{', '{{').replace('}', '}}'), commit_spec, silent=True,
+        )
 
 
     def patch_from_commit(self, commit_ref, path=None):
         commit_spec = self.get_commit_spec(commit_ref)
+        #'git diff {commit}^ {commit} | patch'.format(commit=commit_spec)
+        diff = self.git_queries.query_bytes('git show -M {}', commit_spec)
+        patch_path = os.path.join(self.tempdir, 'commit.patch')
+        with open(patch_path, 'wb') as f:
+            f.write(diff)
         self.run_command(
-            #'git diff {commit}^ {commit} | patch'.format(commit=commit_spec)
-            'git show -M {commit} | patch -p1 --fuzz=3 --no-backup-if-mismatch'.format(commit=commit_spec)
+            'patch -p1 --fuzz=3 --no-backup-if-mismatch -i {}'.format(patch_path)
         )
+        os.remove(patch_path)
         #self.run_command('git reset')
 
 
     def apply_listing_from_commit(self, listing):
         commit_spec = self.get_commit_spec(listing.commit_ref)
-        commit_info = self.run_command('git show %s' % (commit_spec,))
+        commit_info = self.git_queries.query('git show {}', commit_spec)
         print('Applying listing from commit.\nListing:\n' + listing.contents)
 
         commit = Commit.from_diff(commit_info)
@@ -206,8 +767,7 @@ def check_listing_matches_commit(listing, commit, future_contents):
 
         return
 
-    listing_lines = listing.contents.split('\n')
-    listing_lines = [strip_comments(l) for l in listing_lines]
+    listing_lines = [strip_comments(l) for l in listing.lines]
 
     stripped_listing_lines = [l.strip() for l in listing_lines]
     for new_line in commit.new_lines:
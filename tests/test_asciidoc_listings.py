@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+import glob
+import os
+from textwrap import dedent
+import unittest
+
+from lxml import html
+
+from asciidoc_listings import load_listings_from_asciidoc, parse_listings_from_asciidoc
+from book_parser import CodeListing, assign_listing_ids, parse_listing, parse_listings_from_html
+import examples
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# a small chapter and its html, checked in so there's always something to
+# compare against.  the html is the asciidoctor output in examples.py, put
+# together: if a listing changes, rebuild it with asciidoctor
+EXAMPLE_CHAPTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_chapter')
+
+
+class ListingComparisonMixin(object):
+
+    def assert_same_listings(self, from_asciidoc, from_html):
+        self.assertEqual(
+            [type(l) for l in from_asciidoc],
+            [type(l) for l in from_html],
+        )
+        for ours, theirs in zip(from_asciidoc, from_html):
+            if isinstance(ours, CodeListing):
+                for attribute in CodeListing.__slots__:
+                    self.assertEqual(getattr(ours, attribute), getattr(theirs, attribute))
+            else:
+                self.assertEqual(str(ours), str(theirs))
+                self.assertEqual(vars(ours), vars(theirs))
+
+
+    def assert_matches_example(self, asciidoc, example_html):
+        self.assert_same_listings(
+            parse_listings_from_asciidoc(dedent(asciidoc)),
+            assign_listing_ids(parse_listing(html.fromstring(example_html))),
+        )
+
+
+
+class ParseListingsFromAsciidocTest(ListingComparisonMixin, unittest.TestCase):
+
+    def test_example_block_with_caption(self):
+        self.assert_matches_example(
+            """
+            Some text.
+
+            [role="sourcecode"]
+            .functional_tests.py
+            ====
+            [source,python]
+            ----
+            from selenium import webdriver
+
+            browser = webdriver.Firefox()
+            browser.get('http://localhost:8000')
+
+            assert 'Django' in browser.title
+            ----
+            ====
+            """,
+            examples.CODE_LISTING_WITH_CAPTION
+        )
+
+
+    def test_listing_block_with_skipme(self):
+        self.assert_matches_example(
+            """
+            [role="sourcecode skipme"]
+            .lists/functional_tests/test_list_item_validation.py
+            [source,python]
+            ----
+                def DONTtest_cannot_add_empty_list_items(self):
+            ----
+            """,
+            examples.CODE_LISTING_WITH_SKIPME
+        )
+
+
+    def test_server_command(self):
+        self.assert_matches_example(
+            """
+            [role="server-commands"]
+            [subs="specialcharacters,quotes"]
+            ----
+            elspeth@server:$ *sudo do stuff*
+            ----
+            """,
+            examples.SERVER_COMMAND
+        )
+
+
+    def test_commands_and_output(self):
+        self.assert_matches_example(
+            """
+            [subs="specialcharacters,quotes"]
+            ----
+            $ *source ../virtualenv/bin/activate*
+            (virtualenv)$ *python manage.py test lists*
+            [...]
+            ImportError: No module named django
+            ----
+            """,
+            examples.COMMANDS_WITH_VIRTUALENV
+        )
+
+
+    def test_dofirst_and_escaped_html(self):
+        self.assert_matches_example(
+            """
+            [role="dofirst-ch09l058"]
+            [subs="specialcharacters,quotes"]
+            ----
+            $ *grep -r id_new_item lists/*
+
+            lists/static/base.css:#id_new_item {
+            lists/templates/list.html:        <input name="item_text" id="id_new_item"
+            placeholder="Enter a to-do item" />
+            ----
+            """,
+            examples.OUTPUTS_WITH_DOFIRST
+        )
+
+
+    def test_qunit_output(self):
+        self.assert_matches_example(
+            """
+            [role="qunit-output"]
+            ----
+            2 assertions of 2 passed, 0 failed.
+            1. smoke test (2)
+            ----
+            """,
+            examples.OUTPUT_QUNIT
+        )
+
+
+    def test_user_input_inline_in_output(self):
+        self.assert_matches_example(
+            """
+            [subs="specialcharacters,macros"]
+            ----
+            $ pass:quotes[*python manage.py makemigrations*]
+            You are trying to add a non-nullable field 'list' to item without a default;
+            we can't do that (the database needs something to populate existing rows).
+            Please select a fix:
+             1) Provide a one-off default now (will be set on all existing rows)
+             2) Quit, and let me add a default in models.py
+            Select an option: pass:quotes[*1*]
+            Please enter the default value now, as valid Python
+            The datetime module is available, so you can do e.g. datetime.date.today()
+            >>> pass:quotes[*''*]
+            Migrations for 'lists':
+              0003_item_list.py:
+                - Add field list to item
+            ----
+            """,
+            examples.OUTPUT_WITH_COMMANDS_INLINE
+        )
+
+
+    def test_callouts(self):
+        self.assert_matches_example(
+            """
+            [subs="specialcharacters,macros,callouts"]
+            ----
+            $ pass:quotes[*python manage.py test functional_tests.test_list_item_validation*]
+            Creating test database for alias 'default'...
+            E
+            ======================================================================
+            ERROR: test_cannot_add_empty_list_items
+            (functional_tests.test_list_item_validation.ItemValidationTest)
+             ---------------------------------------------------------------------
+            Traceback (most recent call last):
+              File "/.../superlists/functional_tests/test_list_item_validation.py", line
+            15, in test_cannot_add_empty_list_items
+                self.wait_for(lambda: self.assertEqual(  <1>
+              File "/.../superlists/functional_tests/base.py", line 37, in wait_for
+                raise e  <2>
+              File "/.../superlists/functional_tests/base.py", line 34, in wait_for
+                return fn()  <2>
+              File "/.../superlists/functional_tests/test_list_item_validation.py", line
+            16, in <lambda>  <3>
+                self.browser.find_element_by_css_selector('.has-error').text,  <3>
+            [...]
+            selenium.common.exceptions.NoSuchElementException: Message: Unable to locate
+            element: .has-error
+
+
+             ---------------------------------------------------------------------
+            Ran 1 test in 10.575s
+
+            FAILED (errors=1)
+            ----
+            """,
+            examples.OUTPUT_WITH_CALLOUTS
+        )
+
+
+    def test_ignores_listings_in_comments_tables_and_passthroughs(self):
+        listings = parse_listings_from_asciidoc(dedent(
+            """
+            ////
+            ----
+            $ *commented out*
+            ----
+            ////
+
+            // ----
+
+            |===
+            |a table
+            |===
+
+            ++++
+            <pre>raw html</pre>
+            ++++
+
+            [subs="specialcharacters,quotes"]
+            ----
+            $ *real command*
+            ----
+            """
+        ))
+        self.assertEqual(listings, ['real command'])
+
+
+    def test_section_underlines_are_not_listing_delimiters(self):
+        listings = parse_listings_from_asciidoc(dedent(
+            """
+            A Section
+            ---------
+
+            ----
+            some output
+            ----
+            """
+        ))
+        self.assertEqual(listings, ['some output'])
+
+
+    def test_nested_sourcecode_example_is_one_listing(self):
+        listings = parse_listings_from_asciidoc(dedent(
+            """
+            [role="sourcecode"]
+            .lists/views.py (ch07l009)
+            ======
+            [source,python]
+            ----
+            def home_page(request):
+                pass
+            ----
+
+            ====
+            [source,python]
+            ----
+            def another():
+                pass
+            ----
+            ====
+            ======
+            """
+        ))
+        self.assertEqual(len(listings), 1)
+        self.assertEqual(listings[0].commit_ref, 'ch07l009')
+
+
+    def test_quotes_and_passthroughs_in_macros_subs(self):
+        [output] = parse_listings_from_asciidoc(dedent(
+            """
+            [subs="macros,quotes"]
+            ----
+            see `*not bold*` and pass:[*raw*] ((index term)) (((hidden)))done
+            ----
+            """
+        ))
+        self.assertEqual(output, 'see *not bold* and *raw* index term done')
+
+
+
+class AllChaptersTest(ListingComparisonMixin, unittest.TestCase):
+
+    def test_matches_listings_parsed_from_example_chapter_html(self):
+        with open(EXAMPLE_CHAPTER + '.html', encoding='utf-8') as f:
+            from_html = parse_listings_from_html(f.read())
+        from_asciidoc = load_listings_from_asciidoc(EXAMPLE_CHAPTER + '.asciidoc')
+        self.assertEqual(len(from_html), 17)
+        self.assert_same_listings(from_asciidoc, from_html)
+        self.assertEqual(
+            [l.listing_id for l in from_asciidoc], [l.listing_id for l in from_html]
+        )
+
+
+    def test_matches_listings_parsed_from_built_html(self):
+        html_paths = sorted(
+            glob.glob(os.path.join(BASE_DIR, 'chapter_*.html')) +
+            glob.glob(os.path.join(BASE_DIR, 'appendix_*.html'))
+        )
+        if not html_paths:
+            self.skipTest('no chapter html built, run make build')
+        for html_path in html_paths:
+            with open(html_path, encoding='utf-8') as f:
+                from_html = parse_listings_from_html(f.read())
+            from_asciidoc = load_listings_from_asciidoc(
+                html_path.replace('.html', '.asciidoc')
+            )
+            with self.subTest(chapter=os.path.basename(html_path)):
+                self.assert_same_listings(from_asciidoc, from_html)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
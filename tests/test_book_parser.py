@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 from lxml import html
+import os
 import re
+import tempfile
 from textwrap import dedent
 import unittest
+from unittest.mock import patch
 
+import book_parser
 from book_parser import (
     COMMIT_REF_FINDER,
     CodeListing,
     Command,
     Output,
+    assign_listing_ids,
     get_commands,
+    get_listing_nodes,
+    iter_book_listings,
     parse_listing,
+    parse_listings_from_html,
+    parse_listings_incrementally,
     _strip_callouts,
 )
 import examples
@@ -33,6 +42,51 @@ class CodeListingTest(unittest.TestCase):
         assert c.is_server_listing is True
 
 
+    def test_commit_ref_wins_over_server_prefix(self):
+        c = CodeListing(filename='server: a.py (ch09l027-2)', contents='foo')
+        assert c.filename == 'server: a.py'
+        assert c.commit_ref == 'ch09l027-2'
+        assert c.is_server_listing is False
+
+
+    def test_has_no_instance_dict(self):
+        c = CodeListing(filename='a.py', contents='foo')
+        with self.assertRaises(AttributeError):
+            c.some_new_attribute = 1
+
+
+    def test_lines_and_type_follow_contents(self):
+        c = CodeListing(filename='a.py', contents='abc\ndef')
+        assert c.lines == ['abc', 'def']
+        assert c.type == 'code listing'
+        c.contents = '@@ -1,2 +1,2 @@\n-abc\n+abd'
+        assert c.lines[0] == '@@ -1,2 +1,2 @@'
+        assert c.is_diff()
+        assert c.type == 'diff'
+        c.commit_ref = 'ch01l001'
+        assert c.type == 'code listing with git ref'
+
+
+class ListingTypeTest(unittest.TestCase):
+
+    def test_command_types(self):
+        assert Command('git diff --staged').type == 'git diff'
+        assert Command('python manage.py test lists').type == 'test'
+        assert Command('python manage.py behave').type == 'bdd test'
+        assert Command('python manage.py makemigrations').type == 'interactive manage.py'
+        assert Command('ls -lh').type == 'other command'
+
+
+    def test_flags_override_content_type(self):
+        command = Command('git status')
+        command.server_command = True
+        assert command.type == 'server command'
+        output = Output(u'├── foo')
+        assert output.type == 'tree'
+        output.qunit_output = True
+        assert output.type == 'qunit output'
+
+
 class CommitRefFinderTest(unittest.TestCase):
 
     def test_base_finder(self):
@@ -443,3 +497,226 @@ class GetCommandsTest(unittest.TestCase):
             ]
         )
 
+
+
+class GetListingNodesTest(unittest.TestCase):
+
+    def _old_listing_nodes(self, parsed_html):
+        all_nodes = parsed_html.cssselect('.exampleblock.sourcecode, div:not(.sourcecode) div.listingblock')
+        return [
+            node for ix, node in enumerate(all_nodes)
+            if node not in list(all_nodes[ix - 1].iterdescendants())
+        ]
+
+
+    def test_finds_outermost_listings_in_document_order(self):
+        parsed_html = html.fromstring(
+            '<html><body><div id="content"><div class="sect1">{}<!-- a comment -->{}{}</div>'
+            '<div class="sidebarblock"><div class="content">{}</div></div></div></body></html>'.format(
+                examples.CODE_LISTING_WITH_CAPTION,
+                examples.COMMANDS_WITH_VIRTUALENV,
+                examples.CODE_LISTING_WITH_SKIPME,
+                examples.OUTPUT_QUNIT,
+            )
+        )
+        nodes = get_listing_nodes(parsed_html)
+        self.assertEqual(
+            [n.get('class') for n in nodes],
+            [
+                'exampleblock sourcecode',
+                'listingblock',
+                'listingblock sourcecode skipme',
+                'listingblock qunit-output',
+            ]
+        )
+        self.assertEqual(nodes, self._old_listing_nodes(parsed_html))
+
+
+    def test_ignores_listingblocks_without_a_plain_div_ancestor(self):
+        parsed_html = html.fromstring(
+            '<html><body>'
+            '<div class="listingblock"><div class="content"><pre>top level</pre></div></div>'
+            '<div class="sourcecode"><div class="listingblock"><pre>in sourcecode</pre></div></div>'
+            '<div><div class="listingblock"><pre>found</pre></div></div>'
+            '</body></html>'
+        )
+        nodes = get_listing_nodes(parsed_html)
+        self.assertEqual([n.text_content() for n in nodes], ['found'])
+        self.assertEqual(nodes, self._old_listing_nodes(parsed_html))
+
+
+
+class IterBookListingsTest(unittest.TestCase):
+
+    def setUp(self):
+        book_html = (
+            '<html><body><div id="header"><div id="toc"><ul><li>toc</li></ul></div></div>'
+            '<div id="content">'
+            '<div class="sect1"><h2 id="preface">Preface</h2>'
+            '<div class="sectionbody"><div class="paragraph"><p>no listings</p></div></div></div>'
+            '<h1 id="part1" class="sect0">Part 1</h1>'
+            '<div class="sect1"><h2 id="chapter_01">Chapter 1</h2>'
+            '<div class="sectionbody">{}</div></div>'
+            '<div class="sect1"><h2 id="chapter_02">Chapter 2</h2>'
+            '<div class="sectionbody"><div class="sect2"><h3>sub</h3>{}{}</div></div></div>'
+            '</div></body></html>'
+        ).format(
+            examples.CODE_LISTING_WITH_CAPTION,
+            examples.COMMANDS_WITH_VIRTUALENV,
+            examples.OUTPUT_QUNIT,
+        )
+        tf = tempfile.NamedTemporaryFile(suffix='.html', delete=False)
+        tf.write(book_html.encode('utf8'))
+        tf.close()
+        self.path = tf.name
+
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+    def test_yields_chapter_position_and_listing(self):
+        results = list(iter_book_listings(self.path))
+        self.assertEqual(
+            [(chapter_id, position, type(listing)) for chapter_id, position, listing in results],
+            [
+                ('chapter_01', 0, CodeListing),
+                ('chapter_02', 0, Command),
+                ('chapter_02', 1, Command),
+                ('chapter_02', 2, Output),
+                ('chapter_02', 3, Output),
+            ]
+        )
+        self.assertEqual(results[0][2].filename, 'functional_tests.py')
+        self.assertEqual(results[2][2], 'source ../virtualenv/bin/activate && python manage.py test lists')
+        self.assertEqual(results[4][2].type, 'qunit output')
+
+
+    def test_same_results_with_tiny_chunks(self):
+        self.assertEqual(
+            [(c, p, str(l)) for c, p, l in iter_book_listings(self.path, chunk_size=7)],
+            [(c, p, str(l)) for c, p, l in iter_book_listings(self.path)],
+        )
+
+
+def _chapter(*listings):
+    return '<html><body><div id="content">{}</div></body></html>'.format(
+        '\n'.join('<div class="paragraph"><p>text</p></div>' + l for l in listings)
+    )
+
+
+class AssignListingIdsTest(unittest.TestCase):
+
+    def _listings(self):
+        with_ref = CodeListing(filename='lists/views.py (ch07l005)', contents='foo')
+        return [
+            Command('git status'),
+            Output('On branch master'),
+            with_ref,
+            Command('git status'),
+            Command('python manage.py test'),
+            Command('git status'),
+        ]
+
+
+    def test_commit_ref_listings_use_their_ref(self):
+        listings = assign_listing_ids(self._listings())
+        self.assertEqual(listings[2].listing_id, 'ch07l005')
+
+
+    def test_other_listings_anchor_on_last_commit_ref(self):
+        listings = assign_listing_ids(self._listings())
+        assert listings[0].listing_id.startswith('start:command-')
+        assert listings[1].listing_id.startswith('start:output-')
+        assert listings[3].listing_id.startswith('ch07l005:command-')
+        self.assertEqual(listings[5].listing_id, listings[3].listing_id + '.2')
+        self.assertEqual(len(set(l.listing_id for l in listings)), 6)
+
+
+    def test_dofirst_is_an_anchor_too(self):
+        command = Command('ls')
+        command.dofirst = 'ch09l058'
+        [listing] = assign_listing_ids([command])
+        assert listing.listing_id.startswith('ch09l058:command-')
+
+
+    def test_inserting_a_listing_leaves_the_other_ids_alone(self):
+        before = [l.listing_id for l in assign_listing_ids(self._listings())]
+        edited = self._listings()
+        edited.insert(0, Command('git status'))
+        after = [l.listing_id for l in assign_listing_ids(edited)]
+        self.assertEqual(after[0], before[0])
+        self.assertEqual(after[1], before[0] + '.2')
+        self.assertEqual(after[2:], before[1:])
+
+
+    def test_parsed_listings_get_ids(self):
+        listings = parse_listings_from_html(_chapter(
+            examples.CODE_LISTING_WITH_CAPTION_AND_GIT_COMMIT_REF,
+            examples.COMMANDS_WITH_VIRTUALENV,
+        ))
+        self.assertEqual(listings[0].listing_id, 'ch06l001')
+        assert all(l.listing_id.startswith('ch06l001:') for l in listings[1:])
+
+
+class ParseListingsIncrementallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_html = _chapter(
+            examples.CODE_LISTING_WITH_CAPTION,  # 1 listing
+            examples.COMMANDS_WITH_VIRTUALENV,  # 3 listings
+            examples.OUTPUT_QUNIT,  # 1 listing
+        )
+        _, self.blocks, _ = parse_listings_incrementally(self.original_html)
+
+
+    def _reparse(self, new_html):
+        with patch('book_parser.parse_listing', wraps=book_parser.parse_listing) as mock_parse:
+            listings, blocks, changes = parse_listings_incrementally(new_html, self.blocks)
+        return listings, changes, mock_parse.call_count
+
+
+    def test_first_parse_is_all_inserts_and_matches_normal_parse(self):
+        listings, blocks, changes = parse_listings_incrementally(self.original_html)
+        expected = parse_listings_from_html(self.original_html)
+        self.assertEqual([repr(l) for l in listings], [repr(l) for l in expected])
+        self.assertEqual(len(blocks), 3)
+        self.assertEqual(changes, ([0, 1, 2, 3, 4], [], []))
+
+
+    def test_unchanged_chapter_parses_nothing(self):
+        listings, changes, parse_calls = self._reparse(self.original_html)
+        self.assertEqual(parse_calls, 0)
+        self.assertEqual(changes, ([], [], []))
+        self.assertEqual(len(listings), 5)
+
+
+    def test_edited_block_is_only_one_reparsed(self):
+        new_html = self.original_html.replace('smoke test', 'smoke test 2')
+        listings, changes, parse_calls = self._reparse(new_html)
+        self.assertEqual(parse_calls, 1)
+        self.assertEqual(changes, ([], [], [4]))
+        self.assertIn('smoke test 2', listings[4])
+
+
+    def test_inserted_and_removed_blocks(self):
+        new_html = _chapter(
+            examples.SERVER_COMMAND,
+            examples.CODE_LISTING_WITH_CAPTION,
+            examples.OUTPUT_QUNIT,
+        )
+        listings, changes, parse_calls = self._reparse(new_html)
+        self.assertEqual(parse_calls, 1)
+        self.assertEqual(changes.inserted, [0])
+        self.assertEqual(changes.removed, [1, 2, 3])
+        self.assertEqual(changes.modified, [])
+        self.assertEqual(listings[0].type, 'server command')
+
+
+    def test_returned_listings_are_not_shared(self):
+        new_html = _chapter(examples.OUTPUT_QUNIT, examples.OUTPUT_QUNIT)
+        listings, _, _ = self._reparse(new_html)
+        listings[0].was_checked = True
+        assert not listings[1].was_checked
+        listings, _, _ = self._reparse(new_html)
+        assert not listings[0].was_checked
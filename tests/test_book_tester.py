@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import itertools
 import os
 import unittest
 from unittest.mock import Mock
@@ -8,6 +9,7 @@ from book_tester import (
     ChapterTest,
     PHANTOMJS_RUNNER,
     contains,
+    find_subsequence,
     wrap_long_lines,
     split_blocks,
 
@@ -15,11 +17,22 @@ from book_tester import (
 from book_parser import (
     Command,
     Output,
+    assign_listing_ids,
 )
 from test_write_to_file import *  # noqa
 from test_book_parser import *  # noqa
 from test_source_updater import *  # noqa
 from test_sourcetree import *  # noqa
+from test_listing_cache import *  # noqa
+from test_asciidoc_listings import *  # noqa
+from test_command_stats import *  # noqa
+from test_listing_index import *  # noqa
+from test_html_selectors import *  # noqa
+from test_listing_store import *  # noqa
+from test_mismatch_report import *  # noqa
+from test_normalizers import *  # noqa
+from test_output_matcher import *  # noqa
+from test_output_recorder import *  # noqa
 
 
 
@@ -123,11 +136,22 @@ class RunCommandTest(ChapterTest):
         output = self.run_command(cmd, cwd='bar', user_input='thing')
         assert output == self.sourcetree.run_command.return_value
         self.sourcetree.run_command.assert_called_with(
-            'foo', cwd='bar', user_input='thing', ignore_errors=False,
+            'foo', cwd='bar', user_input='thing', ignore_errors=False, output_check=None,
         )
         assert cmd.was_run
 
 
+    def test_checks_output_as_it_streams_if_it_has_to_match_exactly(self):
+        self.sourcetree.run_command = Mock()
+        self.run_command(Command('foo'), expected_output=Output('1\n2\n3\n4\n5'))
+        output_check = self.sourcetree.run_command.call_args[1]['output_check']
+        self.assertTrue(output_check.feed('1\n'))
+        self.assertFalse(output_check.feed('3\n'))
+
+        self.run_command(Command('foo'), expected_output=Output('1\n[...]\n5'))
+        self.assertIsNone(self.sourcetree.run_command.call_args[1]['output_check'])
+
+
     def test_raises_if_not_command(self):
         with self.assertRaises(AssertionError):
             self.run_command('foo')
@@ -235,6 +259,32 @@ class GetListingsTest(ChapterTest):
 
 
 
+class ListingIdTest(ChapterTest):
+
+    def setUp(self):
+        super().setUp()
+        self.listings = assign_listing_ids([
+            Command('git status'),
+            Output('On branch master'),
+            Command('git status'),
+            Output('nothing to commit'),
+        ])
+
+
+    def test_position_of(self):
+        self.assertEqual(self.position_of(self.listings[2].listing_id), 2)
+        with self.assertRaises(Exception):
+            self.position_of('ch99l999')
+
+
+    def test_skip_with_check_by_listing_id(self):
+        self.skip_with_check(self.listings[3].listing_id, 'nothing to')
+        assert self.listings[3].skip
+        with self.assertRaises(Exception):
+            self.skip_with_check(self.listings[1].listing_id, 'nothing to')
+
+
+
 class AssertConsoleOutputCorrectTest(ChapterTest):
 
     def test_simple_case(self):
@@ -999,6 +1049,36 @@ class TestContains(unittest.TestCase):
     def testcontains_iteslf(self):
         assert contains([1, 2, 3], [1, 2, 3])
 
+    def testcontains_after_partial_matches(self):
+        assert contains([1, 1, 2, 1, 1, 1, 2, 3], [1, 1, 2, 3])
+        assert not contains([1, 1, 2, 1, 1, 1, 2], [1, 1, 2, 3])
+
+    def testcontains_empty_seq(self):
+        assert contains([], [])
+        assert contains([1], [])
+        assert not contains([], [1])
+
+
+
+class FindSubsequenceTest(unittest.TestCase):
+
+    def test_returns_position_of_first_match(self):
+        self.assertEqual(find_subsequence(['a', 'b', 'a', 'b', 'c'], ['a', 'b', 'c']), 2)
+        self.assertEqual(find_subsequence(['a', 'b', 'a', 'b'], ['a', 'b']), 0)
+        self.assertEqual(find_subsequence(['a', 'b'], ['b', 'a']), -1)
+
+
+    def test_agrees_with_slice_comparison(self):
+        for length in range(7):
+            for inseq in itertools.product('ab', repeat=length):
+                for sublength in range(1, 4):
+                    for subseq in itertools.product('ab', repeat=sublength):
+                        expected = next((
+                            pos for pos in range(len(inseq) - sublength + 1)
+                            if inseq[pos:pos + sublength] == subseq
+                        ), -1)
+                        self.assertEqual(find_subsequence(inseq, subseq), expected)
+
 
 
 
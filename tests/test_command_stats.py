@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from book_parser import Command
+from book_tester import ChapterTest
+from command_stats import CommandStats, get_kind
+from sourcetree import SourceTree
+
+
+class GetKindTest(unittest.TestCase):
+
+    def test_kinds(self):
+        self.assertEqual(get_kind('python manage.py test lists'), 'django tests')
+        self.assertEqual(get_kind('python functional_tests.py'), 'functional tests')
+        self.assertEqual(get_kind('../virtualenv/bin/pip install -r requirements.txt'), 'pip')
+        self.assertEqual(get_kind('git diff --staged'), 'git')
+        self.assertEqual(get_kind('patch -p1'), 'patch')
+
+
+
+class CommandStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sourcetree = SourceTree()
+
+
+    def tearDown(self):
+        self.sourcetree.cleanup()
+
+
+    def test_records_every_command(self):
+        self.sourcetree.run_command(
+            'python3 -c "sum(range(10 ** 7))"; echo done', cwd=self.sourcetree.tempdir,
+        )
+        self.sourcetree.run_command('exit 3', cwd=self.sourcetree.tempdir, ignore_errors=True)
+        first, second = self.sourcetree.command_stats.records
+        self.assertEqual(first['kind'], 'python3')
+        self.assertEqual((first['exit_code'], first['output_bytes']), (0, 5))
+        self.assertGreater(first['cpu_seconds'], 0)
+        self.assertGreaterEqual(first['seconds'], first['cpu_seconds'] * 0.5)
+        self.assertGreater(first['children_max_rss_kb'], 0)
+        self.assertEqual((second['exit_code'], second['output_bytes']), (3, 0))
+
+
+    def test_cpu_is_unknown_for_shell_session_and_background_commands(self):
+        sourcetree = SourceTree(shell_session=True)
+        self.addCleanup(sourcetree.cleanup)
+        sourcetree.run_command('echo hi', cwd=sourcetree.tempdir)
+        sourcetree.run_command('sleep 30 #runserver', cwd=sourcetree.tempdir)
+        session, server = sourcetree.command_stats.records
+        self.assertEqual((session['exit_code'], session['output_bytes']), (0, 3))
+        self.assertIsNone(session['cpu_seconds'])
+        self.assertIsNone(session['children_max_rss_kb'])
+        self.assertIsNone(server['cpu_seconds'])
+        self.assertEqual(sourcetree.command_stats.format_report().split('\n')[1].split()[1], 'n/a')
+
+
+    def test_failed_commands_are_recorded_too(self):
+        with self.assertRaises(Exception):
+            self.sourcetree.run_command('false', cwd=self.sourcetree.tempdir)
+        self.assertEqual(self.sourcetree.command_stats.records[0]['exit_code'], 1)
+
+
+    def test_report(self):
+        stats = CommandStats()
+        for command, seconds in [('git status', 0.5), ('python manage.py test', 3), ('git diff', 1)]:
+            record = stats.start(command)
+            stats.finish(record, 0, 'output')
+            record['seconds'] = seconds
+        stats.start('still running')
+
+        report = stats.format_report(top=2).split('\n')
+        self.assertEqual(report[1].split()[-4:], ['0', 'python', 'manage.py', 'test'])
+        self.assertEqual(report[2].split()[-3:], ['0', 'git', 'diff'])
+        self.assertEqual(report[3], '')
+        self.assertEqual([l.split()[-1] for l in report[5:]], ['tests', 'git'])
+        self.assertEqual(report[6].split()[0], '1.50')
+
+        stats_dir = tempfile.mkdtemp()
+        try:
+            json_path, csv_path = stats.write_report('chapter_x', stats_dir)
+            with open(json_path) as f:
+                self.assertEqual(len(json.load(f)), 3)
+            with open(csv_path) as f:
+                self.assertEqual([r['command'] for r in csv.DictReader(f)][0], 'git status')
+        finally:
+            shutil.rmtree(stats_dir)
+
+
+
+class ChapterCommandStatsTest(ChapterTest):
+    chapter_name = 'chapter_x'
+
+    def use_temporary_stats_dir(self):
+        self.stats_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.stats_dir)
+
+
+    def test_tags_commands_with_listing_and_writes_report(self):
+        self.use_temporary_stats_dir()
+        self.pos = 7
+        self.run_command(Command('python manage.py test lists'), cwd=self.tempdir)
+        [record] = self.sourcetree.command_stats.records
+        self.assertEqual((record['pos'], record['listing_type']), (7, 'test'))
+        with patch.dict(os.environ, {'WRITE_STATS': '1'}):
+            self.tearDown()
+            self.setUp()
+        self.assertTrue(os.path.exists(os.path.join(self.stats_dir, 'chapter_x.csv')))
+
+
+    def test_writes_nothing_unless_asked(self):
+        self.use_temporary_stats_dir()
+        self.run_command(Command('true'), cwd=self.tempdir)
+        with patch.dict(os.environ):
+            os.environ.pop('WRITE_STATS', None)
+            self.tearDown()
+            self.setUp()
+        self.assertEqual(os.listdir(self.stats_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import unittest
+
+from lxml import html
+
+import examples
+import html_selectors
+
+
+PAGE = """<html><head><title>t</title></head><body id="chapter_foo">
+<div id="header"><h1>The Book</h1></div>
+<div id="toc"><a href="#chapter_foo">Chapter Foo</a></div>
+<div id="content">
+<h2 id="_chapter_foo">Chapter Foo</h2>
+<h3 id="some_section">A section</h3>
+<p>see <a href="#some_section">here</a> and <a href="http://example.com">there</a></p>
+{}
+</div></body></html>""".format('\n'.join([
+    examples.CODE_LISTING_WITH_CAPTION,
+    examples.SERVER_COMMAND,
+    examples.COMMANDS_WITH_VIRTUALENV,
+    examples.OUTPUTS_WITH_DOFIRST,
+]))
+
+
+class HtmlSelectorsTest(unittest.TestCase):
+
+    def test_selectors_match_cssselect(self):
+        root = html.fromstring(PAGE)
+        selectors = [
+            ('.title', html_selectors.TITLE),
+            ('.content', html_selectors.CONTENT),
+            ('div.content', html_selectors.DIV_CONTENT),
+            ('pre strong', html_selectors.PRE_STRONG),
+            ('pre code strong', html_selectors.PRE_CODE_STRONG),
+            ('a', html_selectors.LINKS),
+            (r'a[href^=\#]', html_selectors.INTERNAL_LINKS),
+            ('*[id]', html_selectors.ELEMENTS_WITH_ID),
+            ('h1', html_selectors.H1),
+            ('h2', html_selectors.H2),
+            ('h3', html_selectors.H3),
+            ('head', html_selectors.HEAD),
+            ('body', html_selectors.BODY),
+            ('#header', html_selectors.HEADER),
+            ('#toc', html_selectors.TOC),
+        ]
+        for css, selector in selectors:
+            expected = root.cssselect(css)
+            assert expected, css
+            self.assertEqual(selector(root), expected, css)
+
+
+    def test_internal_links(self):
+        root = html.fromstring(PAGE)
+        self.assertEqual(
+            [a.get('href') for a in html_selectors.INTERNAL_LINKS(root)],
+            ['#chapter_foo', '#some_section']
+        )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
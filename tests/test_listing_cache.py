@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import book_parser
+from book_parser import CodeListing, Command, Output
+from examples import CHAPTER_HTML
+from listing_cache import get_cache_path, load_listings
+
+
+class LoadListingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        self.html_path = os.path.join(self.tempdir, 'chapter_foo.html')
+        self._write_html(CHAPTER_HTML)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def _write_html(self, contents):
+        with open(self.html_path, 'w', encoding='utf-8') as f:
+            f.write(contents)
+
+
+    def test_cached_listings_keep_types_and_flags(self):
+        fresh = load_listings(self.html_path, cache_dir=self.cache_dir)
+        cached = load_listings(self.html_path, cache_dir=self.cache_dir)
+
+        self.assertEqual(
+            [type(l) for l in cached],
+            [CodeListing, CodeListing, CodeListing, Command, Output, Command, Output]
+        )
+        self.assertEqual([l.type for l in cached], [l.type for l in fresh])
+        git_ref, skipped, currentcontents, dofirst, _, server, qunit = cached
+        assert git_ref.commit_ref == 'ch06l001'
+        assert git_ref.contents == fresh[0].contents
+        assert skipped.skip is True
+        assert currentcontents.currentcontents is True
+        assert dofirst.dofirst == 'ch09l058'
+        assert dofirst == 'grep -r id_new_item lists/'
+        assert server.server_command is True
+        assert qunit.qunit_output is True
+        assert not any(getattr(l, 'was_run', False) for l in cached)
+
+
+    def test_second_load_does_not_parse_html(self):
+        load_listings(self.html_path, cache_dir=self.cache_dir)
+        with patch('listing_cache.parse_listings_incrementally') as mock_parse:
+            listings = load_listings(self.html_path, cache_dir=self.cache_dir)
+        assert not mock_parse.called
+        assert len(listings) == 7
+
+
+    def test_reparses_and_clears_stale_entry_when_html_changes(self):
+        load_listings(self.html_path, cache_dir=self.cache_dir)
+        self._write_html(CHAPTER_HTML.replace('sudo do stuff', 'sudo do other stuff'))
+
+        listings = load_listings(self.html_path, cache_dir=self.cache_dir)
+
+        assert listings[5] == 'sudo do other stuff'
+        assert len(os.listdir(self.cache_dir)) == 1
+
+
+    def test_changed_chapter_only_reparses_changed_blocks(self):
+        load_listings(self.html_path, cache_dir=self.cache_dir)
+        self._write_html(CHAPTER_HTML.replace('sudo do stuff', 'sudo do other stuff'))
+
+        with patch('book_parser.parse_listing', wraps=book_parser.parse_listing) as mock_parse:
+            listings = load_listings(self.html_path, cache_dir=self.cache_dir)
+
+        assert mock_parse.call_count == 1
+        assert listings[5] == 'sudo do other stuff'
+        assert listings[5].server_command is True
+
+
+    def test_cache_key_includes_parser_version(self):
+        raw_html = CHAPTER_HTML.encode('utf8')
+        path1 = get_cache_path(self.html_path, raw_html, self.cache_dir)
+        with patch('listing_cache.BOOK_PARSER_VERSION', 999):
+            path2 = get_cache_path(self.html_path, raw_html, self.cache_dir)
+        assert path1 != path2
+        assert 'v999' in path2
+
+
+    def test_ignores_corrupt_cache_file(self):
+        raw_html = CHAPTER_HTML.encode('utf8')
+        os.makedirs(self.cache_dir)
+        with open(get_cache_path(self.html_path, raw_html, self.cache_dir), 'wb') as f:
+            f.write(b'not a pickle')
+        listings = load_listings(self.html_path, cache_dir=self.cache_dir)
+        assert len(listings) == 7
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import tempfile
+from textwrap import dedent
+import unittest
+
+import examples
+from listing_index import (
+    build_index,
+    find_commit_ref,
+    find_filename,
+    get_chapters,
+    load_index,
+)
+
+
+class ListingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tempdir, 'index.jsonl')
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        with open(os.path.join(self.tempdir, 'atlas.json'), 'w') as f:
+            json.dump({'files': [
+                'cover.html', 'chapter_one.asciidoc', 'chapter_two.asciidoc',
+            ]}, f)
+        with open(os.path.join(self.tempdir, 'chapter_one.html'), 'w') as f:
+            f.write('<html><body><div id="content">{}{}</div></body></html>'.format(
+                examples.CODE_LISTING_WITH_CAPTION_AND_GIT_COMMIT_REF,
+                examples.OUTPUTS_WITH_DOFIRST,
+            ))
+        with open(os.path.join(self.tempdir, 'chapter_two.asciidoc'), 'w') as f:
+            f.write(dedent(
+                """
+                [role="sourcecode"]
+                .lists/views.py, lists/urls.py
+                ====
+                [source,python]
+                ----
+                def home_page(request):
+                    pass
+                ----
+                ====
+                """
+            ))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_get_chapters_reads_asciidoc_files_from_atlas(self):
+        self.assertEqual(
+            get_chapters(os.path.join(self.tempdir, 'atlas.json')),
+            ['chapter_one', 'chapter_two']
+        )
+
+
+    def test_builds_index_in_atlas_order(self):
+        entries = build_index(self.index_path, base_dir=self.tempdir, cache_dir=self.cache_dir, processes=2)
+        self.assertEqual(load_index(self.index_path), entries)
+        self.assertEqual(
+            [(e['chapter'], e['position'], e['type']) for e in entries],
+            [
+                ('chapter_one', 0, 'code listing with git ref'),
+                ('chapter_one', 1, 'other command'),
+                ('chapter_one', 2, 'output'),
+                ('chapter_two', 0, 'code listing'),
+            ]
+        )
+        assert entries[0]['filename'] == 'functional_tests/tests.py'
+        assert entries[1]['dofirst'] == 'ch09l058'
+        assert len(set(e['sha1'] for e in entries)) == 4
+
+
+    def test_queries(self):
+        entries = build_index(self.index_path, base_dir=self.tempdir, cache_dir=self.cache_dir, processes=1)
+        [by_ref] = find_commit_ref(entries, 'ch06l001')
+        assert by_ref['chapter'] == 'chapter_one'
+        [by_dofirst] = find_commit_ref(entries, 'ch09l058')
+        assert by_dofirst['position'] == 1
+        [by_file] = find_filename(entries, 'lists/urls.py')
+        assert by_file['chapter'] == 'chapter_two'
+        assert find_filename(entries, 'lists/models.py') == []
+
+
+
+if __name__ == '__main__':
+    unittest.main()
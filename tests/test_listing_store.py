@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from book_parser import CodeListing, Command, Output, parse_listings_from_html
+from examples import CHAPTER_HTML
+from listing_index import get_source_sha
+from listing_store import (
+    ChapterNotInStoreException,
+    ListingStore,
+    StaleListingStoreException,
+    write_store,
+)
+
+
+class ListingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'listings.store')
+        self.listings = parse_listings_from_html(CHAPTER_HTML)
+        for chapter in ['chapter_one', 'chapter_two', 'chapter_empty']:
+            with open(os.path.join(self.tempdir, chapter + '.html'), 'w') as f:
+                f.write(CHAPTER_HTML)
+        write_store(self.path, [
+            ('chapter_one', self.sha('chapter_one'), self.listings),
+            ('chapter_two', self.sha('chapter_two'), self.listings[:2]),
+            ('chapter_empty', self.sha('chapter_empty'), []),
+        ])
+
+
+    def sha(self, chapter):
+        return get_source_sha(chapter, self.tempdir)
+
+
+    def open_store(self):
+        return ListingStore(self.path, base_dir=self.tempdir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_round_trips_listings(self):
+        with self.open_store() as store:
+            self.assertEqual(store.chapters(), ['chapter_one', 'chapter_two', 'chapter_empty'])
+            loaded = store.load_listings('chapter_one')
+            self.assertEqual(store.load_listings('chapter_empty'), [])
+
+        self.assertEqual([type(l) for l in loaded], [type(l) for l in self.listings])
+        for original, copy in zip(self.listings, loaded):
+            self.assertEqual(copy.type, original.type)
+            self.assertEqual(copy.skip, original.skip)
+            self.assertEqual(copy.dofirst, original.dofirst)
+            if isinstance(original, CodeListing):
+                for attribute in CodeListing.__slots__:
+                    self.assertEqual(getattr(copy, attribute), getattr(original, attribute))
+            else:
+                self.assertEqual(vars(copy), vars(original))
+                self.assertEqual(str(copy), str(original))
+
+
+    def test_views_decode_lazily(self):
+        with self.open_store() as store:
+            views = store.views('chapter_two')
+            with patch.object(ListingStore, '_get_string') as mock_get_string:
+                self.assertEqual([v.kind for v in views], [0, 0])
+            assert not mock_get_string.called
+            self.assertEqual(views[0].commit_ref, 'ch06l001')
+            self.assertEqual(views[0].type, 'code listing with git ref')
+            self.assertEqual(views[1].filename, 'lists/functional_tests/test_list_item_validation.py')
+            self.assertIsNone(views[1].commit_ref)
+
+
+    def test_materialized_listings_are_independent(self):
+        with self.open_store() as store:
+            first = store.load_listings('chapter_one')
+            first[5].was_run = True
+            second = store.load_listings('chapter_one')
+        self.assertIsInstance(second[5], Command)
+        self.assertIsInstance(second[6], Output)
+        self.assertFalse(second[5].was_run)
+
+
+    def test_refuses_store_from_other_parser_version(self):
+        with patch('listing_store.BOOK_PARSER_VERSION', 999):
+            with self.assertRaises(StaleListingStoreException):
+                self.open_store()
+
+
+    def test_refuses_chapters_whose_source_has_changed(self):
+        with open(os.path.join(self.tempdir, 'chapter_two.html'), 'a') as f:
+            f.write('<p>a new paragraph</p>')
+        with self.open_store() as store:
+            self.assertEqual(store.source_sha('chapter_one'), self.sha('chapter_one'))
+            self.assertEqual(len(store.load_listings('chapter_one')), len(self.listings))
+            with self.assertRaises(StaleListingStoreException):
+                store.load_listings('chapter_two')
+
+
+    def test_refuses_chapters_it_doesnt_have(self):
+        with self.open_store() as store:
+            with self.assertRaises(ChapterNotInStoreException):
+                store.load_listings('chapter_three')
+            with self.assertRaises(StaleListingStoreException):
+                store.views('chapter_three')
+
+
+    def test_chapter_tests_parse_chapters_missing_from_the_store(self):
+        from book_tester import ChapterTest
+        test = ChapterTest()
+        test.chapter_name = 'chapter_three'
+        with patch.dict(os.environ, {'LISTING_STORE': self.path}):
+            with patch('listing_store.get_source_sha', return_value='some sha'):
+                with patch('book_tester.load_listings') as mock_load_listings:
+                    test.parse_listings()
+        self.assertEqual(test.listings, mock_load_listings.return_value)
+
+
+    def test_chapter_tests_parse_the_chapter_if_the_store_is_stale(self):
+        from book_tester import ChapterTest
+        test = ChapterTest()
+        test.chapter_name = 'chapter_two'
+        with patch.dict(os.environ, {'LISTING_STORE': self.path}):
+            with patch('listing_store.get_source_sha', return_value='some other sha'):
+                with patch('book_tester.load_listings') as mock_load_listings:
+                    test.parse_listings()
+        self.assertEqual(test.listings, mock_load_listings.return_value)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
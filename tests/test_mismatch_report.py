@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from book_parser import Output
+from book_tester import ChapterTest
+import mismatch_report
+from mismatch_report import (
+    clip,
+    close_matches,
+    first_difference,
+    is_small,
+    lines_around,
+    windowed_diff,
+)
+
+
+class WindowedDiffTest(unittest.TestCase):
+
+    def test_first_difference(self):
+        self.assertEqual(first_difference(['a', 'b', 'c'], ['a', 'x', 'c']), 1)
+        self.assertEqual(first_difference(['a', 'b'], ['a', 'b', 'c']), 2)
+
+
+    def test_only_diffs_around_first_difference(self):
+        expected = '\n'.join('line %d' % i for i in range(100000))
+        actual = expected.replace('line 50000\n', 'line 5OOOO\n')
+        line_number, diff = windowed_diff(actual, expected)
+        self.assertEqual(line_number, 50001)
+        self.assertIn('-line 50000', diff)
+        self.assertIn('+line 5OOOO', diff)
+        self.assertNotIn(' line 49000', diff)
+        self.assertLess(len(diff), 4 * mismatch_report.CONTEXT)
+
+
+    def test_clips_long_lines(self):
+        self.assertEqual(clip('x' * 10), 'x' * 10)
+        clipped = clip('x' * (mismatch_report.MAX_LINE_LENGTH + 3))
+        self.assertTrue(clipped.endswith('x [... 3 more chars]'))
+        self.assertFalse(is_small('x' * (mismatch_report.MAX_LINE_LENGTH + 1)))
+        self.assertFalse(is_small('x\n' * mismatch_report.MAX_LINES))
+        self.assertTrue(is_small('x\n' * 10))
+
+
+    def test_close_matches_stay_within_budget(self):
+        self.assertEqual(close_matches('OK', ['OK.', 'FAILED', 'OK!']), ['OK.', 'OK!'])
+        lines = ['x' * 100] * 10 + ['y' * 100 + str(i) for i in range(10000)] + ['OK!']
+        self.assertEqual(close_matches('OK', lines), [])
+        # but they look wherever they're told the line should have been
+        self.assertEqual(close_matches('OK', lines, near=len(lines)), ['OK!'])
+
+
+    def test_lines_around_work_outwards_and_skip_repeats(self):
+        lines = ['a', 'b', 'c', 'c', 'd', 'e']
+        self.assertEqual(lines_around(lines, 3), ['c', 'd', 'b', 'e', 'a'])
+        self.assertEqual(lines_around(lines, 3, budget=3), ['c', 'd', 'b'])
+        self.assertEqual(lines_around(lines, 100, budget=2), ['e', 'd'])
+
+
+
+class MismatchReportingTest(ChapterTest):
+
+    def setUp(self):
+        super().setUp()
+        self.mismatch_dir = tempfile.mkdtemp()
+        self.old_mismatch_dir = mismatch_report.MISMATCH_DIR
+        mismatch_report.MISMATCH_DIR = self.mismatch_dir
+        environment = patch.dict(os.environ, {'WRITE_MISMATCHES': '1'})
+        environment.start()
+        self.addCleanup(environment.stop)
+
+
+    def tearDown(self):
+        mismatch_report.MISMATCH_DIR = self.old_mismatch_dir
+        shutil.rmtree(self.mismatch_dir)
+        super().tearDown()
+
+
+    def test_long_mismatched_output_reports_window_and_writes_files(self):
+        expected = '\n'.join('line %d' % i for i in range(1000))
+        # all the lines are there, just not in the right order
+        actual = expected.replace('line 500\nline 501', 'line 501\nline 500')
+        self.pos = 3
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(actual, Output(expected))
+        message = str(cm.exception)
+        self.assertTrue(message.startswith('output differs from expected, first at line 501'))
+        self.assertNotIn('line 100\n', message)
+        actual_path = os.path.join(self.mismatch_dir, 'MismatchReportingTest.3.actual')
+        self.assertIn(actual_path, message)
+        with open(actual_path) as f:
+            self.assertEqual(f.read(), actual)
+
+
+    def test_short_mismatched_output_keeps_full_diff(self):
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct('a\nb\nc\ne\nd', Output('a\nb\nc\nd\ne'))
+        self.assertIn('  c\n- e\n- d+ d\n+ e', str(cm.exception))
+        self.assertIn('full outputs in:', str(cm.exception))
+
+
+    def test_missing_line_in_long_output_lists_closest_lines(self):
+        actual = '\n'.join(['Ran 1 test', 'FAILED (errors=1)'] + ['.'] * 1000)
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(actual, Output('FAILED (errors=2)'))
+        message = str(cm.exception).split('\n')
+        self.assertEqual(message[0], "'FAILED (errors=2)' not found in 1002 lines. closest were:")
+        self.assertEqual(message[1], "'FAILED (errors=1)'")
+        self.assertLess(len(message), 10)
+        actual_path = os.path.join(self.mismatch_dir, 'MismatchReportingTest.0.actual')
+        self.assertEqual(message[-1], '  ' + actual_path)
+        # the whole of both outputs, not just the line and where it was looked for
+        with open(actual_path) as f:
+            self.assertEqual(f.read(), actual)
+        with open(actual_path.replace('.actual', '.expected')) as f:
+            self.assertEqual(f.read(), 'FAILED (errors=2)')
+
+
+    def test_missing_line_late_in_huge_output_gets_close_matches_from_there(self):
+        actual = '\n'.join(
+            ['test_%d ... ok' % i for i in range(30000)] +
+            ['Ran 30001 tests in 9.999s', '', 'FAILED (errors=1)']
+        )
+        expected = Output('Ran 30001 tests in 9.999s\n\nFAILED (errors=2)')
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(actual, expected)
+        self.assertEqual(str(cm.exception).split('\n')[1], "'FAILED (errors=1)'")
+
+
+    def test_only_writes_files_on_chapter_runs(self):
+        del os.environ['WRITE_MISMATCHES']
+        expected = '\n'.join('line %d' % i for i in range(1000))
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(expected + '\nmore', Output(expected))
+        self.assertNotIn('full outputs in:', str(cm.exception))
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct('a\nb', Output('a\nc'))
+        self.assertNotIn('full outputs in:', str(cm.exception))
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct('\n'.join(['.'] * 1000), Output('nope'))
+        self.assertNotIn('all of them are in:', str(cm.exception))
+        self.assertEqual(os.listdir(self.mismatch_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
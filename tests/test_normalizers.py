@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import unittest
+from textwrap import dedent, wrap
+
+from normalizers import (
+    fix_actual_output,
+    fix_creating_database_line,
+    fix_expected_output,
+    fix_interactive_managepy_stuff,
+    fix_test_dashes,
+    standardise_library_paths,
+    wrap_long_lines,
+)
+import normalizers
+from book_parser import Command, Output
+from output_matcher import StreamingOutputCheck
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+# the fixes assert_console_output_correct used to run one after the other,
+# kept to check normalizers against
+
+def strip_mock_ids(output):
+    strip_mocks_with_names = re.sub(
+        r"Mock name='(.+)' id='(\d+)'>",
+        r"Mock name='\1' id='XX'>",
+        output,
+    )
+    strip_all_mocks = re.sub(
+        r"Mock id='(\d+)'>",
+        r"Mock id='XX'>",
+        strip_mocks_with_names,
+    )
+    return strip_all_mocks
+
+def strip_object_ids(output):
+    return re.sub('0x([0-9a-f]+)>', '0xXX>', output)
+
+
+def strip_migration_timestamps(output):
+    return re.sub(r'00(\d\d)_auto_20\d{6}_\d{4}', r'00\1_auto_20XXXXXX_XXXX', output)
+
+
+def strip_localhost_port(output):
+    return re.sub(r'localhost:\d\d\d\d\d?', r'localhost:XXXX', output)
+
+
+def strip_session_ids(output):
+    return re.sub(r'^[a-z0-9]{32}$', r'xxx_session_id_xxx', output)
+
+
+def standardise_assertionerror_none(output):
+    return output.replace("AssertionError: None", "AssertionError")
+
+
+def strip_git_hashes(output):
+    fixed_indexes = re.sub(
+        r"index .......\.\........ 100644",
+        r"index XXXXXXX\.\.XXXXXXX 100644",
+        output,
+    )
+    fixed_commit_numbers = re.sub(
+        r"^[a-f0-9]{7} ",
+        r"XXXXXXX ",
+        fixed_indexes,
+        flags=re.MULTILINE,
+    )
+    return fixed_commit_numbers
+
+
+def strip_callouts(output):
+    minus_old_callouts = re.sub(
+        r"^(.+)  <\d+>$",
+        r"\1",
+        output,
+        flags=re.MULTILINE,
+    )
+    minus_new_callouts = re.sub(
+        r"^(.+)  \(\d+\)$",
+        r"\1",
+        minus_old_callouts,
+        flags=re.MULTILINE,
+    )
+    return minus_new_callouts
+
+
+def strip_test_speed(output):
+    return re.sub(
+        r"Ran (\d+) tests? in \d+\.\d\d\ds",
+        r"Ran \1 tests in X.Xs",
+        output,
+    )
+
+def strip_js_test_speed(output):
+    return re.sub(
+        r"Took \d+ms to run (\d+) tests. (\d+) passed, (\d+) failed.",
+        r"Took XXms to run \1 tests. \2 passed, \3 failed.",
+        output,
+    )
+
+
+def strip_bdd_test_speed(output):
+    return re.sub(
+        r"features/steps/(\w+).py:(\d+) \d+.\d\d\ds",
+        r"features/steps/\1.py:\2 XX.XXXs",
+        output,
+    )
+
+
+def strip_screenshot_timestamps(output):
+    fixed = re.sub(
+        r"window0-(201\d-\d\d-\d\dT\d\d\.\d\d\.\d?\d?)",
+        r"window0-201X-XX-XXTXX.XX",
+        output,
+    )
+    # this last is very specific to one listing in 19...
+    fixed = re.sub(r"^\d\d\.html$", "XX.html", fixed, flags=re.MULTILINE)
+    return fixed
+
+
+SQLITE_MESSAGES = {
+    'django.db.utils.IntegrityError: lists_item.list_id may not be NULL':
+    'django.db.utils.IntegrityError: NOT NULL constraint failed: lists_item.list_id',
+
+    'django.db.utils.IntegrityError: columns list_id, text are not unique':
+    'django.db.utils.IntegrityError: UNIQUE constraint failed: lists_item.list_id,\nlists_item.text',
+
+    'sqlite3.IntegrityError: columns list_id, text are not unique':
+    'sqlite3.IntegrityError: UNIQUE constraint failed: lists_item.list_id,\nlists_item.text'
+}
+
+
+def fix_sqlite_messages(actual_text):
+    fixed_text = actual_text
+    for old_version, new_version in SQLITE_MESSAGES.items():
+        fixed_text = fixed_text.replace(old_version, new_version)
+    return fixed_text
+
+
+def chained_actual(text):
+    # what assert_console_output_correct used to do, one re.sub at a time
+    for fix in [
+        standardise_library_paths, wrap_long_lines, strip_test_speed,
+        strip_js_test_speed, strip_bdd_test_speed, strip_git_hashes,
+        strip_mock_ids, strip_object_ids, strip_migration_timestamps,
+        strip_session_ids, strip_localhost_port, strip_screenshot_timestamps,
+        fix_sqlite_messages, fix_creating_database_line,
+        fix_interactive_managepy_stuff, standardise_assertionerror_none,
+    ]:
+        text = fix(text)
+    return text
+
+
+def chained_expected(text):
+    for fix in [
+        standardise_library_paths, fix_test_dashes, strip_test_speed,
+        strip_js_test_speed, strip_bdd_test_speed, strip_git_hashes,
+        strip_mock_ids, strip_object_ids, strip_migration_timestamps,
+        strip_session_ids, strip_localhost_port, strip_screenshot_timestamps,
+        strip_callouts, standardise_assertionerror_none,
+    ]:
+        text = fix(text)
+    return text
+
+
+TRICKY_OUTPUTS = [
+    '',
+    '\n',
+    'abcdef0 first line is a commit\n1234567 so is this\nnot 7654321 this one',
+    '12.html\nsome text\n34.html',
+    '12.html  <1>',
+    'abc12345678901234567890123456789',
+    'abc12345678901234567890123456789\n',
+    'abc12345678901234567890123456789\nand more',
+    "<Mock name='mock()' id='139758452629392'>",
+    "<Mock name='Ran 3 tests in 0.123s on localhost:8081 at 0x7f3a>' id='12'>",
+    "<Mock name='a' id='1'> <Mock name='b' id='2'> <Mock name='c' id='3'>",
+    "<Mock name='a' id='1'>, <Mock id='2'>, <Mock name='b' id='3'>",
+    "<Mock name='abcdef0 x' id='1'>",
+    "x = <Mock name='mock()' id='139758452629392'>  <1>",
+    'some code  <1>\nmore code  (2)\nboth  (3)  <4>\n  (5)  <6>\n  <7>\nthree spaces   <8>',
+    'a line  (1)  (2)  <3>',
+    'Took 12ms to run 3 tests. 3 passed, 0 failed  <1>',
+    'Ran 1 test in 0.001s\nRan 12 tests in 10.123s  <1>',
+    'features/steps/my_lists.py:19 0.020s\nfeatures/steps/my_lists.py:19 12.020s',
+    'index 5b6ea1b..a6a5c9d 100644\n--- a/lists/views.py',
+    'lists/migrations/0002_auto_20140227_1905.py\n0012_auto_20140227_1905.py',
+    'window0-2014-03-09T17.30.52.png\nwindow0-2015-01-01T01.02.png',
+    'Select an option: >>> "some default"\nok\nCreating test database for alias \'default\'...',
+    "Creating test database for alias 'default'...\nAssertionError: None",
+    'django.db.utils.IntegrityError: columns list_id, text are not unique\n'
+    'sqlite3.IntegrityError: columns list_id, text are not unique\n'
+    'django.db.utils.IntegrityError: lists_item.list_id may not be NULL',
+    'AssertionError: None  <1>',
+    ' ' + '-' * 69 + '\nabcdef0 ' + '-' * 69,
+    '  File "/usr/lib/python3/dist-packages/django/test.py", line 1\n\tindented\twith tabs',
+    'a very long line ' * 20,
+]
+
+
+class NormalizersMatchChainedFixesTest(unittest.TestCase):
+
+    def check(self, text):
+        self.assertEqual(fix_actual_output(text), chained_actual(text))
+        self.assertEqual(fix_expected_output(text), chained_expected(text))
+
+
+    def test_tricky_outputs(self):
+        for text in TRICKY_OUTPUTS:
+            with self.subTest(text=text):
+                self.check(text)
+
+
+    def test_real_test_run_output(self):
+        with open(os.path.join(THIS_FOLDER, 'actual_manage_py_test.output')) as f:
+            self.check(f.read())
+
+
+    def test_everything_assert_console_output_correct_gets_tested_with(self):
+        # test_book_tester star-imports this module, so import it late
+        from test_book_tester import AssertConsoleOutputCorrectTest
+        seen = []
+
+        class RecordingTest(AssertConsoleOutputCorrectTest):
+            def assert_console_output_correct(self, actual, expected, ls=False):
+                seen.append(actual)
+                seen.append(str(expected))
+                super().assert_console_output_correct(actual, expected, ls=ls)
+
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(RecordingTest)
+        suite.run(unittest.TestResult())
+        self.assertGreater(len(seen), 50)
+        for text in seen:
+            with self.subTest(text=text):
+                self.check(text)
+
+
+
+def textwrap_long_lines(text):
+    # wrap_long_lines before it learnt to leave short lines alone
+    return '\n'.join(
+        '\n'.join(wrap(p, 79, break_long_words=True, break_on_hyphens=False))
+        for p in text.split('\n')
+    )
+
+
+class WrapLongLinesMatchesTextwrapTest(unittest.TestCase):
+
+    def test_awkward_lines(self):
+        for line in [
+            '', ' ', '   ', 'x' * 79, 'x' * 80, 'x ' * 40, ' x' * 40,
+            'trailing space ', 'trailing tab\t', '\tleading tab', 'a\ttab',
+            'carriage\rreturn', 'form\x0cfeed', 'vertical\x0btab',
+            'non-breaking\xa0space', 'ideographic space\u3000',
+            '    indented ' + 'word ' * 20, 'hyphen-ated-' * 10,
+        ]:
+            for text in [line, 'short\n' + line + '\nshort']:
+                with self.subTest(text=text):
+                    self.assertEqual(wrap_long_lines(text), textwrap_long_lines(text))
+
+
+    def test_real_test_run_output(self):
+        with open(os.path.join(THIS_FOLDER, 'actual_manage_py_test.output')) as f:
+            output = f.read()
+        self.assertEqual(wrap_long_lines(output), textwrap_long_lines(output))
+        self.assertEqual(
+            wrap_long_lines(output.replace('    ', '\t')),
+            textwrap_long_lines(output.replace('    ', '\t')),
+        )
+
+
+
+class NormalizerTest(unittest.TestCase):
+
+    def test_mock_names_are_normalized_too(self):
+        self.assertEqual(
+            normalizers.ACTUAL.normalize("<Mock name='on localhost:8081' id='12'>"),
+            "<Mock name='on localhost:XXXX' id='XX'>",
+        )
+
+
+    def test_callouts_only_stripped_on_expected_side(self):
+        text = dedent(
+            """
+            self.assertEqual(1, 1)  <1>
+            self.fail('Finish the test!')  (2)
+            """
+        )
+        self.assertEqual(normalizers.ACTUAL.normalize(text), text)
+        self.assertEqual(
+            normalizers.EXPECTED.normalize(text),
+            "\nself.assertEqual(1, 1)\nself.fail('Finish the test!')\n",
+        )
+
+
+    def test_commit_hash_on_first_line(self):
+        self.assertEqual(
+            normalizers.EXPECTED.normalize('abcdef0 Some commit\n'),
+            'XXXXXXX Some commit\n',
+        )
+
+
+    def test_without_leaves_original_alone(self):
+        scan = normalizers.ACTUAL.scans[0]
+        without_mocks = scan.without('mock_name')
+        self.assertNotIn(normalizers.MOCK_NAME, without_mocks.rules)
+        self.assertIn(normalizers.MOCK_NAME, scan.rules)
+        self.assertIs(scan.without('mock_name'), without_mocks)
+
+
+    def test_leftmost_match_wins_where_rules_run_into_each_other(self):
+        # the old chain stripped the object id first, see the top of
+        # normalizers.py
+        text = '<thing at localhost:80810x7fab>'
+        self.assertEqual(normalizers.ACTUAL.normalize(text), '<thing at localhost:XXXXx7fab>')
+        self.assertEqual(chained_actual(text), '<thing at localhost:XXXXxXX>')
+
+
+    def test_migration_name_straight_after_a_port_keeps_its_timestamp(self):
+        text = 'localhost:80810002_auto_20140101_1234.py'
+        self.assertEqual(
+            normalizers.ACTUAL.normalize(text), 'localhost:XXXX002_auto_20140101_1234.py',
+        )
+        self.assertEqual(chained_actual(text), 'localhost:XXXX002_auto_20XXXXXX_XXXX.py')
+
+
+    def test_rules_are_told_apart_by_their_group(self):
+        scan = normalizers.ACTUAL.scans[0]
+        match = scan.regex.search('\nRan 3 tests in 0.123s')
+        self.assertIs(scan.rules[int(match.lastgroup[1:])], normalizers.TEST_SPEED)
+
+
+
+def chained_phantomjs_fixes(output):
+    # what run_js_tests used to do to make phantomjs look like firefox
+    output = output.replace('at file', '@file')
+    output = re.sub(r"Can't find variable: (\w+)", r"\1 is not defined", output)
+    output = re.sub(
+        r"'(\w+)' is not an object \(evaluating '(\w+)\.\w+'\)", r"\2 is \1", output
+    )
+    return re.sub(
+        r"'undefined' is not a function \(evaluating '(.+)\(.*\)'\)",
+        r"\1 is not a function",
+        output,
+    )
+
+
+PHANTOMJS_OUTPUT = dedent(
+    """\
+    not ok 1 - errors should be hidden on keypress
+        ReferenceError: Can't find variable: $ at file:///.../lists.js:2
+        TypeError: 'undefined' is not an object (evaluating 'Superlists.Accounts')
+        TypeError: 'undefined' is not a function (evaluating 'navigator.id.watch()')
+        TypeError: 'null' is not an object (evaluating 'input.value')
+    """
+)
+
+
+class TranslationTableTest(unittest.TestCase):
+
+    def test_phantomjs_profile_matches_old_fixes(self):
+        self.assertEqual(
+            normalizers.translate(PHANTOMJS_OUTPUT, 'phantomjs-firefox'),
+            chained_phantomjs_fixes(PHANTOMJS_OUTPUT),
+        )
+        self.assertIn(
+            'navigator.id.watch is not a function',
+            normalizers.translate(PHANTOMJS_OUTPUT, 'phantomjs-firefox'),
+        )
+
+
+    def test_sqlite_profile_matches_old_fixes(self):
+        for text in TRICKY_OUTPUTS:
+            with self.subTest(text=text):
+                self.assertEqual(
+                    normalizers.translate(text, 'sqlite-legacy'), fix_sqlite_messages(text),
+                )
+
+
+    def test_profiles_combine_into_one_scan(self):
+        table = normalizers.translation_table('sqlite-legacy', 'phantomjs-firefox')
+        self.assertIs(table, normalizers.translation_table('sqlite-legacy', 'phantomjs-firefox'))
+        self.assertEqual(
+            table.rules, normalizers.SQLITE_MESSAGES + normalizers.PHANTOMJS_MESSAGES,
+        )
+        table.reset_stats()
+        text = "sqlite3.IntegrityError: columns list_id, text are not unique\nCan't find variable: x"
+        self.assertEqual(
+            table.normalize(text),
+            chained_phantomjs_fixes(fix_sqlite_messages(text)),
+        )
+        self.assertEqual(table.scans, 1)
+
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        normalizers.reset_stats()
+
+
+    def tearDown(self):
+        normalizers.reset_stats()
+
+
+    def test_each_side_gets_its_own_entries_in_registry_order(self):
+        self.assertEqual(
+            [s.name for s in normalizers.EXPECTED.stages[:3]],
+            ['library_paths', 'test_dashes', 'session_id'],
+        )
+        actual_rules = normalizers.ACTUAL.scans[0].rules
+        self.assertNotIn(normalizers.OLD_CALLOUT, actual_rules)
+        self.assertIn(normalizers.SQLITE_MESSAGES[0], actual_rules)
+        self.assertEqual(actual_rules[-1], normalizers.ASSERTIONERROR_NONE)
+
+
+    def test_counts_hits_and_time(self):
+        fix_expected_output('Ran 2 tests in 0.123s\nRan 1 test in 0.001s  <1>')
+        fix_actual_output('x' * 100)
+        self.assertEqual(normalizers.TEST_SPEED.hits, 2)
+        self.assertEqual(normalizers.OLD_CALLOUT.hits, 1)
+        self.assertEqual(normalizers.MOCK_ID.hits, 0)
+        self.assertGreater(normalizers.TEST_SPEED.seconds, 0)
+        wrap_step = normalizers.ACTUAL.stages[1]
+        self.assertEqual((wrap_step.name, wrap_step.hits), ('wrap_long_lines', 1))
+        self.assertEqual(normalizers.EXPECTED.scans[0].scans, 1)
+
+
+    def test_lines_fixed_for_streaming_checks_arent_counted(self):
+        line = 'Ran 2 tests in 0.123s at 0x7fab>'
+        self.assertEqual(normalizers.fix_actual_line(line), fix_actual_output(line))
+        self.assertEqual(normalizers.TEST_SPEED.hits, 1)
+        self.assertEqual(normalizers.OBJECT_ID.hits, 1)
+        self.assertEqual(normalizers.ACTUAL.scans[0].scans, 1)
+
+
+    def test_streamed_commands_are_counted_once(self):
+        from book_tester import ChapterTest
+        test = ChapterTest()
+        test.setUp()
+        self.addCleanup(test.tearDown)
+        # long enough to get checked as it comes in
+        command = Command('printf "a\\nb\\nc\\nd\\nRan 2 tests in 0.123s\\n"')
+        expected = Output('a\nb\nc\nd\nRan 2 tests in X.Xs')
+        output = test.run_command(command, cwd=test.tempdir, expected_output=expected)
+        self.assertIsNotNone(StreamingOutputCheck.for_output(expected, None))
+        test.assert_console_output_correct(output, expected)
+        # the expected side is X.Xs already, so that's the actual output,
+        # once, not once more for each line streamed past the check
+        self.assertEqual(normalizers.TEST_SPEED.hits, 1)
+
+
+    def test_format_stats(self):
+        fix_expected_output('Ran 2 tests in 0.123s')
+        stats = normalizers.format_stats().split('\n')
+        self.assertEqual(stats[0].split(), ['normalizer', 'sides', 'hits', 'ms'])
+        self.assertIn(['test_speed', 'actual,expected', '1'], [l.split()[:3] for l in stats])
+        self.assertIn(['mock_id', 'actual,expected', '0'], [l.split()[:3] for l in stats])
+        self.assertEqual(len(stats), 1 + len(normalizers.REGISTRY) + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import copy
+import pickle
+import unittest
+from textwrap import dedent
+from unittest.mock import patch
+
+from book_parser import Output
+from book_tester import ChapterTest
+from output_matcher import (
+    EXACT,
+    PREFIX,
+    STRIPPED,
+    ActualOutputIndex,
+    ExpectedOutputMatcher,
+    StreamingOutputCheck,
+    compile_lines,
+)
+from normalizers import fix_actual_output
+
+
+class CompileLinesTest(unittest.TestCase):
+
+    def test_works_out_match_mode_for_each_line(self):
+        lines = compile_lines(dedent(
+            """\
+            [...]
+            Traceback (most recent call last):
+              File "/.../functional_tests.py", line 9, in <module>
+            AssertionError: 'To-Do' not found in [...]
+            """
+        ))
+        self.assertEqual(lines, [
+            (STRIPPED, 'Traceback (most recent call last):'),
+            (EXACT, '  File "/.../functional_tests.py", line 9, in <module>'),
+            (PREFIX, "AssertionError: 'To-Do' not found in"),
+            (STRIPPED, ''),
+        ])
+
+
+    def test_prefix_is_everything_before_the_first_ellipsis(self):
+        self.assertEqual(
+            compile_lines('one [...] two [...]'),
+            [(PREFIX, 'one')],
+        )
+
+
+
+class ExpectedOutputMatcherTest(unittest.TestCase):
+
+    def test_normalizes_expected_output(self):
+        matcher = ExpectedOutputMatcher.compile('Ran 1 test in 0.123s\n\nOK  <1>')
+        self.assertEqual(matcher.text, 'Ran 1 tests in X.Xs\n\nOK')
+
+
+    def test_needs_full_equality_for_long_outputs_without_ellipses(self):
+        self.assertFalse(ExpectedOutputMatcher('a\nb\nc\nd').needs_full_equality)
+        self.assertTrue(ExpectedOutputMatcher('a\nb\nc\nd\ne').needs_full_equality)
+        self.assertFalse(ExpectedOutputMatcher('a\nb\n[...]\nd\ne').needs_full_equality)
+
+
+    def test_whitespace_collapsed_version(self):
+        matcher = ExpectedOutputMatcher('a\n  b\nc\nd\ne')
+        collapsed = matcher.whitespace_collapsed
+        self.assertEqual(collapsed.text, 'a b c d e')
+        self.assertEqual(collapsed.lines, [(STRIPPED, 'a b c d e')])
+        self.assertFalse(collapsed.needs_full_equality)
+        self.assertIs(matcher.whitespace_collapsed, collapsed)
+
+
+
+class OutputMatcherTest(unittest.TestCase):
+
+    def test_outputs_are_compiled_when_first_used(self):
+        output = Output('Ran 2 tests in 0.001s')
+        self.assertIsNone(output._matcher)
+        self.assertEqual(output.matcher, ExpectedOutputMatcher('Ran 2 tests in X.Xs'))
+        self.assertIs(output.matcher, output.matcher)
+
+
+    def test_survives_pickling_and_copying(self):
+        output = Output('a\n  b\nc\nd\ne')
+        output.matcher.whitespace_collapsed
+        for clone in [pickle.loads(pickle.dumps(output)), copy.copy(output)]:
+            self.assertIsNone(clone._matcher)
+            self.assertEqual(clone.matcher, output.matcher)
+            self.assertEqual(clone.matcher.lines, output.matcher.lines)
+
+
+    def test_unpickled_outputs_use_current_normalizers(self):
+        pickled = pickle.dumps(Output('Ran 2 tests in 0.001s'))
+        with patch('output_matcher.fix_expected_output', lambda text: text.upper()):
+            self.assertEqual(pickle.loads(pickled).matcher.text, 'RAN 2 TESTS IN 0.001S')
+
+
+
+class ActualOutputIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ActualOutputIndex([
+            'Creating test database...',
+            '  File "/.../tests.py", line 9',
+            '    self.assertEqual(1, 2)',
+        ])
+
+
+    def test_exact_lines(self):
+        self.assertTrue(self.index.contains(EXACT, '  File "/.../tests.py", line 9'))
+        self.assertFalse(self.index.contains(EXACT, ' File "/.../tests.py", line 9'))
+
+
+    def test_stripped_lines(self):
+        self.assertTrue(self.index.contains(STRIPPED, 'self.assertEqual(1, 2)'))
+        self.assertFalse(self.index.contains(STRIPPED, 'self.assertEqual(1,'))
+
+
+    def test_prefixes(self):
+        self.assertTrue(self.index.contains(PREFIX, 'Creating test'))
+        self.assertTrue(self.index.contains(PREFIX, '    self.assert'))
+        self.assertFalse(self.index.contains(PREFIX, 'test database'))
+        self.assertEqual(sorted(self.index._prefixes), [13, 15])
+
+
+    def test_candidates_are_what_was_searched(self):
+        self.assertEqual(
+            self.index.candidates(PREFIX, 'Creating'),
+            ['Creating', '  File "', '    self'],
+        )
+        self.assertEqual(self.index.candidates(EXACT, 'x'), self.index.lines)
+        self.assertEqual(self.index.candidates(STRIPPED, 'x')[2], 'self.assertEqual(1, 2)')
+
+
+
+class AssertConsoleOutputErrorMessageTest(ChapterTest):
+
+    def test_missing_prefix_line_lists_truncated_actual_lines(self):
+        with self.assertRaises(AssertionError) as cm:
+            self.assert_console_output_correct(
+                'Creating test database...\nOK', Output('Destroying [...]'),
+            )
+        self.assertEqual(
+            str(cm.exception),
+            "'Destroying' not found in:\n'Creating t'\n'OK'",
+        )
+
+
+
+class StreamingOutputCheckTest(unittest.TestCase):
+
+    def check(self, expected):
+        return StreamingOutputCheck(ExpectedOutputMatcher.compile(expected), fix_actual_output)
+
+
+    def test_follows_normalized_output_ignoring_whitespace(self):
+        check = self.check('..\n------\nRan 2 tests in 0.123s\n\nOK')
+        for line in ['..\n', '------\n', 'Ran 2 tests in 3.210s\n', '\n', '  OK\t\n']:
+            self.assertTrue(check.feed(line), line)
+        self.assertIsNone(check.mismatched_line)
+
+
+    def test_stops_at_first_line_that_cannot_match(self):
+        check = self.check('a\nb\nc')
+        self.assertTrue(check.feed('a\n'))
+        self.assertFalse(check.feed('x\n'))
+        self.assertEqual(check.mismatched_line, 'x')
+        self.assertFalse(check.feed('c\n'))
+
+
+    def test_output_longer_than_expected_cannot_match(self):
+        check = self.check('a\nb')
+        self.assertTrue(check.feed('a\n'))
+        self.assertTrue(check.feed('b\n'))
+        self.assertFalse(check.feed('c\n'))
+
+
+    def test_creating_test_database_can_turn_up_anywhere(self):
+        check = self.check("Creating test database for alias 'default'...\na\nb")
+        self.assertTrue(check.feed('a\n'))
+        self.assertTrue(check.feed("Creating test database for alias 'default'...\n"))
+        self.assertTrue(check.feed('b\n'))
+
+
+    def test_stays_out_of_it_when_unsure(self):
+        check = self.check('a\nb')
+        self.assertTrue(check.feed('0123456789abcdef0123456789abcdef\n'))
+        self.assertTrue(check.undecided)
+        self.assertTrue(check.feed('anything\n'))
+
+        check = StreamingOutputCheck(ExpectedOutputMatcher('a'), lambda line: None)
+        self.assertTrue(check.feed('x\n'))
+
+
+    def test_only_for_outputs_that_must_match_exactly(self):
+        self.assertIsNotNone(StreamingOutputCheck.for_output(Output('1\n2\n3\n4\n5'), None))
+        self.assertIsNone(StreamingOutputCheck.for_output(Output('1\n2\n3\n4'), None))
+        self.assertIsNone(StreamingOutputCheck.for_output(Output('1\n[...]\n3\n4\n5'), None))
+        qunit = Output('1\n2\n3\n4\n5')
+        qunit.qunit_output = True
+        self.assertIsNone(StreamingOutputCheck.for_output(qunit, None))
+
+
+    def test_never_stops_output_that_would_have_passed(self):
+        from test_book_tester import AssertConsoleOutputCorrectTest
+        passing = []
+
+        class RecordingTest(AssertConsoleOutputCorrectTest):
+            def assert_console_output_correct(self, actual, expected, ls=False):
+                super().assert_console_output_correct(actual, expected, ls=ls)
+                if not ls:
+                    passing.append((actual.replace(self.tempdir, '/...'), expected))
+
+        unittest.defaultTestLoader.loadTestsFromTestCase(RecordingTest).run(unittest.TestResult())
+        checked = 0
+        for actual, expected in passing:
+            check = StreamingOutputCheck.for_output(expected, fix_actual_output)
+            if check is None:
+                continue
+            checked += 1
+            for line in actual.splitlines(True):
+                self.assertTrue(check.feed(line), (line, expected))
+        self.assertGreater(checked, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
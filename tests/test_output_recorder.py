@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from book_parser import Command, Output, assign_listing_ids
+from book_tester import ChapterTest
+from output_recorder import OutputRecorder, get_recording_path, load_recordings
+
+
+class OutputRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recordings_dir = tempfile.mkdtemp()
+        self.path = get_recording_path(self.recordings_dir, 'chapter_x')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.recordings_dir)
+
+
+    def test_only_records_when_asked_to(self):
+        with patch.dict(os.environ, {'RECORD_OUTPUTS': ''}):
+            self.assertIsNone(OutputRecorder.from_environment('chapter_x'))
+        with patch.dict(os.environ, {'RECORD_OUTPUTS': self.recordings_dir}):
+            self.assertIsNone(OutputRecorder.from_environment(None))
+            self.assertEqual(OutputRecorder.from_environment('chapter_x').path, self.path)
+
+
+    def test_checks_attach_to_the_command_they_checked(self):
+        command, expected = assign_listing_ids([Command('ls'), Output('a')])
+        recorder = OutputRecorder(self.path)
+        recorder.record_command(command, 'a\n', 0, 0.01234, '/tmp/x')
+        recorder.record_check('a\n', expected, True, '/tmp/x')
+        recorder.record_check('js output', expected, False, '/tmp/x')
+        recorder.save()
+
+        records = load_recordings(self.path)
+        self.assertEqual(records[0], dict(
+            listing_id=command.listing_id, command='ls', output='a\n', exit_code=0,
+            seconds=0.012, tempdir='/tmp/x', expected_id=expected.listing_id, ls=True,
+        ))
+        self.assertEqual(
+            (records[1]['command'], records[1]['output'], records[1]['expected_id']),
+            (None, 'js output', expected.listing_id),
+        )
+
+
+
+class RecordingChapterTest(ChapterTest):
+    chapter_name = 'chapter_x'
+
+    def setUp(self):
+        self.recordings_dir = tempfile.mkdtemp()
+        with patch.dict(os.environ, {'RECORD_OUTPUTS': self.recordings_dir}):
+            super().setUp()
+
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.recordings_dir)
+
+
+    def test_records_raw_output_and_rechecks_it(self):
+        self.listings = assign_listing_ids([
+            Command('echo $PWD; false'), Output('/...'),
+        ])
+        output = self.run_command(self.listings[0], cwd=self.tempdir, ignore_errors=True)
+        self.assert_console_output_correct(output, self.listings[1])
+        self.recorder.save()
+        records = load_recordings(get_recording_path(self.recordings_dir, 'chapter_x'))
+
+        self.assertEqual(records[0]['output'], records[0]['tempdir'] + '\n')
+        self.assertEqual(records[0]['exit_code'], 1)
+        self.assertEqual(self.recheck_recordings(records), [])
+
+        # an edited expected output gets a new id, but follows the same command
+        self.listings = assign_listing_ids([Command('echo $PWD; false'), Output('/elsewhere/')])
+        [(failed_id, message)] = self.recheck_recordings(records)
+        self.assertEqual(failed_id, records[0]['expected_id'])
+        self.assertIn("'/elsewhere/' not found", message)
+
+
+
+    def test_recheck_uses_current_normalizers(self):
+        self.listings = assign_listing_ids([Command('echo'), Output('Ran 1 test in 5.000s')])
+        self.assert_console_output_correct('Ran 1 test in 0.123s', self.listings[1])
+        self.listings[1].matcher
+        records = self.recorder.records
+        self.assertEqual(self.recheck_recordings(records), [])
+        with patch('output_matcher.fix_expected_output', lambda text: text):
+            [(failed_id, _)] = self.recheck_recordings(records)
+        self.assertEqual(failed_id, self.listings[1].listing_id)
+
+
+    def test_tree_checks_get_recorded_and_rechecked(self):
+        [tree] = assign_listing_ids([Output('superlists/\n\u251c\u2500\u2500 lists')])
+        self.listings = [tree]
+        actual = '.\n\u251c\u2500\u2500 lists\n'
+        self.assert_console_output_correct(actual, self._tree_for_checking(tree))
+        [record] = self.recorder.records
+        self.assertEqual(record['expected_id'], tree.listing_id)
+        self.assertEqual(self.recheck_recordings([record]), [])
+        record['output'] = '.\n\u251c\u2500\u2500 accounts\n'
+        self.assertEqual(len(self.recheck_recordings([record])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,22 @@ import unittest
 from unittest.mock import patch
 import subprocess
 from textwrap import dedent
+import asyncio
 import os
+import shutil
+import signal
+import tempfile
+import time
 
 from book_parser import CodeListing
 from sourcetree import (
     BOOTSTRAP_WGET,
     ApplyCommitException,
-    Commit, SourceTree,
+    ProcessSupervisor,
+    Commit, GitQueryCache, SourceTree,
     check_indentation,
     get_offset,
+    get_timeout,
     strip_comments,
 )
 
@@ -507,6 +514,374 @@ class ApplyFromGitRefTest(unittest.TestCase):
 
 
 
+class ShellSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sourcetree = SourceTree(shell_session=True)
+
+
+    def tearDown(self):
+        self.sourcetree.cleanup()
+
+
+    def run_command(self, command, **kwargs):
+        return self.sourcetree.run_command(command, cwd=self.sourcetree.tempdir, **kwargs)
+
+
+    def test_commands_share_one_shell(self):
+        self.assertEqual(self.run_command('echo hello'), 'hello\n')
+        session = self.sourcetree.shell_session
+        self.assertEqual(self.run_command('printf "no newline"'), 'no newline')
+        self.assertIs(self.sourcetree.shell_session, session)
+        self.assertEqual(session.commands_run, 2)
+        self.assertEqual(self.sourcetree.processes, [])
+
+
+    def test_shell_state_carries_over_but_cwd_does_not(self):
+        self.run_command('export SOME_SETTING=1; cd /')
+        self.assertEqual(
+            self.run_command('echo $SOME_SETTING; pwd'),
+            '1\n{}\n'.format(self.sourcetree.tempdir),
+        )
+
+
+    def test_passes_on_environment_changes(self):
+        self.run_command('true')
+        os.environ['TEHFOO'] = 'qux'
+        self.assertEqual(self.run_command('echo $TEHFOO'), 'qux\n')
+
+
+    def test_exit_codes_and_errors(self):
+        with self.assertRaises(Exception):
+            self.run_command('synt!tax error')
+        self.run_command('echo "unbalanced', ignore_errors=True)
+        self.assertEqual(self.sourcetree.last_returncode, 2)
+        self.run_command('exit 3', ignore_errors=True)
+        self.assertEqual(self.sourcetree.last_returncode, 3)
+        self.assertEqual(self.run_command('echo still here'), 'still here\n')
+
+
+    def test_commands_cant_read_the_sessions_input(self):
+        self.assertEqual(self.run_command('cat; echo done'), 'done\n')
+
+
+    def test_background_and_interactive_commands_get_their_own_shell(self):
+        self.run_command('sleep 5 & #runserver')
+        self.run_command('read x; echo $x', user_input='hi')
+        self.run_command('echo one && echo two 2>&1')
+        self.assertEqual(
+            [p._command for p in self.sourcetree.processes],
+            ['sleep 5 & #runserver', 'read x; echo $x'],
+        )
+
+
+
+class AsyncSourceTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sourcetree = SourceTree()
+
+
+    def tearDown(self):
+        self.sourcetree.cleanup()
+
+
+    def test_run_returns_output(self):
+        output = asyncio.run(self.sourcetree.run(
+            'read x; echo hello $x', cwd=self.sourcetree.tempdir, user_input='there',
+        ))
+        self.assertEqual(output, 'hello there\n')
+
+
+    def test_run_raises_on_errors(self):
+        with self.assertRaises(Exception):
+            asyncio.run(self.sourcetree.run('synt!tax error', cwd=self.sourcetree.tempdir))
+        asyncio.run(self.sourcetree.run(
+            'synt!tax error', cwd=self.sourcetree.tempdir, ignore_errors=True,
+        ))
+        self.assertEqual(self.sourcetree.last_returncode, 127)
+
+
+    def test_run_times_out_and_is_recorded_like_run_command(self):
+        self.sourcetree.supervisor.kill_grace = 0.5
+        with patch('sourcetree.DEFAULT_TIMEOUT', 0.2):
+            output = asyncio.run(self.sourcetree.run(
+                'echo hello; sleep 30', cwd=self.sourcetree.tempdir, ignore_errors=True,
+            ))
+        self.assertEqual(output, 'hello\n\n[timed out after 0.2s]\n')
+        self.assertEqual(self.sourcetree.last_returncode, -signal.SIGTERM)
+        [record] = self.sourcetree.command_stats.records
+        self.assertEqual(record['command'], 'echo hello; sleep 30')
+        self.assertEqual(record['exit_code'], -signal.SIGTERM)
+        self.assertEqual(record['output_bytes'], len(output))
+        self.assertIsNone(record['cpu_seconds'])
+
+
+    def test_runs_can_overlap(self):
+        async def run_both():
+            return await asyncio.gather(
+                self.sourcetree.run('sleep 0.5; echo one', cwd=self.sourcetree.tempdir),
+                self.sourcetree.run('sleep 0.5; echo two', cwd=self.sourcetree.tempdir),
+            )
+        start = time.time()
+        self.assertEqual(asyncio.run(run_both()), ['one\n', 'two\n'])
+        self.assertLess(time.time() - start, 0.9)
+
+
+    def test_spawned_process_output_can_be_watched(self):
+        async def start_server():
+            server = await self.sourcetree.spawn(
+                'echo starting; echo ready; sleep 30', cwd=self.sourcetree.tempdir,
+            )
+            line = await server.wait_for_line('ready', timeout=5)
+            still_running = server.returncode is None
+            await server.stop()
+            return server, line, still_running
+
+        server, line, still_running = asyncio.run(start_server())
+        self.assertEqual(line, 'ready\n')
+        self.assertEqual(server.lines, ['starting\n', 'ready\n'])
+        self.assertTrue(still_running)
+        self.assertEqual(server.returncode, -signal.SIGTERM)
+        self.assertEqual(self.sourcetree.processes, [server.process])
+
+
+    def test_wait_for_line_raises_if_process_finishes_first(self):
+        async def watch():
+            server = await self.sourcetree.spawn('echo oops', cwd=self.sourcetree.tempdir)
+            try:
+                await server.wait_for_line('ready')
+            finally:
+                await server.stop()
+        with self.assertRaises(Exception) as cm:
+            asyncio.run(watch())
+        self.assertIn('oops', str(cm.exception))
+
+
+    def test_stopping_a_spawned_process_kills_it_if_it_ignores_sigterm(self):
+        self.sourcetree.supervisor.kill_grace = 0.5
+        async def start_stubborn_server():
+            server = await self.sourcetree.spawn(
+                'trap "" TERM; echo ready; sleep 30 & wait', cwd=self.sourcetree.tempdir,
+            )
+            await server.wait_for_line('ready', timeout=5)
+            await server.stop()
+            return server
+
+        start = time.time()
+        server = asyncio.run(start_stubborn_server())
+        self.assertEqual(server.returncode, -signal.SIGKILL)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertLess(time.time() - start, 5)
+
+
+
+class ProcessSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = ProcessSupervisor(kill_grace=0.5)
+        self.tempdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        self.supervisor.stop_all()
+        shutil.rmtree(self.tempdir)
+
+
+    def start(self, command, **kwargs):
+        return self.supervisor.start(command, command, self.tempdir, **kwargs)
+
+
+    def test_timeouts_by_command_type(self):
+        self.assertIsNone(get_timeout('python manage.py runserver'))
+        self.assertEqual(get_timeout('python functional_tests.py'), 15 * 60)
+        self.assertEqual(get_timeout('python manage.py test lists'), 10 * 60)
+        self.assertEqual(get_timeout('git status'), 5 * 60)
+        self.assertEqual(get_timeout('fab deploy:host=elspeth@superlists.ottg.eu'), 30 * 60)
+
+
+    def test_timeouts_can_be_scaled(self):
+        with patch.dict(os.environ, {'TIMEOUT_SCALE': '2.5'}):
+            self.assertEqual(get_timeout('git status'), 2.5 * 5 * 60)
+            self.assertEqual(get_timeout('python functional_tests.py'), 2.5 * 15 * 60)
+            self.assertIsNone(get_timeout('python manage.py runserver'))
+
+
+    def test_stops_commands_that_time_out(self):
+        process = self.start('echo started; sleep 30', timeout=0.2)
+        output, _ = process.communicate()
+        self.assertEqual(output, 'started\n')
+        self.assertEqual(process.returncode, -signal.SIGTERM)
+        self.assertTrue(process._timed_out)
+
+
+    def test_kills_process_groups_that_ignore_sigterm(self):
+        process = self.start('trap "" TERM; echo ready; sleep 30 & wait')
+        self.assertEqual(process.stdout.readline(), 'ready\n')
+        start = time.time()
+        self.supervisor.stop(process)
+        process.wait()
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertFalse(subprocess.call(['pgrep', '-g', str(process.pid)]) == 0)
+
+
+    def test_forgets_finished_processes_and_closes_their_pipes(self):
+        finished = self.start('true')
+        finished.wait()
+        running = self.start('sleep 30')
+        self.assertEqual(self.supervisor.processes, [running])
+        self.assertTrue(finished.stdout.closed)
+        self.assertTrue(finished.stdin.closed)
+
+
+    def test_only_stops_its_own_matching_processes(self):
+        other_supervisor = ProcessSupervisor()
+        theirs = other_supervisor.start('sleep 30 #runserver', 'sleep 30', self.tempdir)
+        server = self.start('sleep 30 #runserver', background=True)
+        other = self.start('sleep 30')
+        self.supervisor.stop_matching('runserver')
+        self.assertEqual(self.supervisor.processes, [other])
+        self.assertIsNotNone(server.returncode)
+        self.assertIsNone(theirs.poll())
+        other_supervisor.stop_all()
+
+
+    def test_sourcetree_run_command_times_out(self):
+        sourcetree = SourceTree()
+        sourcetree.supervisor.kill_grace = 0.5
+        with patch('sourcetree.DEFAULT_TIMEOUT', 0.2):
+            output = sourcetree.run_command(
+                'echo hello; sleep 30', cwd=sourcetree.tempdir, ignore_errors=True,
+            )
+        self.assertEqual(output, 'hello\n\n[timed out after 0.2s]\n')
+        self.assertEqual(sourcetree.last_returncode, -signal.SIGTERM)
+        sourcetree.cleanup()
+
+
+    def test_shell_session_commands_time_out_too(self):
+        sourcetree = SourceTree(shell_session=True)
+        sourcetree.supervisor.kill_grace = 0.5
+        with patch('sourcetree.DEFAULT_TIMEOUT', 0.2):
+            output = sourcetree.run_command(
+                'echo hello; sleep 30', cwd=sourcetree.tempdir, ignore_errors=True,
+            )
+        self.assertEqual(output, 'hello\n\n[timed out after 0.2s]\n')
+        self.assertNotEqual(sourcetree.last_returncode, 0)
+        # and the next command gets a new session
+        self.assertEqual(
+            sourcetree.run_command('echo again', cwd=sourcetree.tempdir), 'again\n'
+        )
+        sourcetree.cleanup()
+
+
+
+class GitQueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        git = 'git -c user.name=T -c user.email=t@example.com '
+        subprocess.check_output(
+            'git init -q . && git checkout -q -b previous && ' +
+            'echo one > a.py && git add a.py && ' + git + 'commit -qm first && ' +
+            'git checkout -q -b chapter_x && ' +
+            'echo two >> a.py && ' + git + 'commit -qam "--ch01l001--" && ' +
+            'echo three >> a.py && ' + git + 'commit -qam "--ch01l002--"',
+            shell=True, cwd=self.origin,
+        )
+
+
+    def tearDown(self):
+        shutil.rmtree(self.origin)
+        shutil.rmtree(self.cache_dir)
+
+
+    def checkout(self):
+        sourcetree = SourceTree()
+        self.addCleanup(sourcetree.cleanup)
+        sourcetree.get_local_repo_path = lambda chapter: self.origin
+        sourcetree.git_queries = GitQueryCache(sourcetree, self.cache_dir)
+        sourcetree.start_with_checkout('chapter_x', 'previous')
+        sourcetree.command_stats.records = []
+        return sourcetree
+
+
+    def commands_run(self, sourcetree):
+        return [r['command'].split()[1] for r in sourcetree.command_stats.records]
+
+
+    def test_answers_questions_about_commits(self):
+        sourcetree = self.checkout()
+        commit_spec = sourcetree.get_commit_spec('ch01l001')
+        self.assertEqual(sourcetree.get_files_from_commit_spec(commit_spec), ['a.py'])
+        self.assertEqual(sourcetree.show_future_version(commit_spec, 'a.py'), 'one\ntwo\n')
+        self.assertIn('+two', sourcetree.git_queries.query('git show {}', commit_spec))
+        self.assertEqual(
+            self.commands_run(sourcetree), ['rev-parse', '--version', 'diff-tree', 'show', 'show'],
+        )
+
+
+    def test_asks_git_once_per_question(self):
+        sourcetree = self.checkout()
+        commit_spec = sourcetree.get_commit_spec('ch01l001')
+        sourcetree.show_future_version(commit_spec, 'a.py')
+        sourcetree.show_future_version(commit_spec, 'a.py')
+        self.assertEqual(self.commands_run(sourcetree), ['rev-parse', '--version', 'show'])
+
+        # and a rerun only has to work out which commit it is, and check
+        # it's talking to the same git
+        sourcetree = self.checkout()
+        commit_spec = sourcetree.get_commit_spec('ch01l001')
+        self.assertEqual(sourcetree.show_future_version(commit_spec, 'a.py'), 'one\ntwo\n')
+        self.assertEqual(self.commands_run(sourcetree), ['rev-parse', '--version'])
+
+
+    def test_diff_settings_are_part_of_the_key(self):
+        sourcetree = self.checkout()
+        commit_spec = sourcetree.get_commit_spec('ch01l001')
+        sourcetree.show_future_version(commit_spec, 'a.py')
+        sourcetree = self.checkout()
+        sourcetree.run_command('git config diff.noprefix true', silent=True)
+        sourcetree.command_stats.records = []
+        sourcetree.show_future_version(sourcetree.get_commit_spec('ch01l001'), 'a.py')
+        self.assertEqual(self.commands_run(sourcetree), ['rev-parse', '--version', 'show'])
+
+
+    def test_patches_from_cached_diffs(self):
+        sourcetree = self.checkout()
+        sourcetree.patch_from_commit('ch01l001')
+        sourcetree.patch_from_commit('ch01l002')
+        self.assertEqual(sourcetree.get_contents('a.py'), 'one\ntwo\nthree\n')
+        self.assertFalse(os.path.exists(os.path.join(sourcetree.tempdir, 'commit.patch')))
+
+
+    def test_diffs_are_patched_in_byte_for_byte(self):
+        git = 'git -c user.name=T -c user.email=t@example.com '
+        subprocess.check_output(
+            "printf 'caf\\351\\r\\n' > b.txt && git add b.txt && " +
+            git + 'commit -qm "--ch01l003--"',
+            shell=True, cwd=self.origin,
+        )
+        sourcetree = self.checkout()
+        sourcetree.patch_from_commit('ch01l001')
+        sourcetree.patch_from_commit('ch01l002')
+        for _ in range(2):
+            # once from git, once from the cache
+            sourcetree.patch_from_commit('ch01l003')
+            with open(os.path.join(sourcetree.tempdir, 'superlists', 'b.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'caf\xe9\r\n')
+            sourcetree.run_command('rm b.txt', silent=True)
+            sourcetree.git_queries.answers = {}
+
+
+    def test_missing_commits_still_raise(self):
+        sourcetree = self.checkout()
+        with self.assertRaises(Exception):
+            sourcetree.get_files_from_commit_spec(sourcetree.get_commit_spec('nope'))
+
+
+
 class SourceTreeRunCommandTest(unittest.TestCase):
 
     def test_running_simple_command(self):
@@ -587,6 +962,45 @@ class SourceTreeRunCommandTest(unittest.TestCase):
         assert 'OK' in output
 
 
+    def test_output_check_sees_lines_as_they_come_and_can_stop_command(self):
+        sourcetree = SourceTree()
+        seen = []
+
+        class StopAtTwo(object):
+            mismatched_line = None
+
+            def feed(self, line):
+                seen.append(line)
+                if line == 'two\n':
+                    self.mismatched_line = line
+                return self.mismatched_line is None
+
+        started = time.time()
+        output = sourcetree.run_command(
+            'echo one; echo two; sleep 30; echo three',
+            cwd=sourcetree.tempdir, output_check=StopAtTwo(),
+        )
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual(output, 'one\ntwo\n')
+        self.assertEqual(seen, ['one\n', 'two\n'])
+
+
+    def test_output_check_with_user_input(self):
+        sourcetree = SourceTree()
+
+        class AcceptAll(object):
+            mismatched_line = None
+
+            def feed(self, line):
+                return True
+
+        command = "python3 -c \"a = input(); print('OK' if a=='yes' else 'NO')\""
+        output = sourcetree.run_command(
+            command, cwd=sourcetree.tempdir, user_input='yes', output_check=AcceptAll(),
+        )
+        self.assertEqual(output, 'OK\n')
+
+
     def test_special_cases_wget_bootstrap(self):
         sourcetree = SourceTree()
         sourcetree.run_command('mkdir superlists', cwd=sourcetree.tempdir)